@@ -3,48 +3,67 @@ import json
 import os
 import re
 import secrets
-import tempfile
+import shutil
+import threading
 import time
-import urllib
 from functools import wraps
-from json import JSONDecodeError
 from pathlib import Path
 from typing import Dict, Optional, Tuple, List
-import requests
 from flask import Flask, render_template, request, session, Response, abort, redirect, url_for, jsonify, \
     stream_with_context
 from llama_cpp import get_llama_default_parameters, get_llama_parameters, ASSISTANT, USER, \
-    get_default_props_from_llamacpp
+    get_context_per_slot
+from llama_cpp.backends import BACKEND_POOL
+from llama_cpp.stream import StreamRelay, frame
+from llama_cpp.tokens import TOKEN_COUNTER
 from flask_session import Session
 from urllib.parse import urlparse
 from rag import get_available_collections, load_collection, get_collection_from_query, create_or_open_collection, \
-    get_text_splitter, extract_contents, get_context_from_rag, RAG_DATA_DIR
-from utils.filesystem import is_archive, extract_archive, find_files
-from utils.timestamp_formatter import categorize_timestamp
+    get_text_splitter, get_context_from_rag, RAG_DATA_DIR, warm_up_embeddings, warm_up_reranker
+from rag.embeddings import EMBEDDINGS_REGISTRY
+from rag.cache import VECTOR_STORE_CACHE, EXTRACTION_CACHE, QUERY_EMBEDDING_CACHE, RETRIEVAL_CACHE
+from rag.pdf import PDF_WORKER_POOL
+from rag.ann import ANN_BUILDER
+from rag.quantize import PRECISIONS
+from rag.lexical import HYBRID_SEARCH
+from rag.rerank import RERANKER
+from rag.ingest import extract_files, CollectionWriter
+from rag.jobs import IngestionQueue, Job, JobCancelled
+from utils.filesystem import extract_archive, find_files, classify_file, FileType
+from utils.timestamp_formatter import categorize_timestamp, timestamp_range, AGE_DAYS
+from history import HistoryStore
 
 
 MAX_NUM_TOKENS_FOR_INLINE_CONTEXT: int = 2**15
+
+
+def update_max_num_tokens_for_inline_context(_props=None):
+    global MAX_NUM_TOKENS_FOR_INLINE_CONTEXT
+    # With several llama-servers the context must fit into a slot of any of them
+    MAX_NUM_TOKENS_FOR_INLINE_CONTEXT = get_context_per_slot() or MAX_NUM_TOKENS_FOR_INLINE_CONTEXT
+
+
 while True:
     # noinspection PyBroadException
     try:
-        props = get_default_props_from_llamacpp()
-        default_generation_settings = props.get('default_generation_settings', {})
-        num_slots = props.get('total_slots', 1)
-        n_ctx = default_generation_settings.get('n_ctx', MAX_NUM_TOKENS_FOR_INLINE_CONTEXT)
-        MAX_NUM_TOKENS_FOR_INLINE_CONTEXT = n_ctx // num_slots
+        update_max_num_tokens_for_inline_context()
         break
     except Exception:
         print("Waiting for llama-server")
         time.sleep(1)
         # break
+BACKEND_POOL.add_props_listener(update_max_num_tokens_for_inline_context)  # llama-server may be restarted with another -c
+BACKEND_POOL.start()
 
 
-LOADED_EMBEDDINGS = {}
 CACHE_DIR = 'cache'
 if not os.path.exists(CACHE_DIR):
     os.mkdir(CACHE_DIR)
+HISTORY = HistoryStore(CACHE_DIR)
+HISTORY.collect_blobs_in_background()  # of conversations deleted before the last restart
+HISTORY_MAX_PAGE_SIZE = int(os.environ.get('HISTORY_MAX_PAGE_SIZE', 200))
 ADDITIONAL_CONTEXT = {}  # this can be done as global variable
-LLAMA_API = 'http://localhost:8080/'
+STREAM_CANCELLATIONS: Dict[str, Tuple[str, threading.Event]] = {}  # chat token -> (hashed username, cancel flag)
 
 
 app = Flask(__name__)
@@ -57,20 +76,18 @@ app.config.update(
 app.config['SESSION_TYPE'] = 'filesystem'  # Filesystem-based sessions
 app.config['SESSION_PERMANENT'] = True  # Persist sessions across restarts
 app.config["PERMANENT_SESSION_LIFETIME"] = 30 * 24 * 60 * 60  # 30 days
-app.config['UPLOAD_FOLDER'] = tempfile.gettempdir()
+app.config['UPLOAD_FOLDER'] = os.path.abspath(os.path.join(CACHE_DIR, 'uploads'))  # kept until ingested, also across restarts
 Session(app)
 
+threading.Thread(target=warm_up_embeddings, daemon=True).start()  # models in RAG_EMBEDDINGS_WARMUP, if any
+threading.Thread(target=warm_up_reranker, daemon=True).start()  # if any collection reranks its results
+INGESTION = IngestionQueue(app.config['UPLOAD_FOLDER'], lambda job: ingest(job))  # started once everything is defined
+
 
 @app.route('/api/chats')
 def get_chats():
     username = hash_username(session.get('username'))
-    project_id = request.args.get('project_id')
-    all_chats = load_all_chats(username)  # your existing function
-    if project_id:
-        filtered = [c for c in all_chats if c.get('project_id') == project_id]
-    else:
-        filtered = all_chats
-    return jsonify(filtered)
+    return history_listing(username)
 
 #
 # @app.route('/api/projects', methods=['GET', 'POST'])
@@ -133,10 +150,9 @@ def remove_collection(collection):
                 path = Path(RAG_DATA_DIR) / Path(f'user/{username}' if key == 'user' else 'common') / Path(collection)
                 path = os.path.normpath(path)
                 if path.startswith(RAG_DATA_DIR) and os.path.exists(path):
-                    os.remove(path + '/config.json')
-                    os.remove(path + '/index.faiss')
-                    os.remove(path + '/index.pkl')
-                    os.rmdir(path)
+                    VECTOR_STORE_CACHE.invalidate(path)
+                    RETRIEVAL_CACHE.invalidate(path)
+                    shutil.rmtree(path)
                 return jsonify({})
     abort(404)
     #
@@ -150,11 +166,7 @@ def remove(token):
     """
     username = session.get('username')
     hashed_username = hash_username(username)
-    history_key = f'{hashed_username}-{token}-history'
-    cache_key = f'{CACHE_DIR}/{history_key}.json'
-    try:
-        os.remove(cache_key)
-    except FileNotFoundError:
+    if not HISTORY.delete(hashed_username, token):
         abort(400)
     return jsonify({})
 
@@ -172,32 +184,89 @@ def history(item=None):
         redirect(url_for('logout'))
     hashed_username = hash_username(username)
 
-    history_items = load_all_chats(hashed_username, item)
-
-    return jsonify(history_items)
+    return history_listing(hashed_username, item)
 
 
-def load_all_chats(username: str, item: Optional[str] = None):
+def history_listing(username: str, item: Optional[str] = None) -> Response:
+    """
+    Conversations of a user as json, for /history and /api/chats.
+    Query arguments: limit and cursor (X-Next-Cursor of the previous page), since (X-History-Since of an earlier
+    response, returns only what changed, deleted conversations included), project_id and age.
+    An unchanged listing is answered with 304 Not Modified when the client sends If-None-Match.
+    """
+    args = request.args
+    try:
+        limit = min(int(args['limit']), HISTORY_MAX_PAGE_SIZE) if 'limit' in args else None
+        since = int(args['since']) if 'since' in args else None
+        cursor = None
+        if 'cursor' in args:
+            updated_at, _, chat_id = args['cursor'].partition('_')
+            cursor = (float(updated_at), chat_id)
+    except ValueError:
+        return jsonify({"error": "Invalid limit, since or cursor"}), 400
+    age = args.get('age')
+    if age is not None and age not in AGE_DAYS:
+        return jsonify({"error": f"Unknown age {age}"}), 400
+
+    seq, count = HISTORY.version(username)
+    etag = hashlib.sha256(f'{seq}-{count}-{item}-{request.query_string.decode()}'.encode()).hexdigest()[:32]
+    if age is None and request.if_none_match.contains(etag):  # age buckets move with the clock
+        response = Response(status=304)
+    else:
+        updated_after, updated_until = timestamp_range(age) if age else (None, None)
+        history_items = load_all_chats(username, item, args.get('project_id'), limit=limit, cursor=cursor,
+                                       since=since, updated_after=updated_after, updated_until=updated_until)
+        response = jsonify(history_items)
+        if limit and len(history_items) == limit:
+            last = history_items[-1]
+            response.headers['X-Next-Cursor'] = f"{last['updated_at']!r}_{last['url']}"
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-History-Since'] = str(seq)
+    return response
+
+
+def load_all_chats(username: str, item: Optional[str] = None, project_id: Optional[str] = None, **filters):
     history_items = []
-    entries = os.listdir(CACHE_DIR)
-    sorted_entries = sorted(entries, key=lambda x: os.path.getmtime(os.path.join(CACHE_DIR, x)), reverse=True)
-    for d in sorted_entries:
-        if d.startswith(username):
-            with open(f'{CACHE_DIR}/{d}', 'r') as f:
-                try:
-                    json_data = json.load(f)
-                except JSONDecodeError:
-                    continue  # We ignore
-            url = d.split('-')[1]
-            history_items.append(dict(
-                title=json_data["title"],
-                url=url,
-                items=json_data["items"] if item == url else [],
-                age=categorize_timestamp(os.path.getmtime(os.path.join(CACHE_DIR, d)))
-            ))
+    for entry in HISTORY.list(username, project_id, **filters):  # only the requested conversation is loaded
+        url = entry['chat_id']
+        if entry['deleted']:
+            history_items.append(dict(url=url, deleted=True, updated_at=entry['updated_at']))
+            continue
+        items = []
+        if item == url:
+            json_data = HISTORY.load(username, url)
+            items = json_data["items"] if json_data else []
+        history_items.append(dict(
+            title=entry['title'],
+            url=url,
+            items=items,
+            project_id=entry['project_id'],
+            age=categorize_timestamp(entry['updated_at']),
+            updated_at=entry['updated_at']
+        ))
     return history_items
 
 
+@app.route('/api/stats')
+@login_required
+def get_stats():
+    return jsonify(dict(
+        embeddings=EMBEDDINGS_REGISTRY.stats(),
+        vector_stores=VECTOR_STORE_CACHE.stats(),
+        query_embeddings=QUERY_EMBEDDING_CACHE.stats(),
+        retrievals=RETRIEVAL_CACHE.stats(),
+        ann=ANN_BUILDER.stats(),
+        hybrid=HYBRID_SEARCH.stats(),
+        rerank=RERANKER.stats(),
+        pdf=PDF_WORKER_POOL.stats(),
+        extractions=EXTRACTION_CACHE.stats(),
+        ingestion=INGESTION.stats(),
+        llama=BACKEND_POOL.stats(),
+        tokens=TOKEN_COUNTER.stats(),
+    ))
+
+
 @login_required
 @app.route("/settings/default")
 def get_default_settings():
@@ -244,108 +313,195 @@ def index():
 @login_required
 @app.route('/upload', methods=["POST"])
 def upload():
+    """
+    Queues the uploaded file for ingestion, the progress is at /upload/<job id>/events
+    """
     if not request.files:
         abort(400)
 
     files = request.files.getlist('file')
     if len(files) != 1:
         abort(400)  # maybe one day we will upload more files, now you can simply upload a zip
+    if not files[0].filename:
+        return jsonify({"error": "You must provide a file."})
 
-    base_folder = os.path.join(app.config['UPLOAD_FOLDER'], secrets.token_hex(8))
     collection_selector = request.form.get('collection-selector', None)
     use_collection = collection_selector != ''
-    return_args = {}
-
-    n_tokens = 0
-
-    # first check if any of the files is an archive
-    # if this is the case, append it to files
-    error, files_to_process = prepare_files(base_folder, files)
-    if error:
-        return jsonify(error)
-
-    contents = []
-    # Now loop over the files and extract the contents
-    for destination in files_to_process:
-        # noinspection PyBroadException
-        try:
-            content, error = extract_contents(destination)
-        except Exception as e:
-            print(e)
-            continue  # ignore this file
-        if error:
-            continue
-            # return jsonify(error)
-        contents.append((destination, content))
-
+    collection_name = None
     if use_collection:
-
         collection_name = request.form.get('collection-name')
-        collection_selector = request.form.get('collection-selector')
         if not collection_name and not collection_selector:
             return jsonify({"error": f"You must provide a name for the collection."})
         if not collection_name:
             collection_name = collection_selector
-        collection_visibility = request.form.get('collection-visibility', 'private')
-        username = session.get('username')
-
-        index, index_path, hashed_index_name = create_or_open_collection(collection_name, username, collection_visibility == "public")
-        for destination, content in contents:
-            filename = os.path.basename(destination)
-            text_splitter = get_text_splitter(destination)
-            docs = text_splitter.create_documents([content], metadatas=[dict(file=filename)])
-            # Ok now we have all docs and metadata
-            index.add_documents(docs)
-            index.save_local(index_path)
-            return_args['collection-name'] = collection_name
-            return_args['collection-hashed-name'] = hashed_index_name
-            return_args['collection-visibility'] = collection_visibility
+    collection_precision = request.form.get('collection-precision') or None
+    if collection_precision is not None and collection_precision not in PRECISIONS:
+        return jsonify({"error": f"Unknown precision {collection_precision}."})
+
+    job_id = INGESTION.new_id()
+    base_folder = INGESTION.job_dir(job_id)
+    filenames = []
+    for file in files:
+        destination = os.path.normpath(os.path.join(base_folder, file.filename))
+        if not destination.startswith(base_folder + os.sep):
+            abort(400)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        file.save(destination)
+        filenames.append(os.path.relpath(destination, base_folder))
+
+    INGESTION.submit(job_id, session.get('username'), dict(
+        files=filenames,
+        use_collection=use_collection,
+        collection_name=collection_name,
+        collection_visibility=request.form.get('collection-visibility', 'private'),
+        collection_precision=collection_precision,
+        token=session.get('token'),
+    ))
+    return jsonify({"status": "queued", "job": job_id})
+
+
+def ingest(job: Job) -> Dict:
+    """
+    Runs an upload job: unpacks archives, extracts the contents and adds them to a collection or the chat context
+    """
+    params = job.params
+    return_args = {}
+    n_tokens = 0
+
+    # first check if any of the files is an archive
+    # if this is the case, append it to files
+    files_to_process = prepare_files(job.directory, params['files'])
+    completed = set(job.progress.get('completed', []))  # indexed before a restart
+    files_to_process = [f for f in files_to_process if os.path.relpath(f[0], job.directory) not in completed]
+    failed = []  # files which could not be extracted, reported without stopping the others
+    extracted = 0
+    job.report(files_total=len(files_to_process) + len(completed), files_done=len(completed), files_failed=0,
+               chunks_embedded=job.progress.get('chunks_embedded', 0))
+    # The contents are extracted concurrently, each one is used as soon as it is available
+    if params['use_collection']:
+        collection_name = params['collection_name']
+        collection_visibility = params['collection_visibility']
+
+        index, index_path, hashed_index_name = create_or_open_collection(collection_name, job.username, collection_visibility == "public",
+                                                                         params.get('collection_precision'))
+
+        def checkpoint(files: List[str]):
+            # a restart skips the files which are on disk already
+            completed.update(files)
+            job.report(persist=True, completed=sorted(completed), chunks_embedded=chunks_before + writer.chunks,
+                       chunks_per_second=writer.chunks_per_second)
+
+        writer = CollectionWriter(index, index_path, on_checkpoint=checkpoint)
+        chunks_before = job.progress['chunks_embedded']  # by the run interrupted by a restart
+        try:
+            for destination, content, error in extract_files(files_to_process):
+                job.check_cancelled()
+                relative_path = os.path.relpath(destination, job.directory)
+                if error:
+                    failed.append(dict(file=relative_path, error=error))
+                    job.report(files_done=job.progress['files_done'] + 1, files_failed=len(failed))
+                    continue
+                extracted += 1
+                filename = os.path.basename(destination)
+                text_splitter = get_text_splitter(destination)
+                docs = text_splitter.create_documents([content], metadatas=[dict(file=filename)])
+                # Ok now we have all docs and metadata
+                writer.add(relative_path, docs)
+                job.report(files_done=job.progress['files_done'] + 1, chunks_embedded=chunks_before + writer.chunks,
+                           chunks_per_second=writer.chunks_per_second)
+            writer.save()
+        except JobCancelled:
+            writer.save()  # keep what has been embedded
+            raise
+        finally:
+            VECTOR_STORE_CACHE.invalidate(index_path)  # chats pick up the new documents on their next message
+            RETRIEVAL_CACHE.invalidate(index_path)
+            ANN_BUILDER.schedule(index_path)  # built or updated in the background if the collection is large enough
+        return_args['chunks'] = writer.chunks
+        return_args['chunks-per-second'] = writer.chunks_per_second
+        return_args['collection-name'] = collection_name
+        return_args['collection-hashed-name'] = hashed_index_name
+        return_args['collection-visibility'] = collection_visibility
 
     else:
         context = ""
-        for _, content in contents:
-            tokens = get_tokens(content)
-            n_tokens += len(tokens.get('tokens', []))
+        for destination, content, error in extract_files(files_to_process):
+            job.check_cancelled()
+            if error:
+                failed.append(dict(file=os.path.relpath(destination, job.directory), error=error))
+                job.report(files_done=job.progress['files_done'] + 1, files_failed=len(failed))
+                continue
+            extracted += 1
+            n_tokens += TOKEN_COUNTER.count(content, budget=MAX_NUM_TOKENS_FOR_INLINE_CONTEXT - n_tokens)
             context += f"{content}\n\n"
-        if n_tokens > MAX_NUM_TOKENS_FOR_INLINE_CONTEXT:
-            return jsonify(
-                {"error": f"Too many tokens: {n_tokens}. Maximum tokens allows: {MAX_NUM_TOKENS_FOR_INLINE_CONTEXT}"})
-        token = session.get('token')
-        ADDITIONAL_CONTEXT[token] = dict(contents=context, filename=files[0].filename)
+            job.report(files_done=job.progress['files_done'] + 1)
+            if n_tokens > MAX_NUM_TOKENS_FOR_INLINE_CONTEXT:  # no need to extract the rest
+                return {"error": f"Too many tokens: {n_tokens}. Maximum tokens allows: {MAX_NUM_TOKENS_FOR_INLINE_CONTEXT}"}
+        if failed and not extracted:
+            return {"error": failed[0]['error'], "failed": failed}
+        ADDITIONAL_CONTEXT[params['token']] = dict(contents=context, filename=params['files'][0])
 
-    ret_val = {**{"status": "OK"}, **return_args}
-    return jsonify(ret_val)  # redirect done in JS
+    return {**{"status": "OK"}, **return_args, "failed": failed}
 
 
-def prepare_files(base_folder: str, files: List) -> Tuple[Dict[str, str], List[str]]:
+def prepare_files(base_folder: str, filenames: List[str]) -> List[Tuple[str, FileType]]:
     files_to_process = []
-    error = None
-    for file in files:
-        if not file.filename:
-            error = {"error": "You must provide a file."}
-        destination = os.path.join(base_folder, file.filename)
-        os.makedirs(os.path.dirname(destination), exist_ok=True)
-        file.save(destination)
-        if is_archive(destination):
+    for filename in filenames:
+        destination = os.path.join(base_folder, filename)
+        file_type = classify_file(destination)  # the only time the file type is looked at
+        if file_type.kind == 'archive':
             # add all
-            filename = destination
+            archive = destination
             destination, _ = os.path.splitext(destination)
-            if extract_archive(filename, destination):
+            if extract_archive(archive, destination):
                 files = find_files(destination, '')
-                files_to_process.extend(files)
+                files_to_process.extend((member, classify_file(member)) for member in files)
         else:
             # add this file
-            files_to_process.append(destination)
-    return error, files_to_process
+            files_to_process.append((destination, file_type))
+    return files_to_process
+
+
+def get_upload_job(job_id: str) -> Dict:
+    job = INGESTION.get(job_id)
+    if job is None or job.pop('username') != session.get('username'):
+        abort(404)
+    return job
+
+
+@app.route('/upload/<job_id>')
+@login_required
+def upload_status(job_id):
+    return jsonify(get_upload_job(job_id))
 
 
-def get_tokens(text):
-    data = requests.request(method="POST",
-                            url=urllib.parse.urljoin(LLAMA_API, "/tokenize"),
-                            data=json.dumps(dict(content=text)),
-                            )
-    data_json = data.json()
-    return data_json
+@app.route('/upload/<job_id>/events')
+@login_required
+def upload_events(job_id):
+    """
+    Progress of an upload as server-sent events, one per change, the last one when the job is finished
+    """
+    get_upload_job(job_id)
+
+    def generate():
+        for job in INGESTION.events(job_id):
+            if job is None:
+                yield ': keepalive\n\n'
+                continue
+            job.pop('username')
+            yield frame(json.dumps(job))
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/upload/<job_id>/cancel', methods=["POST"])
+@login_required
+def cancel_upload(job_id):
+    get_upload_job(job_id)
+    if not INGESTION.cancel(job_id):
+        abort(409)  # already finished
+    return jsonify({})
 
 
 # @login_required
@@ -373,17 +529,7 @@ def get_tokens(text):
 #                             data=json.dumps(dict(prompt=prompt)),
 #                             stream=True)
 
-def parse_tool_call(chunks, tools):
-    name = None
-    args_buf = ""
-    for chunk in chunks:
-        delta = chunk["choices"][0]["delta"]
-        for call in delta.get("tool_calls", []):
-            fn = call.get("function")
-            if fn:
-                if name is None:
-                    name = fn["name"]
-                args_buf += fn.get("arguments", "")
+def parse_tool_call(name, args_buf, tools):
     if name is None:
         raise ValueError("no function call in chunks")
     args = json.loads(args_buf)
@@ -412,25 +558,70 @@ def compile_history(hist):
     for h in hist["items"]:
         suffix = h.get("suffix", "")
         if suffix:
-            lines.append(f'{h["role"]}:\n{h["content"]}\n{suffix}\n')
+            lines.append(f'{h["role"]}:\n{HISTORY.content(h)}\n{suffix}\n')
         else:
-            lines.append(f'{h["role"]}:\n{h["content"]}\n')
+            lines.append(f'{h["role"]}:\n{HISTORY.content(h)}\n')
     return '\n'.join(lines)
 
 
 @login_required
 @app.route('/', methods=["POST"])
 def get_input():
+    chat = prepare_chat()
+    token = chat['token']
+    cancelled = threading.Event()
+    STREAM_CANCELLATIONS[token] = (chat['hashed_username'], cancelled)
+
+    def generate():
+        data, lease = BACKEND_POOL.post_completion(token, chat['post_data'], stream=True)
+        # yield '{"id": "chatcmpl-8580f0ec-509d-4944-881c-c902939fb611", "system_fingerprint": "0.22.2-0.24.1-macOS-15.3.2-arm64-arm-64bit-applegpu_g15s", "object": "chat.completion.chunk", "model": "default_model", "created": 1743511005, "choices": [{"index": 0, "logprobs": {"token_logprobs": [], "top_logprobs": [], "tokens": null}, "finish_reason": null, "delta": {"role": "assistant", "content": "<think>"}}]}'
+        relay = StreamRelay()
+        try:
+            for line in data.iter_lines():
+                if cancelled.is_set():
+                    break
+                response = relay.feed(line)
+                if response is not None:
+                    yield response
+        finally:  # also runs when the client went away, closing the upstream stops the generation
+            data.close()
+            lease.release()
+            if STREAM_CANCELLATIONS.get(token, (None, None))[1] is cancelled:
+                STREAM_CANCELLATIONS.pop(token, None)
+        response = make_tool_call_response(relay, chat['post_data']['tools'])
+        if response is not None:
+            yield response
+        save_chat(chat, relay.output())
+
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    direct_passthrough=False)
+
+
+@app.route('/cancel/<path:token>', methods=["POST"])
+@login_required
+def cancel(token):
+    """
+    Stops a running generation, the upstream request is closed and the llama-server slot freed
+    """
+    hashed_username, cancelled = STREAM_CANCELLATIONS.get(token, (None, None))
+    if cancelled is None or hashed_username != hash_username(session.get('username')):
+        abort(404)
+    cancelled.set()
+    return jsonify({})
+
+
+def prepare_chat() -> Dict:
+    """
+    Loads the history, adds the context and builds the request for llama-server, needs the flask request and session
+    """
     token = session.get('token', None)
     username = session.get('username')
 
     collection = get_collection_from_query(request)
     vector_store = None
     if collection:
-        vector_store = LOADED_EMBEDDINGS.get(token)
-        if vector_store is None:
-            vector_store = load_collection(collection, username)
-            LOADED_EMBEDDINGS[token] = vector_store  # keep it for next time
+        vector_store = load_collection(collection, username)  # shared and cached across chats
 
     data = request.get_json()
     text = data.pop('input')
@@ -441,13 +632,8 @@ def get_input():
     system_prompt = data.pop('system_prompt')
 
     hashed_username = hash_username(username)
-    history_key = f'{hashed_username}-{token}-history'
-    cache_key = f'{CACHE_DIR}/{history_key}.json'
-    # load cache file
-    try:
-        with open(cache_key, 'r') as f:
-            hist = json.load(f)
-    except (FileNotFoundError, JSONDecodeError):
+    hist = HISTORY.load(hashed_username, token)
+    if hist is None:
         hist = {
             "items": [],
             "title": text,
@@ -457,11 +643,13 @@ def get_input():
             "chat_id": token,
             "project_id": ""
         }
+    stored = len(hist['items'])  # only the items after these are appended to the log
 
     # Add context if asked
     context, metadata = make_context(text, token, vector_store)
     if context:
-        item = dict(role=USER, content=f'<context>\n{context}\n</context>', metadata=metadata)  # todo add filename to context
+        # the context is stored once, the conversation only references it
+        item = dict(role=USER, content_ref=HISTORY.blobs.put(f'<context>\n{context}\n</context>'), metadata=metadata)  # todo add filename to context
         if collection:
             item['collection'] = collection
         hist['items'].append(item)
@@ -470,10 +658,10 @@ def get_input():
 
     if prune_history_index >= 0:  # remove items if required
         hist["items"] = hist["items"][:prune_history_index]
+        stored = min(stored, prune_history_index)
 
     messages = make_prompt(hist, system_prompt, text)
     post_data = get_llama_default_parameters(data)
-    url = urllib.parse.urljoin(LLAMA_API, "/v1/chat/completions")
     post_data['messages'] = messages
     # post_data['stream'] = False
     post_data.pop('grammar')
@@ -497,58 +685,29 @@ def get_input():
             }
         }
     ]
+    return dict(token=token, hashed_username=hashed_username, text=text, hist=hist, stored=stored, post_data=post_data)
 
-    def generate():
-        data = requests.request(method="POST",
-                                url=url,
-                                data=json.dumps(post_data),
-                                stream=True)
-        # yield '{"id": "chatcmpl-8580f0ec-509d-4944-881c-c902939fb611", "system_fingerprint": "0.22.2-0.24.1-macOS-15.3.2-arm64-arm-64bit-applegpu_g15s", "object": "chat.completion.chunk", "model": "default_model", "created": 1743511005, "choices": [{"index": 0, "logprobs": {"token_logprobs": [], "top_logprobs": [], "tokens": null}, "finish_reason": null, "delta": {"role": "assistant", "content": "<think>"}}]}'
-        responses = []
-        tool_calls = []
-        for i, line in enumerate(data.iter_lines()):
-            if line:
-                decoded_line = line.decode('utf-8')
-                response = decoded_line[6:]
-                if response != '[DONE]':
-                    try:
-                        parsed_response = json.loads(response)
-                    except Exception as e:
-                        print(f"Problem parsing response: {e} \n{response} \n")
-                        continue
-                    if 'tool_calls' in parsed_response['choices'][0]['delta']:
-                        tool_calls.append(parsed_response)
-                        # continue
-                    # content = parsed_response['choices'][0]['delta'].get('content', '')
-                    # if content:
-                    if parsed_response not in tool_calls:
-                        responses.append(parsed_response)
-                        yield response
-        # try:
-        if tool_calls:
-            tools = post_data["tools"]  # your function-definition list
-            fname, fargs = parse_tool_call(tool_calls, tools)
-            print(fname, fargs)
-            yield json.dumps({'choices': [{'finish_reason': 'tool_call', 'index': 0, 'delta': {'content': f'Tool call: {fname} with arguments {fargs}'}}], 'created': 1751355925, 'id': 'chatcmpl-Djly3Nuwj7luZN6vOa373DPDuCKiVnjs', 'model': 'qwen3-32b-dense', 'system_fingerprint': 'b5764-f667f1e6', 'object': 'chat.completion.chunk'})
-
-        output = "".join([a['choices'][0]['delta'].get('content', '') or "" for a in responses if 'embedding' not in a]).strip()
-        # except (json.decoder.JSONDecodeError, KeyError, TypeError):
-        #     a = 2
-        hist['items'].append(dict(role=USER, content=text))
-        # Remove thought process from history
-        think_pattern = r'<think>([\s\S]*?)<\/think>([\s\S]*)'
-        matches = re.match(think_pattern, output, re.MULTILINE)
-        if matches is not None:
-            thinking_block, message_block = matches[1], matches[2].strip()
-        else:
-            message_block = output
-        hist['items'].append(dict(role=ASSISTANT, content=message_block))
-        with open(cache_key, 'w') as f:
-            json.dump(hist, f)
 
-    return Response(stream_with_context(generate()),
-                    mimetype='text/event-stream',
-                    direct_passthrough=False)
+def make_tool_call_response(relay: StreamRelay, tools: List[Dict]) -> Optional[str]:
+    if not relay.has_tool_call:
+        return None
+    fname, fargs = parse_tool_call(*relay.tool_call(), tools)
+    print(fname, fargs)
+    return frame(json.dumps({'choices': [{'finish_reason': 'tool_call', 'index': 0, 'delta': {'content': f'Tool call: {fname} with arguments {fargs}'}}], 'created': 1751355925, 'id': 'chatcmpl-Djly3Nuwj7luZN6vOa373DPDuCKiVnjs', 'model': 'qwen3-32b-dense', 'system_fingerprint': 'b5764-f667f1e6', 'object': 'chat.completion.chunk'}))
+
+
+def save_chat(chat: Dict, output: str):
+    hist = chat['hist']
+    hist['items'].append(dict(role=USER, content=chat['text']))
+    # Remove thought process from history
+    think_pattern = r'<think>([\s\S]*?)<\/think>([\s\S]*)'
+    matches = re.match(think_pattern, output, re.MULTILINE)
+    if matches is not None:
+        thinking_block, message_block = matches[1], matches[2].strip()
+    else:
+        message_block = output
+    hist['items'].append(dict(role=ASSISTANT, content=message_block))
+    HISTORY.append(chat['hashed_username'], chat['token'], hist, chat['stored'])
 
 
 def make_context(query, token, vector_store) -> Tuple[Optional[str], List[Dict]]:
@@ -583,7 +742,12 @@ def get_context_from_upload(token: str) -> Tuple[Optional[str], List[Dict]]:
 
 def make_prompt(hist, system_prompt, text):
     messages = [{'role': 'system', 'content': system_prompt}]
-    messages += hist['items']
+    for item in hist['items']:
+        if 'content_ref' in item:  # resolved only for the request, the history keeps the reference
+            content = HISTORY.content(item)
+            item = {key: value for key, value in item.items() if key != 'content_ref'}
+            item['content'] = content
+        messages.append(item)
     # DEEP_THINKING_INSTRUCTION = "Enable deep thinking subroutine."
     # messages += [{"role": "system", "content": DEEP_THINKING_INSTRUCTION}]
     messages += [{'role': USER, 'content': text}]
@@ -594,5 +758,8 @@ def hash_username(username):
     return hashlib.sha256(username.encode()).hexdigest()[0:8]  # 8 character is OK
 
 
+if __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN'):  # not in the watching process of the debug reloader
+    INGESTION.start()
+
 if __name__ == '__main__':
     app.run(port=5000, debug=True)
@@ -0,0 +1,177 @@
+"""
+ASGI entry point. Chat completions are streamed with asyncio, so a stream does not hold a worker thread
+and is closed upstream as soon as the browser goes away. Everything else is served by the flask app.
+
+    cd server && uvicorn asgi:application --port 5000
+"""
+import asyncio
+import json
+from typing import Dict, Tuple, List, Callable, Any, Optional
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import session
+
+from app import app, prepare_chat, make_tool_call_response, save_chat, hash_username
+from llama_cpp.aio import AsyncBackendClients
+from llama_cpp.backends import BACKEND_POOL
+from llama_cpp.stream import StreamRelay
+
+ASYNC_CLIENTS = AsyncBackendClients(BACKEND_POOL)
+ACTIVE_STREAMS: Dict[str, Tuple[Dict, asyncio.Task]] = {}  # chat token -> (chat, relay task)
+
+flask_application = WsgiToAsgi(app)
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == '/':
+        await chat_stream(scope, receive, send)
+    elif scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'].startswith('/cancel/'):
+        await cancel(scope, receive, send)
+    else:
+        await flask_application(scope, receive, send)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await ASYNC_CLIENTS.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def read_body(receive) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return body
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+
+def replay_body(body: bytes, receive):
+    sent = False
+
+    async def replay():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        return await receive()
+    return replay
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+def in_flask_context(scope, body: bytes, fn: Callable[[], Any]) -> Tuple[Any, List[Tuple[bytes, bytes]]]:
+    """
+    Runs fn with the flask request and session of an ASGI request, returns its result and the session cookies to set
+    """
+    headers = [(key.decode('latin-1'), value.decode('latin-1')) for key, value in scope['headers']]
+    with app.test_request_context(scope['path'], method=scope['method'], headers=headers, data=body,
+                                  query_string=scope.get('query_string', b'')):
+        result = fn()
+        response = app.response_class()
+        app.session_interface.save_session(app, session, response)
+    cookies = [(b'set-cookie', cookie.encode('latin-1')) for cookie in response.headers.getlist('Set-Cookie')]
+    return result, cookies
+
+
+def prepare_chat_if_logged_in() -> Optional[Dict]:
+    if 'username' not in session:
+        return None
+    return prepare_chat()
+
+
+def current_hashed_username() -> Optional[str]:
+    username = session.get('username')
+    return hash_username(username) if username else None
+
+
+async def send_json(send, data: Any, status: int = 200):
+    body = json.dumps(data).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def chat_stream(scope, receive, send):
+    body = await read_body(receive)
+    chat, cookies = await asyncio.to_thread(in_flask_context, scope, body, prepare_chat_if_logged_in)
+    if chat is None:
+        await send_json(send, {"error": "Not logged in"}, status=401)
+        return
+
+    token = chat['token']
+    chat['cancelled'] = False
+    relay = asyncio.create_task(relay_stream(chat, send, cookies))
+    ACTIVE_STREAMS[token] = (chat, relay)
+    disconnected = asyncio.create_task(wait_for_disconnect(receive))
+    try:
+        done, _ = await asyncio.wait({relay, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+        if relay not in done:  # the browser went away, closing upstream frees the llama-server slot
+            relay.cancel()
+        await asyncio.gather(relay, return_exceptions=True)
+    finally:
+        disconnected.cancel()
+        relay.cancel()
+        if ACTIVE_STREAMS.get(token, (None, None))[1] is relay:
+            ACTIVE_STREAMS.pop(token, None)
+
+
+async def relay_stream(chat: Dict, send, cookies: List[Tuple[bytes, bytes]]):
+    started = False
+
+    async def start():
+        nonlocal started
+        if not started:
+            started = True
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')] + cookies})
+
+    relay = StreamRelay()
+    try:
+        async with ASYNC_CLIENTS.stream_completion(chat['token'], chat['post_data']) as (upstream, _lease):
+            await start()
+            async for line in upstream.aiter_lines():
+                response = relay.feed(line)
+                if response is not None:
+                    await send({'type': 'http.response.body', 'body': response.encode(), 'more_body': True})  # waits while the browser is slower than llama-server
+    except asyncio.CancelledError:
+        if not chat['cancelled']:
+            raise
+        # stopped by the user, finish the response and keep what has been generated so far
+
+    await start()
+    response = make_tool_call_response(relay, chat['post_data']['tools'])
+    if response is not None:
+        await send({'type': 'http.response.body', 'body': response.encode(), 'more_body': True})
+    await asyncio.to_thread(save_chat, chat, relay.output())
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+async def cancel(scope, receive, send):
+    body = await read_body(receive)
+    token = scope['path'][len('/cancel/'):]
+    chat, relay = ACTIVE_STREAMS.get(token, (None, None))
+    if chat is None:  # maybe a stream served by the flask app
+        await flask_application(scope, replay_body(body, receive), send)
+        return
+    hashed_username, _ = await asyncio.to_thread(in_flask_context, scope, body, current_hashed_username)
+    if hashed_username != chat['hashed_username']:
+        await send_json(send, {"error": "Not found"}, status=404)
+        return
+    chat['cancelled'] = True
+    relay.cancel()
+    await send_json(send, {})
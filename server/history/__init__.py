@@ -0,0 +1,314 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from json import JSONDecodeError
+from typing import Dict, List, Optional, Any, Tuple
+
+from history.blobs import BlobStore
+
+HISTORY_INDEX_FILE = 'history-index.sqlite3'
+HISTORY_BLOBS_DIR = 'blobs'
+HISTORY_SUFFIX = '-history.json'  # whole conversation, written before the log existed
+HISTORY_LOG_SUFFIX = '-history.log'
+HISTORY_COMPACT_SLACK = int(os.environ.get('HISTORY_COMPACT_SLACK', 32))  # superseded log records before compacting
+HISTORY_TOMBSTONE_DAYS = 30  # deletions are reported to incremental listings for that long
+HISTORY_BLOB_GRACE_SECONDS = 3600  # blobs stored more recently are not collected, their conversation may be unsaved
+CONTENT_REF = re.compile(rb'"content_ref": "([0-9a-f]{64})"')
+
+
+class HistoryStore:
+    """
+    Conversations are stored one append-only log per chat, <hashed username>-<chat id>-history.log in the cache directory.
+    A log is json lines, a {"meta": ...} record with everything but the items, then one {"i": position, "item": ...}
+    record per message. Replaying a record drops the items from its position on, so regenerating an answer is an append
+    as well. Logs are compacted (rewritten and atomically replaced) once enough records are superseded.
+    Large contents are kept in a BlobStore, items then have a content_ref instead of a content. Blobs of deleted
+    conversations are collected in the background, after deletions and at startup.
+    An SQLite index of (username, chat_id, title, project_id, updated_at) is updated on every write,
+    so listing the conversations of a user never has to open them.
+    Every write and deletion gets a new sequence number, clients ask for the changes since the last one they saw.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, HISTORY_INDEX_FILE)
+        self.blobs = BlobStore(os.path.join(cache_dir, HISTORY_BLOBS_DIR))
+        self._lock = threading.Lock()
+        self._log_records: Dict[Tuple[str, str], Optional[int]] = {}  # records in each log, None = not a log yet
+        self._collecting = False
+        with closing(self._connect()) as db, db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS chats ('
+                       'username TEXT NOT NULL, chat_id TEXT NOT NULL, title TEXT, project_id TEXT, '
+                       'updated_at REAL NOT NULL, deleted INTEGER NOT NULL DEFAULT 0, seq INTEGER NOT NULL DEFAULT 0, '
+                       'PRIMARY KEY (username, chat_id))')
+            columns = {row[1] for row in db.execute('PRAGMA table_info(chats)')}
+            for column in ['deleted', 'seq']:  # indices created before incremental listings
+                if column not in columns:
+                    db.execute(f'ALTER TABLE chats ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0')
+            db.execute('CREATE INDEX IF NOT EXISTS chats_by_update ON chats (username, updated_at DESC)')
+            db.execute('CREATE INDEX IF NOT EXISTS chats_by_seq ON chats (username, seq)')
+            db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            indexed = db.execute("SELECT value FROM meta WHERE key = 'indexed'").fetchone()
+        if not indexed:
+            self.rebuild_index()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.index_path, timeout=30)
+
+    def path(self, username: str, chat_id: str) -> str:
+        return os.path.join(self.cache_dir, f'{username}-{chat_id}{HISTORY_LOG_SUFFIX}')
+
+    def legacy_path(self, username: str, chat_id: str) -> str:
+        return os.path.join(self.cache_dir, f'{username}-{chat_id}{HISTORY_SUFFIX}')
+
+    def content(self, item: Dict[str, Any]) -> str:
+        """
+        Content of an item, read from the blob store if it is stored there
+        """
+        if 'content_ref' in item:
+            return self.blobs.get(item['content_ref'])
+        return item['content']
+
+    def load(self, username: str, chat_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Replays the log of a conversation, None if there is none
+        """
+        path = self.path(username, chat_id)
+        try:
+            hist, records, valid_size = self._replay(path)
+        except FileNotFoundError:
+            try:
+                with open(self.legacy_path(username, chat_id), 'r') as f:
+                    hist = json.load(f)
+            except (FileNotFoundError, JSONDecodeError):
+                return None
+            self._log_records[(username, chat_id)] = None  # converted to a log on the next write
+            return hist
+        if hist is None:
+            return None
+        if valid_size < os.path.getsize(path):  # a write was interrupted, cut the partial record
+            logging.warning(f'Truncating incomplete record of {path}')
+            with self._lock:
+                os.truncate(path, valid_size)
+        self._log_records[(username, chat_id)] = records
+        return hist
+
+    @staticmethod
+    def _replay(path: str) -> Tuple[Optional[Dict[str, Any]], int, int]:
+        """
+        (conversation, number of records, size of the complete records) of a log
+        """
+        hist = None
+        records = 0
+        valid_size = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except JSONDecodeError:
+                    break
+                if 'meta' in record:
+                    items = hist['items'] if hist else []
+                    hist = dict(record['meta'], items=items)
+                elif hist is not None:
+                    del hist['items'][record['i']:]
+                    hist['items'].append(record['item'])
+                records += 1
+                valid_size += len(line)
+        return hist, records, valid_size
+
+    def append(self, username: str, chat_id: str, hist: Dict[str, Any], start: int):
+        """
+        Persists the items of hist from position start on, the items before it must be the ones already stored.
+        One write and one fsync per call, whatever the size of the conversation.
+        """
+        key = (username, chat_id)
+        path = self.path(username, chat_id)
+        records = self._log_records.get(key)
+        if records is None and (key in self._log_records or not os.path.exists(path)):
+            self.save(username, chat_id, hist)  # new conversation or one to convert
+            return
+        lines = [json.dumps(dict(i=i, item=item)) + '\n' for i, item in enumerate(hist['items'][start:], start)]
+        with self._lock:
+            with open(path, 'a') as f:
+                f.write(''.join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+        records = (records or 0) + len(lines)
+        self._log_records[key] = records
+        if records - len(hist['items']) - 1 > HISTORY_COMPACT_SLACK:
+            self.save(username, chat_id, hist)
+        else:
+            self._index(username, chat_id, hist, time.time())
+
+    def save(self, username: str, chat_id: str, hist: Dict[str, Any]):
+        """
+        Writes the complete log of a conversation, replaces the previous one atomically
+        """
+        path = self.path(username, chat_id)
+        meta = {key: value for key, value in hist.items() if key != 'items'}
+        lines = [json.dumps(dict(meta=meta)) + '\n']
+        lines += [json.dumps(dict(i=i, item=item)) + '\n' for i, item in enumerate(hist['items'])]
+        with self._lock:
+            with open(path + '.tmp', 'w') as f:
+                f.write(''.join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+            try:
+                os.remove(self.legacy_path(username, chat_id))
+            except FileNotFoundError:
+                pass
+        self._log_records[(username, chat_id)] = len(lines)
+        self._index(username, chat_id, hist, time.time())
+
+    def delete(self, username: str, chat_id: str) -> bool:
+        now = time.time()
+        with closing(self._connect()) as db, db:
+            # Keep a tombstone, so incremental listings learn about the deletion
+            db.execute('UPDATE chats SET deleted = 1, title = NULL, updated_at = ?, '
+                       'seq = (SELECT COALESCE(MAX(seq), 0) + 1 FROM chats) WHERE username = ? AND chat_id = ?',
+                       (now, username, chat_id))
+            db.execute('DELETE FROM chats WHERE deleted = 1 AND updated_at < ?', (now - HISTORY_TOMBSTONE_DAYS * 86400,))
+        self._log_records.pop((username, chat_id), None)
+        removed = False
+        for path in [self.path(username, chat_id), self.legacy_path(username, chat_id)]:
+            try:
+                os.remove(path)
+                removed = True
+            except FileNotFoundError:
+                pass
+        if removed:
+            self.collect_blobs_in_background()  # the contents of the chat go with it
+        return removed
+
+    def collect_blobs(self, grace: float = HISTORY_BLOB_GRACE_SECONDS) -> int:
+        """
+        Removes the blobs no conversation refers to any more (mark and sweep), returns how many
+        """
+        candidates = self.blobs.stored(older_than=time.time() - grace)
+        if not candidates:
+            return 0
+        used = set()
+        for entry in os.listdir(self.cache_dir):
+            if not (entry.endswith(HISTORY_LOG_SUFFIX) or entry.endswith(HISTORY_SUFFIX)):
+                continue
+            try:
+                with open(os.path.join(self.cache_dir, entry), 'rb') as f:
+                    for line in f:
+                        used.update(ref.decode() for ref in CONTENT_REF.findall(line))
+            except OSError:
+                continue  # deleted meanwhile
+        unused = candidates - used
+        for ref in unused:
+            self.blobs.remove(ref)
+        if unused:
+            logging.info(f'Removed {len(unused)} blobs of deleted conversations')
+        return len(unused)
+
+    def collect_blobs_in_background(self):
+        with self._lock:
+            if self._collecting:
+                return
+            self._collecting = True
+        threading.Thread(target=self._collect_blobs, daemon=True, name='history-blobs').start()
+
+    def _collect_blobs(self):
+        # noinspection PyBroadException
+        try:
+            self.collect_blobs()
+        except Exception:
+            logging.exception('Collecting the blobs of the history failed')
+        finally:
+            with self._lock:
+                self._collecting = False
+
+    def list(self, username: str, project_id: Optional[str] = None, limit: Optional[int] = None,
+             cursor: Optional[Tuple[float, str]] = None, since: Optional[int] = None,
+             updated_after: Optional[float] = None, updated_until: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Conversations of a user, most recently updated first.
+        cursor is the (updated_at, chat_id) of the last conversation of the previous page,
+        with since only the conversations changed or deleted after that sequence number are returned.
+        """
+        query = 'SELECT chat_id, title, project_id, updated_at, deleted, seq FROM chats WHERE username = ?'
+        args: List[Any] = [username]
+        if since is None:
+            query += ' AND deleted = 0'
+        else:
+            query += ' AND seq > ?'
+            args.append(since)
+        if project_id:
+            query += ' AND project_id = ?'
+            args.append(project_id)
+        if updated_after is not None:
+            query += ' AND updated_at > ?'
+            args.append(updated_after)
+        if updated_until is not None:
+            query += ' AND updated_at <= ?'
+            args.append(updated_until)
+        if cursor is not None:
+            query += ' AND (updated_at < ? OR (updated_at = ? AND chat_id < ?))'
+            args += [cursor[0], cursor[0], cursor[1]]
+        query += ' ORDER BY updated_at DESC, chat_id DESC'
+        if limit:
+            query += ' LIMIT ?'
+            args.append(limit)
+        with closing(self._connect()) as db:
+            rows = db.execute(query, args).fetchall()
+        return [dict(chat_id=chat_id, title=title, project_id=project_id, updated_at=updated_at, deleted=bool(deleted))
+                for chat_id, title, project_id, updated_at, deleted, _seq in rows]
+
+    def version(self, username: str) -> Tuple[int, int]:
+        """
+        (last sequence number, number of entries) of a user, changes with every write or deletion
+        """
+        with closing(self._connect()) as db:
+            seq, count = db.execute('SELECT COALESCE(MAX(seq), 0), COUNT(*) FROM chats WHERE username = ?',
+                                    (username,)).fetchone()
+        return seq, count
+
+    def _index(self, username: str, chat_id: str, hist: Dict[str, Any], updated_at: float):
+        with closing(self._connect()) as db, db:
+            db.execute('INSERT OR REPLACE INTO chats (username, chat_id, title, project_id, updated_at, deleted, seq) '
+                       'VALUES (?, ?, ?, ?, ?, 0, (SELECT COALESCE(MAX(seq), 0) + 1 FROM chats))',
+                       (username, chat_id, hist.get('title', ''), hist.get('project_id', ''), updated_at))
+
+    def rebuild_index(self):
+        """
+        Indexes the conversations already in the cache directory, runs once when the index is created
+        """
+        with self._lock:
+            count = 0
+            for entry in os.listdir(self.cache_dir):
+                for suffix in [HISTORY_LOG_SUFFIX, HISTORY_SUFFIX]:
+                    if entry.endswith(suffix):
+                        break
+                else:
+                    continue
+                username, _, chat_id = entry[:-len(suffix)].partition('-')
+                if suffix == HISTORY_SUFFIX and os.path.exists(self.path(username, chat_id)):
+                    continue  # the log is newer
+                path = os.path.join(self.cache_dir, entry)
+                try:
+                    if suffix == HISTORY_LOG_SUFFIX:
+                        with open(path, 'r') as f:
+                            hist = json.loads(f.readline())['meta']  # the title is all the index needs
+                    else:
+                        with open(path, 'r') as f:
+                            hist = json.load(f)
+                except (OSError, JSONDecodeError, KeyError):
+                    continue  # We ignore
+                self._index(username, chat_id, hist, os.path.getmtime(path))
+                count += 1
+            with closing(self._connect()) as db, db:
+                db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('indexed', ?)", (str(time.time()),))
+            logging.info(f'Indexed {count} conversations')
@@ -0,0 +1,70 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import zlib
+from typing import Set
+
+BLOB_NAME = re.compile(r'[0-9a-f]{64}')
+
+
+class BlobStore:
+    """
+    Content-addressed storage for large texts (uploaded files, retrieved chunks) referenced from conversations.
+    A text is stored once, zlib compressed, under the sha256 of its content, whatever the number of
+    conversations that use it. Blobs no conversation uses any more are removed by HistoryStore.collect_blobs.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, ref: str) -> str:
+        return os.path.join(self.directory, ref[:2], ref)
+
+    def put(self, text: str) -> str:
+        """
+        Stores text if it is not stored yet, returns its reference
+        """
+        data = text.encode('utf-8')
+        ref = hashlib.sha256(data).hexdigest()
+        path = self.path(ref)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'  # one per writing thread
+            with open(tmp, 'wb') as f:
+                f.write(zlib.compress(data))
+            os.replace(tmp, path)  # concurrent writers write the same content
+        else:
+            os.utime(path)  # used again, not collected before the conversation using it is written
+        return ref
+
+    def stored(self, older_than: float) -> Set[str]:
+        """
+        References of the blobs last stored before the time older_than
+        """
+        refs = set()
+        for directory, _, files in os.walk(self.directory):
+            for name in files:
+                if BLOB_NAME.fullmatch(name):
+                    try:
+                        if os.path.getmtime(os.path.join(directory, name)) < older_than:
+                            refs.add(name)
+                    except FileNotFoundError:
+                        pass
+        return refs
+
+    def remove(self, ref: str):
+        try:
+            os.remove(self.path(ref))
+        except FileNotFoundError:
+            pass
+
+    def get(self, ref: str) -> str:
+        try:
+            with open(self.path(ref), 'rb') as f:
+                return zlib.decompress(f.read()).decode('utf-8')
+        except (OSError, zlib.error):
+            logging.warning(f'Missing or damaged blob {ref}')
+            return ''
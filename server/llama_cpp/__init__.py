@@ -1,8 +1,6 @@
 from typing import Dict, Any
 
-import requests
-
-LLAMA_API = 'http://127.0.0.1:8080'
+from llama_cpp.backends import BACKEND_POOL
 
 
 SYSTEM = 'system'
@@ -44,12 +42,6 @@ Always adhere strictly to this format. Otherwise you will destroy my code.
 
 
 def get_llama_default_parameters(params_from_post: Dict[str, Any]) -> Dict[str, Any]:
-
-    try:
-        default_generation_settings = get_default_props_from_llamacpp()
-        # default_generation_settings = {}
-    except (requests.exceptions.ConnectionError, KeyError):
-        default_generation_settings = {}
     default_params = {
         'cache_prompt': True,
         'frequency_penalty': 0,  # Repeat alpha frequency penalty (default: 0.0, 0.0 = disabled)
@@ -70,8 +62,6 @@ def get_llama_default_parameters(params_from_post: Dict[str, Any]) -> Dict[str,
     }
     # Copy the defdault params
     params = dict(default_params)
-    # merge with response from server, keeping the own default_params
-    default_generation_settings.update(default_params)
 
     # 'slot_id': 0 or 1
     params.update(params_from_post)
@@ -92,9 +82,8 @@ def get_llama_default_parameters(params_from_post: Dict[str, Any]) -> Dict[str,
     return params
 
 
-def get_default_props_from_llamacpp():
-    props = requests.get(f'{LLAMA_API}/props').json()
-    return props
+def get_context_per_slot() -> int:
+    return BACKEND_POOL.context_per_slot()
 
 
 def get_llama_parameters():
@@ -0,0 +1,66 @@
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional, AsyncIterator, Tuple
+
+import httpx
+
+from llama_cpp.backends import BackendPool, Backend, Lease, completion_payload
+from llama_cpp.client import LLAMA_CONNECT_TIMEOUT, LLAMA_READ_TIMEOUT
+
+
+class AsyncBackendClients:
+    """
+    Non-blocking httpx clients for the backends of a BackendPool, used by the ASGI streaming path
+    """
+
+    def __init__(self, pool: BackendPool):
+        self.pool = pool
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    def client(self, backend: Backend) -> httpx.AsyncClient:
+        client = self._clients.get(backend.base_url)
+        if client is None:
+            client = httpx.AsyncClient(
+                base_url=backend.base_url,
+                timeout=httpx.Timeout(LLAMA_READ_TIMEOUT, connect=LLAMA_CONNECT_TIMEOUT),
+                # llama-server queues requests beyond its slots, keep alive one connection per slot
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=backend.client.pool_size),
+            )
+            self._clients[backend.base_url] = client
+        return client
+
+    @asynccontextmanager
+    async def stream_completion(self, token: Optional[str], post_data: Dict[str, Any]) -> AsyncIterator[Tuple[httpx.Response, Lease]]:
+        """
+        Streams a chat completion, failing over like BackendPool.post_completion.
+        Leaving the context closes the upstream request, llama-server then stops generating.
+        """
+        exclude = set()
+        while True:
+            lease = self.pool.acquire(token, exclude)
+            try:
+                client = self.client(lease.backend)
+                request = client.build_request('POST', '/v1/chat/completions', json=completion_payload(post_data, lease))
+                start = time.perf_counter()
+                try:
+                    response = await client.send(request, stream=True)
+                except (httpx.ConnectError, httpx.ConnectTimeout):
+                    lease.backend.client.record('/v1/chat/completions', time.perf_counter() - start, error=True)
+                    if not self.pool.fail_over(lease, exclude):
+                        raise
+                    continue
+            except BaseException:  # cancelled while llama-server processes the prompt, timeouts, protocol errors
+                lease.release()
+                raise
+            lease.backend.client.record('/v1/chat/completions', time.perf_counter() - start)
+            break
+        try:
+            yield response, lease
+        finally:
+            await response.aclose()
+            lease.release()
+
+    async def aclose(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
@@ -0,0 +1,241 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Set, Tuple, Callable
+
+import requests
+
+from llama_cpp.client import LlamaClient, LLAMA_API
+from llama_cpp.props import PropsCache
+
+LLAMA_APIS = [url.strip() for url in LLAMA_API.split(',') if url.strip()]  # several llama-servers, comma separated
+LLAMA_POLL_INTERVAL = float(os.environ.get('LLAMA_POLL_INTERVAL', 2))  # seconds
+LLAMA_MAX_STICKY_CHATS = 10000
+
+
+class Backend:
+    """
+    One llama-server with its client, cached props and the last known state of its slots
+    """
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.client = LlamaClient(base_url)
+        self.props = PropsCache(self.fetch_props)
+        self.healthy = True
+        self.slots: Optional[List[Dict[str, Any]]] = None  # None if the server does not expose /slots
+        self.slots_polled_at = 0.0
+        self.reserved: Set[int] = set()  # slots we have sent a completion to and which are not finished yet
+        self.released_at: Dict[int, float] = {}  # so a slot we just released is not considered busy until the next poll
+        self.in_flight = 0
+
+    def fetch_props(self) -> Dict[str, Any]:
+        props = self.client.get('/props').json()
+        self.client.resize_pool(props.get('total_slots', 1))
+        return props
+
+    def poll(self):
+        # noinspection PyBroadException
+        try:
+            if not self.healthy or self.props.stale():  # a server coming back may have been restarted differently
+                self.props.refresh()
+            polled_at = time.monotonic()
+            response = self.client.get('/slots')
+            self.slots = response.json() if response.ok else None
+            self.slots_polled_at = polled_at
+            self.healthy = True
+        except Exception as e:
+            if self.healthy:
+                logging.warning(f'llama-server {self.base_url} is down: {e}')
+            self.healthy = False
+
+    def total_slots(self) -> int:
+        if self.slots is not None:
+            return len(self.slots)
+        props = self.props.cached() or {}
+        return props.get('total_slots', 1)
+
+    def free_slots(self) -> List[int]:
+        if self.slots is None:  # no /slots, count our own requests only
+            return [i for i in range(self.total_slots()) if i not in self.reserved]
+        free = []
+        for slot in self.slots:
+            id_slot = slot.get('id')
+            processing = slot.get('is_processing', slot.get('state', 0) != 0)
+            if processing and self.released_at.get(id_slot, 0.0) > self.slots_polled_at:
+                processing = False  # we finished with it after the last poll
+            if not processing and id_slot not in self.reserved:
+                free.append(id_slot)
+        return free
+
+    def context_per_slot(self) -> int:
+        props = self.props.get()
+        n_ctx = props.get('default_generation_settings', {}).get('n_ctx', 0)
+        return n_ctx // max(props.get('total_slots', 1), 1)
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(healthy=self.healthy,
+                    total_slots=self.total_slots(),
+                    free_slots=len(self.free_slots()),
+                    in_flight=self.in_flight,
+                    **self.client.stats())
+
+
+class Lease:
+    """
+    A chat completion routed to a backend and slot, release it when the completion is done
+    """
+
+    def __init__(self, pool: 'BackendPool', backend: Backend, id_slot: int):
+        self.pool = pool
+        self.backend = backend
+        self.id_slot = id_slot
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.pool.release(self)
+
+
+def completion_payload(post_data: Dict[str, Any], lease: Lease) -> Dict[str, Any]:
+    payload = dict(post_data)
+    if lease.id_slot >= 0:
+        payload['id_slot'] = lease.id_slot
+    return payload
+
+
+class BackendPool:
+    """
+    Routes chat completions to llama-servers with a free slot.
+    A chat stays on the same backend and slot as long as possible, so cache_prompt can reuse its KV cache.
+    """
+
+    def __init__(self, base_urls: List[str], poll_interval: float = LLAMA_POLL_INTERVAL):
+        self.backends = [Backend(base_url) for base_url in base_urls]
+        self.poll_interval = poll_interval
+        self._sticky: 'OrderedDict[str, Tuple[str, int]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._poller: Optional[threading.Thread] = None
+        self.failovers = 0
+
+    def start(self):
+        if self._poller is None:
+            self._poller = threading.Thread(target=self._poll_forever, daemon=True)
+            self._poller.start()
+
+    def _poll_forever(self):
+        while True:
+            self.poll()
+            time.sleep(self.poll_interval)
+
+    def poll(self):
+        for backend in self.backends:
+            backend.poll()
+
+    def acquire(self, token: Optional[str], exclude: Optional[Set[str]] = None) -> Lease:
+        exclude = exclude or set()
+        with self._lock:
+            candidates = [b for b in self.backends if b.healthy and b.base_url not in exclude]
+            if not candidates:  # maybe they came back in between two polls
+                candidates = [b for b in self.backends if b.base_url not in exclude]
+            if not candidates:
+                raise requests.exceptions.ConnectionError('No llama-server available')
+
+            backend, id_slot = None, -1
+            sticky = self._sticky.get(token) if token else None
+            if sticky:
+                for b in candidates:
+                    if b.base_url == sticky[0]:
+                        free = b.free_slots()
+                        if sticky[1] in free:
+                            backend, id_slot = b, sticky[1]
+                        elif free:
+                            backend, id_slot = b, free[0]
+                        break
+            if backend is None:
+                backend = max(candidates, key=lambda b: (len(b.free_slots()), -b.in_flight))
+                free = backend.free_slots()
+                id_slot = free[0] if free else -1  # all busy, let llama-server queue it
+
+            if id_slot >= 0:
+                backend.reserved.add(id_slot)
+            backend.in_flight += 1
+            if token:
+                self._sticky[token] = (backend.base_url, id_slot)
+                self._sticky.move_to_end(token)
+                while len(self._sticky) > LLAMA_MAX_STICKY_CHATS:
+                    self._sticky.popitem(last=False)
+            return Lease(self, backend, id_slot)
+
+    def release(self, lease: Lease):
+        with self._lock:
+            lease.backend.reserved.discard(lease.id_slot)
+            lease.backend.released_at[lease.id_slot] = time.monotonic()
+            lease.backend.in_flight -= 1
+
+    def post_completion(self, token: Optional[str], post_data: Dict[str, Any], **kwargs) -> Tuple[requests.Response, Lease]:
+        """
+        Sends a chat completion to a backend, failing over to the next one if it cannot be reached
+        """
+        exclude = set()
+        while True:
+            lease = self.acquire(token, exclude)
+            try:
+                response = lease.backend.client.post('/v1/chat/completions', json=completion_payload(post_data, lease), **kwargs)
+            except requests.exceptions.ConnectionError:
+                if not self.fail_over(lease, exclude):
+                    raise
+                continue
+            except BaseException:  # read timeouts, broken responses, ... the caller never gets the lease
+                lease.release()
+                raise
+            return response, lease
+
+    def fail_over(self, lease: Lease, exclude: Set[str]) -> bool:
+        """
+        Marks the backend of lease as down, returns False if there is no other backend left to try
+        """
+        lease.release()
+        lease.backend.healthy = False
+        exclude.add(lease.backend.base_url)
+        self.failovers += 1
+        logging.warning(f'llama-server {lease.backend.base_url} is down, failing over')
+        return len(exclude) < len(self.backends)
+
+    def client(self) -> LlamaClient:
+        """
+        Client for calls which any backend can answer, e.g. /tokenize
+        """
+        healthy = [b for b in self.backends if b.healthy] or self.backends
+        return max(healthy, key=lambda b: (len(b.free_slots()), -b.in_flight)).client
+
+    def context_per_slot(self) -> int:
+        """
+        Smallest context of a slot over all reachable backends, raises if none can be reached
+        """
+        sizes = []
+        error = None
+        for backend in self.backends:
+            try:
+                sizes.append(backend.context_per_slot())
+            except requests.exceptions.RequestException as e:
+                error = e
+        if not sizes:
+            raise error or requests.exceptions.ConnectionError('No llama-server available')
+        return min([size for size in sizes if size > 0], default=0)
+
+    def add_props_listener(self, listener: Callable[[Dict[str, Any]], None]):
+        for backend in self.backends:
+            backend.props.add_listener(listener)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(backends=[b.stats() for b in self.backends],
+                        sticky_chats=len(self._sticky),
+                        failovers=self.failovers)
+
+
+BACKEND_POOL = BackendPool(LLAMA_APIS)
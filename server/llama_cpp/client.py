@@ -0,0 +1,101 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict, Any, Optional, Tuple
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+
+LLAMA_API = os.environ.get('LLAMA_API', 'http://127.0.0.1:8080')  # comma separated for several llama-servers
+LLAMA_CONNECT_TIMEOUT = float(os.environ.get('LLAMA_CONNECT_TIMEOUT', 3.05))  # seconds
+LLAMA_READ_TIMEOUT = float(os.environ.get('LLAMA_READ_TIMEOUT', 600))  # seconds between two bytes, prompt processing can be slow
+LLAMA_RETRIES = int(os.environ.get('LLAMA_RETRIES', 2))  # only for idempotent calls and only when connecting fails
+LLAMA_RETRY_BACKOFF = 0.25  # seconds, doubled on each retry
+
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+
+class LlamaClient:
+    """
+    Keep-alive connection pool to one llama-server, with timeouts, retries and per endpoint latencies.
+    """
+
+    def __init__(self, base_url: str = LLAMA_API, pool_size: int = 1,
+                 timeout: Tuple[float, float] = (LLAMA_CONNECT_TIMEOUT, LLAMA_READ_TIMEOUT),
+                 retries: int = LLAMA_RETRIES):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.session = requests.Session()
+        self.pool_size = 0
+        self.resize_pool(pool_size)
+        self._latencies: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def resize_pool(self, slots: int):
+        # One connection per slot for streaming completions plus a few for /props, /tokenize, ...
+        pool_size = max(slots, 1) + 2
+        if pool_size == self.pool_size:
+            return
+        previous = {self.session.adapters.get(prefix) for prefix in ('http://', 'https://')} - {None}
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool_size = pool_size
+        for old in previous:  # its idle connections, the ones in use are closed when they are released
+            old.close()
+
+    def request(self, method: str, path: str, idempotent: Optional[bool] = None, **kwargs) -> requests.Response:
+        """
+        For streamed responses the recorded latency is the time until the headers arrived.
+        """
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        kwargs.setdefault('timeout', self.timeout)
+        url = urljoin(self.base_url, path)
+        attempts = 1 + self.retries if idempotent else 1
+        for attempt in range(attempts):
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectionError as e:  # includes ConnectTimeout, but not ReadTimeout
+                self.record(path, time.perf_counter() - start, error=True)
+                if attempt + 1 >= attempts:
+                    raise
+                logging.warning(f'Could not connect to {url}, retrying: {e}')
+                time.sleep(LLAMA_RETRY_BACKOFF * 2 ** attempt)
+                continue
+            self.record(path, time.perf_counter() - start)
+            return response
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request('POST', path, **kwargs)
+
+    def record(self, path: str, elapsed: float, error: bool = False):
+        with self._lock:
+            latency = self._latencies.setdefault(path, dict(count=0, errors=0, total=0.0, max=0.0, last=0.0))
+            if error:
+                latency['errors'] += 1
+                return
+            latency['count'] += 1
+            latency['total'] += elapsed
+            latency['max'] = max(latency['max'], elapsed)
+            latency['last'] = elapsed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            endpoints = {
+                path: dict(count=latency['count'],
+                           errors=latency['errors'],
+                           mean_ms=round(1000 * latency['total'] / latency['count'], 2) if latency['count'] else None,
+                           max_ms=round(1000 * latency['max'], 2),
+                           last_ms=round(1000 * latency['last'], 2))
+                for path, latency in self._latencies.items()
+            }
+        return dict(base_url=self.base_url, pool_size=self.pool_size, endpoints=endpoints)
+
@@ -0,0 +1,91 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+PROPS_TTL = float(os.environ.get('LLAMA_PROPS_TTL', 30))  # seconds
+
+
+def props_identity(props: Dict[str, Any]) -> Tuple:
+    """
+    Changes when llama-server has been restarted with another build, model or context layout
+    """
+    default_generation_settings = props.get('default_generation_settings', {})
+    return (props.get('build_info'),
+            props.get('model_path'),
+            props.get('total_slots'),
+            default_generation_settings.get('n_ctx'))
+
+
+class PropsCache:
+    """
+    Cached llama-server /props. Stale props are served while a background thread refreshes them,
+    listeners are called when the refreshed props belong to a restarted server.
+    """
+
+    def __init__(self, fetch: Callable[[], Dict[str, Any]], ttl: float = PROPS_TTL):
+        self.fetch = fetch
+        self.ttl = ttl
+        self._props: Optional[Dict[str, Any]] = None
+        self._identity: Optional[Tuple] = None
+        self._fetched_at = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._listeners: List[Callable[[Dict[str, Any]], None]] = []
+
+    def get(self) -> Dict[str, Any]:
+        with self._lock:
+            props = self._props
+            stale = time.monotonic() - self._fetched_at > self.ttl
+            refresh_in_background = props is not None and stale and not self._refreshing
+            if refresh_in_background:
+                self._refreshing = True
+        if props is None:
+            return self.refresh()  # nothing to serve yet, this one has to wait
+        if refresh_in_background:
+            threading.Thread(target=self._background_refresh, daemon=True).start()
+        return props
+
+    def stale(self) -> bool:
+        with self._lock:
+            return self._props is None or time.monotonic() - self._fetched_at > self.ttl
+
+    def cached(self) -> Optional[Dict[str, Any]]:
+        """
+        Never blocks on llama-server, None if the props have not been fetched yet
+        """
+        with self._lock:
+            return self._props
+
+    def refresh(self) -> Dict[str, Any]:
+        props = self.fetch()
+        identity = props_identity(props)
+        with self._lock:
+            changed = self._identity is not None and identity != self._identity
+            self._props = props
+            self._identity = identity
+            self._fetched_at = time.monotonic()
+        if changed:
+            logging.info('llama-server has been restarted, props changed')
+            for listener in list(self._listeners):
+                listener(props)
+        return props
+
+    def _background_refresh(self):
+        # noinspection PyBroadException
+        try:
+            self.refresh()
+        except Exception as e:
+            logging.warning(f'Could not refresh llama-server props, keeping the cached ones: {e}')
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def invalidate(self):
+        with self._lock:
+            self._props = None
+            self._fetched_at = 0.0
+
+    def add_listener(self, listener: Callable[[Dict[str, Any]], None]):
+        self._listeners.append(listener)
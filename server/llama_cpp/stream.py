@@ -0,0 +1,66 @@
+import json
+from typing import List, Optional, Union, Tuple
+
+
+def frame(response: str) -> str:
+    """
+    Server-sent event framing, the browser splits the stream on the blank line
+    """
+    return f'data: {response}\n\n'
+
+
+class StreamRelay:
+    """
+    One pass over the event stream of /v1/chat/completions.
+    Each line is forwarded as received, the assistant text and tool call fragments are accumulated on the way,
+    so the work per chunk does not depend on how much has been generated already.
+    """
+
+    def __init__(self):
+        self._content: List[str] = []
+        self._tool_name: Optional[str] = None
+        self._tool_arguments: List[str] = []
+        self.has_tool_call = False
+        self.chunks = 0
+
+    def feed(self, line: Union[bytes, str]) -> Optional[str]:
+        """
+        Returns the frame which has to be sent to the browser for this line, if any
+        """
+        if not line:
+            return None
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        response = line[6:]  # strip 'data: '
+        if response == '[DONE]':
+            return None
+        self.chunks += 1
+        if '"content"' not in response and '"tool_calls"' not in response:
+            return frame(response)  # nothing to accumulate (role, timings, ...), no need to parse it
+        try:
+            parsed_response = json.loads(response)
+            delta = parsed_response['choices'][0]['delta']
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            print(f"Problem parsing response: {e} \n{response} \n")
+            return None
+        if 'tool_calls' in delta:
+            for call in delta['tool_calls'] or []:
+                function = call.get('function')
+                if function:
+                    if self._tool_name is None:
+                        self._tool_name = function.get('name')
+                    self._tool_arguments.append(function.get('arguments') or '')
+            self.has_tool_call = True
+            return None  # tool calls are not shown while they are streamed
+        if 'embedding' not in parsed_response:
+            self._content.append(delta.get('content') or '')
+        return frame(response)
+
+    def output(self) -> str:
+        return ''.join(self._content).strip()
+
+    def tool_call(self) -> Tuple[Optional[str], str]:
+        """
+        Name and the raw (json) arguments of the streamed tool call
+        """
+        return self._tool_name, ''.join(self._tool_arguments)
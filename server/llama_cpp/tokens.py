@@ -0,0 +1,151 @@
+"""
+Token counting for inline context. The tokenizer of the model of llama-server, configured by LLAMA_TOKENIZER, is loaded
+once, llama-server /tokenize is called when there is none. Texts are counted in segments, so counting stops as soon as a budget
+is exceeded, and counts are cached by content hash.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, Callable, List, Dict, Any, Tuple
+
+from llama_cpp.backends import BackendPool, BACKEND_POOL
+
+LLAMA_TOKENIZER = os.environ.get('LLAMA_TOKENIZER', '')  # huggingface tokenizer (name or path), '' = llama-server
+TOKENS_MAX_CHARS_PER_TOKEN = float(os.environ.get('LLAMA_MAX_CHARS_PER_TOKEN', 12))  # no tokenizer does better
+TOKENS_SEGMENT_CHARS = 64 * 1024  # counted at once, the budget is checked between two segments
+TOKENS_CACHE_ENTRIES = 4096
+
+
+def split_segments(text: str, size: int = TOKENS_SEGMENT_CHARS) -> List[str]:
+    """
+    Pieces of about size characters, split after a newline (or a space) so few tokens are cut in two
+    """
+    segments = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            cut = text.rfind('\n', start + size // 2, end)
+            if cut < 0:
+                cut = text.rfind(' ', start + size // 2, end)
+            if cut >= 0:
+                end = cut + 1
+        segments.append(text[start:end])
+        start = end
+    return segments
+
+
+def load_tokenizer(name: str) -> Optional[Callable[[str], int]]:
+    """
+    Token counter of a huggingface tokenizer or of the tokenizer of a local gguf file (needs gguf),
+    None if it cannot be loaded here
+    """
+    # noinspection PyBroadException
+    try:
+        # noinspection PyPackageRequirements
+        from transformers import AutoTokenizer
+        if name.endswith('.gguf'):
+            tokenizer = AutoTokenizer.from_pretrained(os.path.dirname(name), gguf_file=os.path.basename(name))
+        else:
+            tokenizer = AutoTokenizer.from_pretrained(name)
+    except Exception as e:
+        logging.warning(f'No local tokenizer for {name}, counting with llama-server: {e}')
+        return None
+    logging.info(f'Counting tokens with the tokenizer of {name}')
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+
+class TokenCounter:
+    """
+    Counts tokens the way the model of llama-server does.
+    With a budget the count stops once it is exceeded, the result is then only known to be larger than the budget.
+    """
+
+    def __init__(self, pool: BackendPool, tokenizer: str = LLAMA_TOKENIZER,
+                 max_chars_per_token: float = TOKENS_MAX_CHARS_PER_TOKEN, cache_entries: int = TOKENS_CACHE_ENTRIES):
+        self.pool = pool
+        self.tokenizer = tokenizer
+        self.max_chars_per_token = max_chars_per_token
+        self.cache_entries = cache_entries
+        self._local: Dict[str, Optional[Callable[[str], int]]] = {}  # tokenizer name -> counter, None = use llama-server
+        self._counts: 'OrderedDict[str, Tuple[int, bool]]' = OrderedDict()  # hash -> (count, exact)
+        self._lock = threading.Lock()
+        self._loading = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.prechecked = 0
+        self.stopped_early = 0
+        self.remote = 0
+
+    def _model_path(self) -> str:
+        # noinspection PyBroadException
+        try:
+            return self.pool.backends[0].props.get().get('model_path') or ''
+        except Exception:
+            return ''
+
+    def _count_function(self) -> Tuple[str, Callable[[str], int]]:
+        if self.tokenizer:
+            if self.tokenizer not in self._local:
+                with self._loading:  # loaded once, by one thread
+                    if self.tokenizer not in self._local:
+                        self._local[self.tokenizer] = load_tokenizer(self.tokenizer)
+            local = self._local[self.tokenizer]
+            if local is not None:
+                return self.tokenizer, local
+        return f'llama-server:{self._model_path()}', self._count_remote  # counts change with the model
+
+    def _count_remote(self, text: str) -> int:
+        with self._lock:
+            self.remote += 1
+        data = self.pool.client().post('/tokenize', data=json.dumps(dict(content=text)), idempotent=True)
+        return len(data.json().get('tokens', []))
+
+    def count(self, text: str, budget: Optional[int] = None) -> int:
+        """
+        Number of tokens of text, or a number larger than budget as soon as it is clear that text does not fit
+        """
+        if budget is not None and len(text) / self.max_chars_per_token > budget:
+            with self._lock:
+                self.prechecked += 1
+            return int(len(text) / self.max_chars_per_token) + 1  # more than budget, no need to tokenize
+
+        name, count_tokens = self._count_function()
+        key = hashlib.sha256(f'{name}\0{text}'.encode('utf-8', 'surrogatepass')).hexdigest()
+        with self._lock:
+            cached = self._counts.get(key)
+            if cached is not None and (cached[1] or (budget is not None and cached[0] > budget)):
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+
+        n_tokens = 0
+        exact = True
+        segments = split_segments(text)
+        for i, segment in enumerate(segments):
+            n_tokens += count_tokens(segment)
+            if budget is not None and n_tokens > budget and i < len(segments) - 1:
+                exact = False  # the rest does not matter
+                with self._lock:
+                    self.stopped_early += 1
+                break
+
+        with self._lock:
+            self._counts[key] = (n_tokens, exact)
+            self._counts.move_to_end(key)
+            while len(self._counts) > self.cache_entries:
+                self._counts.popitem(last=False)
+        return n_tokens
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(tokenizers=[name for name, local in self._local.items() if local],
+                        cached=len(self._counts), hits=self.hits, misses=self.misses, prechecked=self.prechecked,
+                        stopped_early=self.stopped_early, remote_calls=self.remote)
+
+
+TOKEN_COUNTER = TokenCounter(BACKEND_POOL)
@@ -1,23 +1,27 @@
+import codecs
 import hashlib
 import json
 import logging
 import os
+import time
 from pathlib import Path
 from typing import List, Tuple, Optional, Dict
 from urllib.parse import urlparse, parse_qs
+import numpy as np
 from flask import Request
 from langchain.text_splitter import TextSplitter, Language, RecursiveCharacterTextSplitter, MarkdownTextSplitter
 from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores.faiss import FAISS
 from langchain_core.documents import Document
-from utils.filesystem import list_directories, is_source_code_file, is_pdf, is_json, is_text_file, is_sqlite, \
-    get_mime_type, is_importable
-# noinspection PyPackageRequirements
-from marker.converters.pdf import PdfConverter
-# noinspection PyPackageRequirements
-from marker.models import create_model_dict
-# noinspection PyPackageRequirements
-from marker.output import text_from_rendered
+from langchain_core.embeddings import Embeddings
+from rag.embeddings import EMBEDDINGS_REGISTRY, EMBEDDINGS_WARMUP
+from rag.cache import VECTOR_STORE_CACHE, QUERY_EMBEDDING_CACHE, RETRIEVAL_CACHE, collection_version
+from rag.store import NativeCollection, open_collection, is_legacy_collection, convert_legacy_collection
+from utils.filesystem import list_directories, is_source_code_file, classify_file, FileType
+from rag.pdf import PDF_WORKER_POOL
+from rag.ann import ANN_BUILDER
+from rag.quantize import DEFAULT_PRECISION
+from rag.lexical import HYBRID_SEARCH, HYBRID_SEARCH_ENABLED
+from rag.rerank import RERANKER, RERANK_DEFAULT, rerank_config
 
 RAG_CHUNK_SIZE = 2048
 RAG_DATA_DIR = os.path.abspath(os.path.dirname(__file__) + '/../../data')
@@ -26,12 +30,20 @@ RAG_NUM_DOCS = 5
 RAG_DEFAULT_MODEL = 'BAAI/bge-m3'
 
 
-def get_embeddings(model_name: str) -> HuggingFaceEmbeddings:
-    return HuggingFaceEmbeddings(model_name=model_name,
-                                 encode_kwargs={
-                                     'normalize_embeddings': True  # set True to compute cosine similarity
-                                 },
-                                 model_kwargs={'device': 'cpu'})
+def get_embeddings(model_name: Optional[str]) -> HuggingFaceEmbeddings:
+    # Shared between all collections using the same model, loading bge-m3 takes seconds and ~2GB
+    return EMBEDDINGS_REGISTRY.get(model_name or RAG_DEFAULT_MODEL)
+
+
+def warm_up_embeddings():
+    EMBEDDINGS_REGISTRY.warm_up(EMBEDDINGS_WARMUP)
+
+
+def warm_up_reranker():
+    # flashrank takes seconds to load, much more than the latency budget of the first query
+    configs = list(Path(RAG_DATA_DIR).glob('common/*/config.json')) + list(Path(RAG_DATA_DIR).glob('user/*/*/config.json'))
+    if RERANK_DEFAULT or any(rerank_config(config.parent)['enabled'] for config in configs):
+        RERANKER.warm_up()
 
 
 def rag_context(docs: List[Document]) -> Tuple[str, List[Dict]]:
@@ -73,7 +85,8 @@ def get_available_collections(username: str = None) -> Dict[str, List[Dict[str,
     return collections
 
 
-def create_or_open_collection(index_name: str, username: Optional[str], public: Optional[bool]) -> Tuple[FAISS, Path, str]:
+def create_or_open_collection(index_name: str, username: Optional[str], public: Optional[bool],
+                              precision: Optional[str] = None) -> Tuple[NativeCollection, Path, str]:
 
     # Check if index exists already
     collections = get_available_collections(username)
@@ -83,35 +96,25 @@ def create_or_open_collection(index_name: str, username: Optional[str], public:
 
     if public:
         data_dir = Path(RAG_DATA_DIR) / Path('common')
-        for item in collections['user']:
-            if hashed_index_name == item.get('hashed_name'):
-                embeddings = get_embeddings(item.get('model'))
-                return FAISS.load_local(data_dir / hashed_index_name, embeddings), data_dir / hashed_index_name, hashed_index_name
-        # otherwise we will create a new DB
     else:
         data_dir = Path(RAG_DATA_DIR) / Path('user') / Path(username)
-        for item in collections['user']:
-            if hashed_index_name == item.get('hashed_name'):
-                embeddings = get_embeddings(item.get('model'))
-                return FAISS.load_local(data_dir / hashed_index_name, embeddings), data_dir / hashed_index_name, hashed_index_name
-
-        # otherwise we will create a new DB
-
     path = data_dir / hashed_index_name
-    doc = Document(page_content="")  # We need to create a doc to initialize the docstore, then we gonna delete it again
-    index = FAISS.from_documents([doc], get_embeddings(RAG_DEFAULT_MODEL))
-    # Todo: This is langchain stuff, too lazy to do it differently
-    # noinspection PyProtectedMember,PyUnresolvedReferences
-    index.delete([list(index.docstore._dict.keys())[0]])  # Empty again, this is
-    index.save_local(path)
+    for item in collections['user']:
+        if hashed_index_name == item.get('hashed_name'):
+            embeddings = get_embeddings(item.get('model'))
+            return open_collection(path, embeddings), path, hashed_index_name
+
+    # otherwise we will create a new DB, precision is how its vectors are stored (see rag.quantize)
+    precision = precision or DEFAULT_PRECISION
+    index = NativeCollection.create(path, get_embeddings(RAG_DEFAULT_MODEL), precision)
 
     with open(path / 'config.json', 'w') as f:
-        json.dump(dict(model=RAG_DEFAULT_MODEL, name=index_name, hashed_name=hashed_index_name), f)
+        json.dump(dict(model=RAG_DEFAULT_MODEL, name=index_name, hashed_name=hashed_index_name, precision=precision), f)
 
     return index, path, hashed_index_name
 
 
-def load_collection(collection: str, username: str) -> Optional[FAISS]:
+def load_collection(collection: str, username: str) -> Optional[NativeCollection]:
     collections = get_available_collections(username)
 
     for key in ['user', 'common']:  # first check for same name user!
@@ -120,19 +123,30 @@ def load_collection(collection: str, username: str) -> Optional[FAISS]:
                 data_dir = RAG_DATA_DIR / Path(key)
                 if key == 'user':
                     data_dir = data_dir / Path(username)
-
-                # noinspection PyBroadException
-                try:
-                    with open(data_dir / Path(collection) / 'config.json', 'r') as f:
-                        data = json.load(f)
-                    embeddings = get_embeddings(data.get('model'))
-                    return FAISS.load_local(data_dir / Path(collection), embeddings)
-                except Exception as _e:
-                    logging.warning(f'Found a problem loading the collection: {_e}')
-                    return None
+                path = data_dir / Path(collection)
+                if is_legacy_collection(path):  # saved by an older version, once
+                    load_collection_from_disk(path)
+                return VECTOR_STORE_CACHE.get(path, lambda: load_collection_from_disk(path))
     return None
 
 
+def load_collection_from_disk(path: Path) -> Optional[NativeCollection]:
+    # noinspection PyBroadException
+    try:
+        with open(path / 'config.json', 'r') as f:
+            data = json.load(f)
+        embeddings = get_embeddings(data.get('model'))
+        if is_legacy_collection(path):
+            collection = convert_legacy_collection(path, embeddings)
+        else:
+            collection = NativeCollection(path, embeddings)
+        ANN_BUILDER.schedule(path)  # e.g. a collection which grew beyond the threshold before
+        return collection
+    except Exception as _e:
+        logging.warning(f'Found a problem loading the collection: {_e}')
+        return None
+
+
 def get_collection_from_query(request: Request) -> str:
     collection = None
     if request.referrer:
@@ -166,49 +180,40 @@ def get_text_splitter(destination: str) -> TextSplitter:
     return text_splitter
 
 
-def extract_contents(destination: str) -> Tuple[str, Dict[str, str]]:
+def extract_contents(destination: str, file_type: Optional[FileType] = None) -> Tuple[str, Dict[str, str]]:
     contents = None
     # parsed_pdf_document = None  # special handling for pdfs
     error = None
-    if is_pdf(destination):
-        # TODO: This is a workaround, see https://github.com/VikParuchuri/marker/issues/654
-        import transformers
-        def new_repr(self):
-            return f"{self.__class__.__name__}"
-        transformers.configuration_utils.PretrainedConfig.__repr__ = new_repr
-        # TODO: End
-
-        os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"  # For some reason, transformers decided to use .isin for a simple op, which is not supported on MPS
-        converter = PdfConverter(
-            artifact_dict=create_model_dict(),
-        )
-        rendered = converter(destination)
-        markdown, _, images = text_from_rendered(rendered)
+    if file_type is None:
+        file_type = classify_file(destination)
+    if file_type.kind == 'pdf':
         # parsed_pdf_document = parse_pdf_with_grobid(destination)
         # contents = make_pdf_prompt(markdown)
-        contents = markdown
-
-    elif is_source_code_file(destination):
-        with open(destination, 'r') as f:
-            contents = f.read()
+        contents = PDF_WORKER_POOL.convert(destination)  # the marker models stay loaded in the workers
 
-    elif is_json(destination):
-        with open(destination, 'r') as f:
+    elif file_type.kind in ['source', 'json', 'text']:
+        with open(destination, 'r', encoding=text_encoding(file_type)) as f:
             contents = f.read()
 
-    elif is_text_file(destination):
-        with open(destination, 'r') as f:
-            contents = f.read()
-
-    elif is_sqlite(destination):
+    elif file_type.kind == 'sqlite':
         error = {"error": "sqlite Databases are not supported yet. If you need this, open a Github Issue. Or try the raw SQL text queries."}
 
     else:
-        mime_type = get_mime_type(destination)
-        error = {"error": f"Unknown file type {mime_type}. If you need this, open a Github Issue."}
+        error = {"error": f"Unknown file type {file_type.mime}. If you need this, open a Github Issue."}
     return contents, error
 
 
+def text_encoding(file_type: FileType) -> Optional[str]:
+    """
+    Python codec for the encoding libmagic reported, None (the locale default) if python does not know it
+    """
+    try:
+        name = codecs.lookup(file_type.encoding).name
+    except LookupError:  # binary, unknown-8bit, ...
+        return None
+    return 'utf-8' if name == 'ascii' else name  # only the header was looked at, the rest may not be ascii
+
+
 # def make_pdf_prompt(article: str):
 #     prompt_text = "The following is an article on which I will ask questions. After processing this article, acknowledge the following with OK."
 #     prompt_text += "\n<article>\n"
@@ -217,7 +222,7 @@ def extract_contents(destination: str) -> Tuple[str, Dict[str, str]]:
 #     return prompt_text
 
 
-def get_context_from_rag(query: str, vector_store: Optional[FAISS], num_docs: int = RAG_NUM_DOCS) -> Tuple[Optional[str], List[Dict]]:
+def get_context_from_rag(query: str, vector_store: Optional[NativeCollection], num_docs: int = RAG_NUM_DOCS) -> Tuple[Optional[str], List[Dict]]:
     context = None
     metadata = []
     if vector_store:
@@ -227,22 +232,44 @@ def get_context_from_rag(query: str, vector_store: Optional[FAISS], num_docs: in
     return context, metadata
 
 
-def search_and_rerank_docs(num_docs: int, query: str, vector_store: FAISS):
-    if is_importable('flashrank') and False:
-        rawdocs = vector_store.similarity_search(query, k=num_docs * 2)  #
-        # noinspection PyPackageRequirements
-        from flashrank import RerankRequest, Ranker
-        ranker = Ranker(model_name="ms-marco-MultiBERT-L-12")
-        rerankrequest = RerankRequest(query=query,
-                                      passages=[
-                                          {"meta": d.metadata, "text": d.page_content} for d in rawdocs
-                                      ])
-        results = ranker.rerank(rerankrequest)
-        docs = []
-        for r in results[:num_docs]:
-            docs.append(Document(page_content=r['text'], metadata=r['meta']))
-        return docs
+def search_and_rerank_docs(num_docs: int, query: str, vector_store: NativeCollection) -> List[Document]:
+    """
+    The num_docs chunks of the collection which are most relevant to query, cached until the collection changes
+    """
+    config = rerank_config(vector_store.path)
+    version = collection_version(vector_store.path)
+    key = (os.path.normpath(vector_store.path), version, query, num_docs, HYBRID_SEARCH_ENABLED,
+           tuple(sorted(config.items())))
+    docs = RETRIEVAL_CACHE.lookup(key)
+    if docs is not None:
+        return list(docs)
+
+    start = time.perf_counter()
+    if config['enabled']:
+        candidates = retrieve(query, vector_store, num_docs * max(1, int(config['candidates'])))
+        docs = RERANKER.rerank(query, candidates, num_docs, float(config['budget_ms']))
+        if docs is None:  # not in time, the search order is used this once
+            return candidates[:num_docs]
     else:
-        logging.warning('no flashrank available')
-        docs = vector_store.similarity_search(query, k=num_docs)  #
-        return docs
+        docs = retrieve(query, vector_store, num_docs)
+    if version is not None:
+        RETRIEVAL_CACHE.store(key, list(docs), time.perf_counter() - start)
+    return docs
+
+
+def retrieve(query: str, vector_store: NativeCollection, k: int) -> List[Document]:
+    """
+    The k chunks closest to query, by vector and lexical search when the collection has a lexical index
+    """
+    if HYBRID_SEARCH_ENABLED and vector_store.has_lexical_index:  # the query is embedded during the lexical search
+        return HYBRID_SEARCH.search(vector_store, query, k, embed=lambda: embed_query(query, vector_store.embeddings))
+    return vector_store.similarity_search_by_vector(embed_query(query, vector_store.embeddings), k=k)
+
+
+def embed_query(query: str, embeddings: Embeddings) -> np.ndarray:
+    """
+    Embedding of query, the same questions are asked again (e.g. answers regenerated) and not embedded again
+    """
+    model_name = getattr(embeddings, 'model_name', None) or type(embeddings).__name__
+    return QUERY_EMBEDDING_CACHE.get((model_name, query),
+                                     lambda: np.asarray(embeddings.embed_query(query), dtype=np.float32))
@@ -0,0 +1,335 @@
+"""
+Approximate nearest neighbour indexes for large collections.
+The index of a collection is configured in its config.json, e.g. "index": {"type": "ivf", "quantizer": "sq8"}:
+- type: auto (default), flat, ivf or hnsw. auto stays exhaustive below RAG_ANN_THRESHOLD chunks.
+- quantizer: none (default), sq8 or pq, how the index stores the vectors.
+- nlist (ivf), m (hnsw) and pq_m (pq) override the parameters derived from the size of the collection.
+Indexes are built in the background from the vectors of the native segments (ann.faiss, described in ann.json).
+Their search parameter (nprobe or efSearch) is the cheapest one reaching RAG_ANN_TARGET_RECALL on queries sampled
+from the collection. Chunks added after the index was built are searched exhaustively until it is updated.
+"""
+import fcntl
+import json
+import logging
+import math
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Any, Optional, Tuple, List, Union
+
+import faiss
+import numpy as np
+
+ANN_INDEX_FILE = 'ann.faiss'
+ANN_INFO_FILE = 'ann.json'
+ANN_BUILD_LOCK = '.ann-lock'  # held while a process builds, the others skip the collection
+ANN_THRESHOLD = int(os.environ.get('RAG_ANN_THRESHOLD', 100000))  # chunks, auto collections are promoted beyond
+ANN_TARGET_RECALL = float(os.environ.get('RAG_ANN_TARGET_RECALL', 0.95))  # recall@10 the search parameter must reach
+ANN_HNSW_MAX = 2000000  # auto uses HNSW up to this many chunks, IVF beyond (HNSW graphs get big and slow to build)
+ANN_UPDATE_FRACTION = 0.05  # unindexed chunks, relative to the indexed ones, which trigger an update of the index
+ANN_RETRAIN_FACTOR = 4  # an IVF index is trained again once the collection has grown that much since
+ANN_EVAL_QUERIES = 200
+ANN_EVAL_K = 10
+ANN_TRAIN_POINTS_PER_LIST = 64
+ANN_REFINE = 4  # quantized indexes return k * ANN_REFINE hits, rescored exactly with the vectors of the segments
+
+
+def index_config(path: Union[str, Path]) -> Dict[str, Any]:
+    try:
+        with open(Path(path) / 'config.json') as f:
+            config = json.load(f).get('index') or {}
+    except (OSError, ValueError):
+        config = {}
+    return dict(dict(type='auto', quantizer='none'), **config)
+
+
+def choose_factory(config: Dict[str, Any], n_vectors: int, dim: int) -> Optional[str]:
+    """
+    faiss index_factory string for a collection of n_vectors, None to search exhaustively
+    """
+    index_type = config['type']
+    if index_type == 'auto':
+        if not ANN_THRESHOLD or n_vectors < ANN_THRESHOLD:
+            return None
+        index_type = 'hnsw' if n_vectors <= ANN_HNSW_MAX else 'ivf'
+    if index_type == 'flat':
+        return None
+
+    quantizer = config['quantizer']
+    if quantizer == 'sq8':
+        storage = 'SQ8'
+    elif quantizer == 'pq':
+        pq_m = int(config.get('pq_m') or max(1, dim // 16))  # 64 bytes per vector for bge-m3
+        storage = f'PQ{pq_m}x8'
+    elif quantizer == 'none':
+        storage = 'Flat'
+    else:
+        raise ValueError(f'Unknown quantizer {quantizer}')
+
+    if index_type == 'hnsw':
+        return f"HNSW{int(config.get('m', 32))},{storage}"
+    if index_type == 'ivf':
+        nlist = int(config.get('nlist') or 2 ** round(math.log2(max(1.0, 4 * math.sqrt(n_vectors)))))
+        return f'IVF{nlist},{storage}'
+    raise ValueError(f'Unknown index type {index_type}')
+
+
+def search_parameter(index: faiss.Index) -> Tuple[Optional[str], List[int]]:
+    """
+    Name and candidate values of the parameter trading recall for latency
+    """
+    if isinstance(index, faiss.IndexHNSW):
+        return 'efSearch', [16, 32, 64, 128, 256, 512]
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return 'nprobe', [n for n in [1, 2, 4, 8, 16, 32, 64, 128, 256] if n <= ivf.nlist]
+    return None, []
+
+
+def exact_neighbours(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """
+    Ground truth, by blocks so it also works for collections larger than memory
+    """
+    best_ids = np.full((len(queries), 0), -1, dtype=np.int64)
+    best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+    for first in range(0, len(vectors), 2**16):
+        block = np.asarray(vectors[first:first + 2**16], dtype=np.float32)
+        scores = np.concatenate([best_scores, queries @ block.T], axis=1)
+        ids = np.concatenate([best_ids, np.broadcast_to(np.arange(first, first + len(block)), (len(queries), len(block)))],
+                             axis=1)
+        top = np.argsort(-scores, axis=1)[:, :k]
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_ids = np.take_along_axis(ids, top, axis=1)
+    return best_ids
+
+
+def refine_factor(factory: str) -> int:
+    return 1 if factory.split(',')[-1] == 'Flat' else ANN_REFINE
+
+
+def ann_search(index: faiss.Index, vectors: np.ndarray, query: np.ndarray, k: int,
+               refine: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Positions and exact scores of the k best hits of the index, best first
+    """
+    _, hits = index.search(query[None, :], k * refine)
+    hits = hits[0][hits[0] >= 0]
+    scores = np.asarray(vectors[hits], dtype=np.float32) @ query  # comparable with those of an exhaustive search
+    order = np.argsort(-scores, kind='stable')[:k]
+    return hits[order], scores[order]
+
+
+def evaluate(index: faiss.Index, vectors: np.ndarray, queries: np.ndarray, truth: np.ndarray, refine: int = 1,
+             k: int = ANN_EVAL_K) -> Tuple[float, float]:
+    """
+    recall@k against the exact neighbours and milliseconds per query, one query at a time like a chat would do
+    """
+    found = 0
+    start = time.perf_counter()
+    for query, expected in zip(queries, truth):
+        ids, _ = ann_search(index, vectors, query, k, refine)
+        found += len(np.intersect1d(ids, expected))
+    elapsed = time.perf_counter() - start
+    return found / truth.size, elapsed / len(queries) * 1000
+
+
+def tune(index: faiss.Index, vectors: np.ndarray, queries: np.ndarray, truth: np.ndarray, refine: int = 1,
+         target_recall: float = ANN_TARGET_RECALL) -> Dict[str, Any]:
+    """
+    Sets the cheapest search parameter reaching target_recall (the best one if none does), returns the measurements
+    """
+    name, values = search_parameter(index)
+    measurements = []
+    parameter_space = faiss.ParameterSpace()
+    for value in values or [None]:
+        if name is not None:
+            parameter_space.set_index_parameter(index, name, value)
+        recall, latency = evaluate(index, vectors, queries, truth, refine)
+        measurements.append(dict(value=value, recall=round(recall, 4), latency_ms=round(latency, 3)))
+        if recall >= target_recall:
+            break
+    chosen = next((m for m in measurements if m['recall'] >= target_recall), max(measurements, key=lambda m: m['recall']))
+    if name is not None:
+        parameter_space.set_index_parameter(index, name, chosen['value'])
+    return dict(parameter=name, value=chosen['value'], recall=chosen['recall'], latency_ms=chosen['latency_ms'],
+                measurements=measurements)
+
+
+def sample_queries(vectors: np.ndarray, n: int = ANN_EVAL_QUERIES, seed: int = 0) -> np.ndarray:
+    """
+    Chunks of the collection, slightly perturbed, stand in for real queries
+    """
+    rng = np.random.default_rng(seed)
+    picked = np.asarray(vectors[np.sort(rng.choice(len(vectors), size=min(n, len(vectors)), replace=False))],
+                        dtype=np.float32)
+    queries = picked + rng.normal(scale=0.05 / math.sqrt(picked.shape[1]), size=picked.shape).astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def read_ann_index(path: Union[str, Path]) -> Optional[Tuple[faiss.Index, Dict[str, Any]]]:
+    """
+    The index of a collection and its description, None if it has none (or it does not match its description)
+    """
+    path = Path(path)
+    try:
+        with open(path / ANN_INFO_FILE) as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # noinspection PyBroadException
+    try:
+        try:  # memory mapped where faiss supports it, shared between processes like the segments
+            index = faiss.read_index(str(path / info['file']), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            index = faiss.read_index(str(path / info['file']))
+        if info.get('parameter'):
+            faiss.ParameterSpace().set_index_parameter(index, info['parameter'], info['value'])
+    except Exception as e:
+        logging.warning(f'Ignoring the ANN index of {path}: {e}')
+        return None
+    if index.ntotal != info['total']:
+        return None
+    return index, info
+
+
+class AnnBuilder:
+    """
+    Builds and updates the ANN indexes of collections in a background thread, one collection at a time.
+    Collections are scheduled after they have been written to and when they are loaded.
+    Collections saved before lexical search existed get their lexical index here as well.
+    """
+
+    def __init__(self):
+        self._queue: 'queue.Queue[str]' = queue.Queue()
+        self._scheduled = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.builds = 0
+        self.updates = 0
+        self.failures = 0
+        self.skipped = 0  # being built by another process
+        self.build_seconds = 0.0
+
+    def schedule(self, path: Union[str, Path]):
+        key = os.path.normpath(path)
+        with self._lock:
+            if key in self._scheduled:
+                return
+            self._scheduled.add(key)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, daemon=True, name='ann')
+                self._thread.start()
+        self._queue.put(key)
+
+    def _work(self):
+        while True:
+            path = self._queue.get()
+            with self._lock:
+                self._scheduled.discard(path)
+            # noinspection PyBroadException
+            try:
+                self.build_once(Path(path))
+            except Exception:
+                logging.exception(f'Building the ANN index of {path} failed')
+                with self._lock:
+                    self.failures += 1
+
+    def build_once(self, path: Path):
+        """
+        Builds unless another process (e.g. another worker which loaded the collection too) is building already
+        """
+        with open(path / ANN_BUILD_LOCK, 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logging.info(f'The ANN index of {path} is being built by another process')
+                with self._lock:
+                    self.skipped += 1
+                return
+            try:
+                self.build(path)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def build(self, path: Path):
+        """
+        Builds, updates or drops the index of a collection, whichever its configuration and size call for
+        """
+        from rag.store import NativeCollection, collection_lock
+        collection = NativeCollection(path, None)
+        collection.build_lexical_index()
+        n_vectors = len(collection)
+        if not n_vectors:
+            return
+        vectors = collection.vectors(0, n_vectors)
+        factory = choose_factory(index_config(path), n_vectors, vectors.shape[1])
+        current = read_ann_index(path)
+        if factory is None:
+            if current is not None:
+                with collection_lock(path):
+                    os.remove(path / ANN_INFO_FILE)  # back to exhaustive search
+                    os.remove(path / current[1]['file'])
+            return
+        start = time.perf_counter()
+        if current is not None and current[1]['factory'] == factory:
+            index, info = current
+            if n_vectors - info['total'] <= ANN_UPDATE_FRACTION * info['total']:
+                return  # the few new chunks are searched exhaustively
+            if faiss.try_extract_index_ivf(index) is None or n_vectors < ANN_RETRAIN_FACTOR * info['trained_on']:
+                index = faiss.read_index(str(path / info['file']))  # writable copy
+                add_in_blocks(index, vectors, info['total'])
+                self._save(path, index, dict(info, total=n_vectors), vectors, updated=True, start=start)
+                return
+        index = faiss.index_factory(vectors.shape[1], factory, faiss.METRIC_INNER_PRODUCT)
+        trained_on = 0
+        if not index.is_trained:
+            ivf = faiss.try_extract_index_ivf(index)
+            n_train = min(n_vectors, max(ANN_TRAIN_POINTS_PER_LIST * (ivf.nlist if ivf is not None else 256), 2**16))
+            sample = np.sort(np.random.default_rng(0).choice(n_vectors, size=n_train, replace=False))
+            index.train(np.asarray(vectors[sample], dtype=np.float32))
+            trained_on = n_vectors
+        add_in_blocks(index, vectors, 0)
+        self._save(path, index, dict(factory=factory, trained_on=trained_on), vectors, updated=False, start=start)
+
+    def _save(self, path: Path, index: faiss.Index, info: Dict[str, Any], vectors: np.ndarray, updated: bool,
+              start: float):
+        from rag.store import collection_lock
+        queries = sample_queries(vectors)
+        info['refine'] = refine_factor(info['factory'])
+        info.update(tune(index, vectors, queries, exact_neighbours(vectors, queries, ANN_EVAL_K), info['refine']))
+        info.update(total=int(index.ntotal), built_at=time.time())
+        with collection_lock(path):
+            info['file'] = f"{ANN_INDEX_FILE}.{int(info['built_at'] * 1000)}"  # readers may still map the previous one
+            faiss.write_index(index, str(path / info['file']))
+            tmp = path / f'{ANN_INFO_FILE}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(info, f)
+            os.replace(tmp, path / ANN_INFO_FILE)
+            for name in os.listdir(path):
+                if name.startswith(ANN_INDEX_FILE) and name != info['file']:
+                    os.remove(path / name)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.build_seconds += elapsed
+            if updated:
+                self.updates += 1
+            else:
+                self.builds += 1
+        logging.info(f"ANN index {info['factory']} of {path}: {info['total']} chunks in {elapsed:.1f}s, "
+                     f"{info['parameter']}={info['value']}, recall@{ANN_EVAL_K} {info['recall']}, "
+                     f"{info['latency_ms']} ms/query")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(scheduled=len(self._scheduled), builds=self.builds, updates=self.updates,
+                        failures=self.failures, skipped=self.skipped, build_seconds=round(self.build_seconds, 3))
+
+
+def add_in_blocks(index: faiss.Index, vectors: np.ndarray, start: int):
+    for first in range(start, len(vectors), 2**16):
+        index.add(np.ascontiguousarray(vectors[first:first + 2**16], dtype=np.float32))
+
+
+ANN_BUILDER = AnnBuilder()
@@ -0,0 +1,290 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Tuple, Callable, Optional, Any, Union
+
+VECTOR_STORE_CACHE_BYTES = int(os.environ.get('RAG_VECTOR_STORE_CACHE_BYTES', 4 * 2**30))  # 0 = unlimited
+COLLECTION_FILES = ['segments.json']  # rewritten on every save of a collection
+COLLECTION_OPTIONAL_FILES = ['ann.json']  # rewritten when the ANN index of a collection has been built
+QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get('RAG_QUERY_EMBEDDING_CACHE_SIZE', 1024))  # queries, 0 = off
+RETRIEVAL_CACHE_SIZE = int(os.environ.get('RAG_RETRIEVAL_CACHE_SIZE', 256))  # search results, 0 = off
+EXTRACTION_CACHE_DIR = os.environ.get('RAG_EXTRACTION_CACHE_DIR', 'cache/extractions')
+EXTRACTION_CACHE_BYTES = int(os.environ.get('RAG_EXTRACTION_CACHE_BYTES', 2 * 2**30))  # compressed, 0 = unlimited
+
+Version = Tuple[Tuple[int, int], ...]
+
+
+def collection_version(path: Union[str, Path]) -> Optional[Version]:
+    """
+    On disk version of a collection, changes whenever the collection is saved again
+    """
+    version = []
+    for name in COLLECTION_FILES:
+        try:
+            stat = os.stat(Path(path) / name)
+        except FileNotFoundError:
+            return None
+        version.append((stat.st_mtime_ns, stat.st_size))
+    for name in COLLECTION_OPTIONAL_FILES:
+        try:
+            stat = os.stat(Path(path) / name)
+            version.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            version.append((0, 0))
+    return tuple(version)
+
+
+class VectorStoreCache:
+    """
+    Loaded vector stores shared by all chats and users, keyed by collection directory and on disk version.
+    The least recently used stores are dropped when the byte budget is exceeded.
+    """
+
+    def __init__(self, max_bytes: int = VECTOR_STORE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: 'OrderedDict[str, Tuple[Version, Any, int]]' = OrderedDict()
+        self._loading: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path: Union[str, Path], loader: Callable[[], Any]) -> Optional[Any]:
+        key = os.path.normpath(path)
+        version = collection_version(key)
+        if version is None:
+            self.invalidate(key)
+            return None
+        store = self._lookup(key, version)
+        if store is not None:
+            return store
+
+        with self._lock:
+            load_lock = self._loading.setdefault(key, threading.Lock())
+        try:
+            with load_lock:  # many chats asking for the same collection only load it once
+                store = self._lookup(key, version)
+                if store is not None:
+                    return store
+                store = loader()
+                if store is None:
+                    return None
+                size = store.memory_bytes() if hasattr(store, 'memory_bytes') else sum(version_size for _, version_size in version)
+                with self._lock:
+                    self.misses += 1
+                    self._entries[key] = (version, store, size)
+                    self._entries.move_to_end(key)
+                    self._evict(keep=key)
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+        return store
+
+    def _lookup(self, key: str, version: Version) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != version:  # stale, the collection has been written since
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def _evict(self, keep: str):
+        if not self.max_bytes:
+            return
+        total = sum(size for _, _, size in self._entries.values())
+        for key in list(self._entries.keys()):  # oldest first
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            _, _, size = self._entries.pop(key)
+            total -= size
+            self.evictions += 1
+            logging.info(f'Evicted vector store {key}')
+
+    def invalidate(self, path: Union[str, Path]):
+        with self._lock:
+            self._entries.pop(os.path.normpath(path), None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(
+                collections=len(self._entries),
+                bytes=sum(size for _, _, size in self._entries.values()),
+                max_bytes=self.max_bytes,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+            )
+
+
+class QueryCache:
+    """
+    Least recently used results of queries, e.g. embeddings of the query text or the chunks found for it.
+    Each entry remembers how long it took to compute, which is counted as saved on every hit.
+    Keys starting with a collection directory can be invalidated together.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[Tuple, Tuple[Any, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def lookup(self, key: Tuple) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += entry[1]
+            return entry[0]
+
+    def store(self, key: Tuple, value: Any, seconds: float):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._entries[key] = (value, seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key: Tuple, compute: Callable[[], Any]) -> Any:
+        value = self.lookup(key)
+        if value is None:
+            start = time.perf_counter()
+            value = compute()
+            self.store(key, value, time.perf_counter() - start)
+        return value
+
+    def invalidate(self, path: Union[str, Path]):
+        key = os.path.normpath(path)
+        with self._lock:
+            for stale in [k for k in self._entries if k[0] == key]:
+                del self._entries[stale]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(
+                entries=len(self._entries),
+                max_entries=self.max_entries,
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=round(self.hits / max(1, self.hits + self.misses), 3),
+                saved_ms=round(self.saved_seconds * 1000, 1),
+            )
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ExtractionCache:
+    """
+    Extracted text of uploaded files on disk, keyed by the sha256 of the file and the version of the extractor,
+    so the same document uploaded again (by anyone, into any collection or chat) is not converted again.
+    Entries are zlib compressed, the least recently used ones are removed when max_bytes is exceeded.
+    """
+
+    def __init__(self, directory: str = EXTRACTION_CACHE_DIR, max_bytes: int = EXTRACTION_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        entries = []
+        for name in os.listdir(directory):
+            if name.endswith('.z'):
+                stat = os.stat(os.path.join(directory, name))
+                entries.append((stat.st_mtime, name[:-2], stat.st_size))
+        # the modification time is bumped on every hit, so it orders the entries from a previous run as well
+        self._entries: 'OrderedDict[str, int]' = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self._bytes = sum(self._entries.values())
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(path: str, extractor: str) -> str:
+        return hashlib.sha256(f'{file_digest(path)}-{extractor}'.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.z')
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+        try:
+            with open(self._path(key), 'rb') as f:
+                text = zlib.decompress(f.read()).decode('utf-8')
+            os.utime(self._path(key))
+        except (OSError, zlib.error) as e:
+            logging.warning(f'Dropping extraction cache entry {key}: {e}')
+            self._remove(key)
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return text
+
+    def put(self, key: str, text: str):
+        data = zlib.compress(text.encode('utf-8'))
+        path = self._path(key)
+        tmp = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._bytes += len(data) - self._entries.get(key, 0)
+            self._entries[key] = len(data)
+            self._entries.move_to_end(key)
+            evicted = []
+            while self.max_bytes and self._bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, size = self._entries.popitem(last=False)  # oldest first
+                self._bytes -= size
+                self.evictions += 1
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except FileNotFoundError:
+                pass
+
+    def _remove(self, key: str):
+        with self._lock:
+            self._bytes -= self._entries.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes,
+                        hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+VECTOR_STORE_CACHE = VectorStoreCache()
+EXTRACTION_CACHE = ExtractionCache()
+QUERY_EMBEDDING_CACHE = QueryCache(QUERY_EMBEDDING_CACHE_SIZE)  # keyed by (model, query)
+RETRIEVAL_CACHE = QueryCache(RETRIEVAL_CACHE_SIZE)  # keyed by (collection directory, collection version, query, ...)
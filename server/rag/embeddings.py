@@ -0,0 +1,119 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple, List, Any, Optional
+
+from langchain_community.embeddings import HuggingFaceEmbeddings
+
+EMBEDDINGS_DEVICE = os.environ.get('RAG_EMBEDDINGS_DEVICE', 'cpu')
+EMBEDDINGS_MEMORY_BUDGET = int(os.environ.get('RAG_EMBEDDINGS_MEMORY_BUDGET', 6 * 2**30))  # bytes, 0 = unlimited
+EMBEDDINGS_WARMUP = [m for m in os.environ.get('RAG_EMBEDDINGS_WARMUP', '').split(',') if m]
+
+
+def load_embeddings(model_name: str, device: str) -> HuggingFaceEmbeddings:
+    return HuggingFaceEmbeddings(model_name=model_name,
+                                 encode_kwargs={
+                                     'normalize_embeddings': True  # set True to compute cosine similarity
+                                 },
+                                 model_kwargs={'device': device})
+
+
+def estimate_model_size(embeddings: HuggingFaceEmbeddings) -> int:
+    # noinspection PyBroadException
+    try:
+        return sum(p.numel() * p.element_size() for p in embeddings.client.parameters())
+    except Exception:
+        return 0
+
+
+class EmbeddingsRegistry:
+    """
+    Process wide registry of loaded embedding models, keyed by (model name, device).
+    Models are loaded once and shared, the least recently used ones are dropped when the memory budget is exceeded.
+    """
+
+    def __init__(self, memory_budget: int = EMBEDDINGS_MEMORY_BUDGET):
+        self.memory_budget = memory_budget
+        self._models: 'OrderedDict[Tuple[str, str], Tuple[HuggingFaceEmbeddings, int]]' = OrderedDict()
+        self._loading: Dict[Tuple[str, str], threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+
+    def get(self, model_name: str, device: Optional[str] = None) -> HuggingFaceEmbeddings:
+        key = (model_name, device or EMBEDDINGS_DEVICE)
+        embeddings = self._lookup(key)
+        if embeddings is not None:
+            return embeddings
+
+        with self._lock:
+            load_lock = self._loading.setdefault(key, threading.Lock())
+        try:
+            with load_lock:  # only one thread loads a given model, the others wait for it
+                embeddings = self._lookup(key)
+                if embeddings is not None:
+                    return embeddings
+                start = time.perf_counter()
+                embeddings = load_embeddings(*key)
+                elapsed = time.perf_counter() - start
+                size = estimate_model_size(embeddings)
+                logging.info(f'Loaded embeddings {key[0]} on {key[1]} in {elapsed:.1f}s ({size / 2**20:.0f} MiB)')
+                with self._lock:
+                    self.misses += 1
+                    self.load_seconds += elapsed
+                    self._models[key] = (embeddings, size)
+                    self._evict(keep=key)
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+        return embeddings
+
+    def _lookup(self, key: Tuple[str, str]) -> Optional[HuggingFaceEmbeddings]:
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is None:
+                return None
+            self._models.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _evict(self, keep: Tuple[str, str]):
+        if not self.memory_budget:
+            return
+        total = sum(size for _, size in self._models.values())
+        for key in list(self._models.keys()):  # oldest first
+            if total <= self.memory_budget:
+                break
+            if key == keep:
+                continue
+            _, size = self._models.pop(key)
+            total -= size
+            self.evictions += 1
+            logging.info(f'Evicted embeddings {key[0]} on {key[1]}')
+
+    def warm_up(self, model_names: List[str], device: Optional[str] = None):
+        for model_name in model_names:
+            # noinspection PyBroadException
+            try:
+                self.get(model_name, device)
+            except Exception as e:
+                logging.warning(f'Could not warm up embeddings {model_name}: {e}')
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(
+                models=[dict(model=k[0], device=k[1], bytes=size) for k, (_, size) in self._models.items()],
+                bytes=sum(size for _, size in self._models.values()),
+                memory_budget=self.memory_budget,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                load_seconds=round(self.load_seconds, 3),
+            )
+
+
+EMBEDDINGS_REGISTRY = EmbeddingsRegistry()
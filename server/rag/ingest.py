@@ -0,0 +1,147 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, Future
+from pathlib import Path
+from typing import List, Tuple, Iterator, Optional, NamedTuple, Dict, Union, Callable
+
+import numpy as np
+from langchain_core.documents import Document
+
+from rag import extract_contents
+from rag.cache import EXTRACTION_CACHE, ExtractionCache
+from rag.pdf import marker_version
+from rag.store import NativeCollection
+from utils.filesystem import FileType
+
+EXTRACT_WORKERS = int(os.environ.get('RAG_EXTRACT_WORKERS', min(8, os.cpu_count() or 1)))
+EMBED_BATCH_SIZE = int(os.environ.get('RAG_EMBED_BATCH_SIZE', 256))  # chunks embedded together
+CHECKPOINT_SECONDS = float(os.environ.get('RAG_INGEST_CHECKPOINT_SECONDS', 60))  # 0 = only at the end
+EXTRACTOR_VERSION = 1  # bump when extract_contents produces a different text for the same file
+CACHED_KINDS = {'pdf': marker_version()}  # kinds worth caching, reading a text file again is as fast as the cache
+
+
+class Extracted(NamedTuple):
+    path: str
+    content: Optional[str]
+    error: Optional[str]
+
+
+def extract_one(path: str, file_type: FileType, cache: Optional[ExtractionCache] = EXTRACTION_CACHE) -> Extracted:
+    key = None
+    # noinspection PyBroadException
+    try:
+        if cache is not None and file_type.kind in CACHED_KINDS:
+            key = cache.key(path, f'{EXTRACTOR_VERSION}-{file_type.kind}-{CACHED_KINDS[file_type.kind]}')
+            content = cache.get(key)
+            if content is not None:
+                return Extracted(path, content, None)
+        content, error = extract_contents(path, file_type)
+    except Exception as e:
+        logging.warning(f'Extracting {path} failed: {e}')
+        return Extracted(path, None, f'{e.__class__.__name__}: {e}')
+    if error:
+        return Extracted(path, None, error['error'])
+    if key is not None:
+        cache.put(key, content)
+    return Extracted(path, content, None)
+
+
+def extract_files(files: List[Tuple[str, FileType]], workers: int = EXTRACT_WORKERS) -> Iterator[Extracted]:
+    """
+    Extracts the contents of files concurrently, yields them as they are done (not in the order of files).
+    At most workers files are extracted at the same time. The work is mostly waiting, on the disk or on the PDF
+    worker processes, so threads are enough. A file that fails is yielded with its error, the others go on.
+    Files converted before (same content, same extractor) are taken from the extraction cache.
+    """
+    workers = max(1, workers)
+    pending = iter(files)
+    running: Dict[Future, str] = {}
+    executor = ThreadPoolExecutor(workers, thread_name_prefix='extract')
+    try:
+        while True:
+            while len(running) < workers:
+                file = next(pending, None)
+                if file is None:
+                    break
+                running[executor.submit(extract_one, *file)] = file[0]
+            if not running:
+                return
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                running.pop(future)
+                yield future.result()
+    finally:
+        # when the consumer stopped early (cancelled, token budget exceeded) it does not wait for the running ones
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class CollectionWriter:
+    """
+    Adds the chunks of many files to a collection. Chunks are embedded in batches of batch_size, whatever the file
+    they come from, and the collection is written to disk every checkpoint_seconds and once at the end,
+    not after every file. on_checkpoint gets the files whose chunks are all on disk.
+    """
+
+    def __init__(self, index: NativeCollection, index_path: Union[str, Path], batch_size: int = EMBED_BATCH_SIZE,
+                 checkpoint_seconds: float = CHECKPOINT_SECONDS,
+                 on_checkpoint: Optional[Callable[[List[str]], None]] = None):
+        self.index = index
+        self.index_path = index_path
+        self.batch_size = max(1, batch_size)
+        self.checkpoint_seconds = checkpoint_seconds
+        self.on_checkpoint = on_checkpoint
+        self._docs: List[Document] = []
+        self._pending_files: List[Tuple[str, int]] = []  # (file, number of its chunks in _docs), in order
+        self._unsaved_files: List[str] = []  # embedded, not on disk yet
+        self._saved_at = time.perf_counter()
+        self.chunks = 0
+        self.embed_seconds = 0.0
+        self.save_seconds = 0.0
+        self.saves = 0
+
+    def add(self, file: str, docs: List[Document]):
+        self._docs.extend(docs)
+        self._pending_files.append((file, len(docs)))
+        if len(self._docs) >= self.batch_size:
+            self.flush(full_batches_only=True)
+        if self.checkpoint_seconds and time.perf_counter() - self._saved_at > self.checkpoint_seconds:
+            self.save()
+
+    def flush(self, full_batches_only: bool = False):
+        """
+        Embeds and adds the pending chunks, the last incomplete batch stays pending with full_batches_only
+        """
+        n_docs = len(self._docs) - len(self._docs) % self.batch_size if full_batches_only else len(self._docs)
+        start = time.perf_counter()
+        for first in range(0, n_docs, self.batch_size):
+            batch = self._docs[first:first + self.batch_size]
+            texts = [doc.page_content for doc in batch]
+            vectors = np.asarray(self.index.embeddings.embed_documents(texts), dtype=np.float32)
+            self.index.add_embeddings(zip(texts, vectors), metadatas=[doc.metadata for doc in batch])
+            self.chunks += len(batch)
+        self.embed_seconds += time.perf_counter() - start
+        self._docs = self._docs[n_docs:]
+        while self._pending_files and self._pending_files[0][1] <= n_docs:  # all chunks of the file are added
+            file, n_file_docs = self._pending_files.pop(0)
+            n_docs -= n_file_docs
+            self._unsaved_files.append(file)
+        if self._pending_files:
+            file, n_file_docs = self._pending_files[0]
+            self._pending_files[0] = (file, n_file_docs - n_docs)
+
+    def save(self):
+        self.flush()
+        start = time.perf_counter()
+        self.index.save_local(self.index_path)
+        self.save_seconds += time.perf_counter() - start
+        self.saves += 1
+        self._saved_at = time.perf_counter()
+        files, self._unsaved_files = self._unsaved_files, []
+        if self.on_checkpoint is not None:
+            self.on_checkpoint(files)
+
+    @property
+    def chunks_per_second(self) -> float:
+        seconds = self.embed_seconds + self.save_seconds
+        return round(self.chunks / seconds, 1) if seconds else 0.0
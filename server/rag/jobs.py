@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+import secrets
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import Dict, Any, Optional, Callable, Iterator, List
+
+INGEST_JOBS_FILE = 'ingestion-jobs.sqlite3'
+INGEST_WORKERS = int(os.environ.get('RAG_INGEST_WORKERS', 1))
+INGEST_JOBS_KEEP_DAYS = 7  # finished jobs can be looked up for that long
+INGEST_PERSIST_INTERVAL = 2.0  # seconds between two writes of the progress of a running job
+
+FINISHED = ['done', 'failed', 'cancelled']
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    A running ingestion job, passed to the handler.
+    The handler reports its progress and checks for cancellation between two files.
+    """
+
+    def __init__(self, queue: 'IngestionQueue', job_id: str, username: str, params: Dict[str, Any],
+                 progress: Dict[str, Any]):
+        self.queue = queue
+        self.id = job_id
+        self.username = username
+        self.params = params
+        self.progress = progress
+        self.directory = queue.job_dir(job_id)
+        self.cancelled = threading.Event()
+
+    def report(self, persist: bool = False, **progress):
+        """
+        Updates the progress, persist=True when it must survive a restart (e.g. the files already indexed)
+        """
+        self.progress.update(progress)
+        started = self.progress.setdefault('started_at', time.time())
+        total, done = self.progress.get('files_total'), self.progress.get('files_done', 0)
+        if total and done:
+            elapsed = time.time() - started
+            self.progress['eta'] = round(elapsed / done * (total - done), 1)
+        self.queue.update(self, persist=persist)
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise JobCancelled()
+
+
+class IngestionQueue:
+    """
+    Uploads are ingested in the background, one job per upload, in the order they were submitted.
+    Jobs are kept in SQLite, so queued jobs and the ones interrupted by a restart are run when the server starts
+    again. The files of a job are kept in its own directory until it is finished.
+    """
+
+    def __init__(self, directory: str, handler: Callable[[Job], Dict[str, Any]], workers: int = INGEST_WORKERS):
+        self.directory = directory
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.db_path = os.path.join(directory, INGEST_JOBS_FILE)
+        os.makedirs(directory, exist_ok=True)
+        self._changed = threading.Condition()
+        self._running: Dict[str, Job] = {}
+        self._persisted_at: Dict[str, float] = {}
+        self._threads: List[threading.Thread] = []
+        with closing(self._connect()) as db, db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                       'id TEXT PRIMARY KEY, username TEXT NOT NULL, state TEXT NOT NULL, params TEXT NOT NULL, '
+                       'progress TEXT NOT NULL, result TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, created_at)')
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(self.directory, job_id)
+
+    @staticmethod
+    def new_id() -> str:
+        return secrets.token_hex(8)
+
+    def start(self):
+        now = time.time()
+        with closing(self._connect()) as db, db:
+            # interrupted by a restart, run them again, the handler skips what has been persisted as done
+            db.execute("UPDATE jobs SET state = 'queued' WHERE state = 'running'")
+            finished = db.execute(f"SELECT id FROM jobs WHERE state IN ({','.join('?' * len(FINISHED))}) "
+                                  f"AND updated_at < ?", (*FINISHED, now - INGEST_JOBS_KEEP_DAYS * 86400)).fetchall()
+            db.executemany('DELETE FROM jobs WHERE id = ?', finished)
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True, name='ingest')
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, job_id: str, username: str, params: Dict[str, Any]) -> str:
+        now = time.time()
+        with closing(self._connect()) as db, db:
+            db.execute("INSERT INTO jobs (id, username, state, params, progress, created_at, updated_at) "
+                       "VALUES (?, ?, 'queued', ?, '{}', ?, ?)", (job_id, username, json.dumps(params), now, now))
+        with self._changed:
+            self._changed.notify_all()
+        return job_id
+
+    def _claim(self) -> Optional[Job]:
+        with closing(self._connect()) as db, db:
+            db.execute('BEGIN IMMEDIATE')  # two workers must not take the same job
+            row = db.execute("SELECT id, username, params, progress FROM jobs WHERE state = 'queued' "
+                             "ORDER BY created_at LIMIT 1").fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET state = 'running', updated_at = ? WHERE id = ?", (time.time(), row[0]))
+        job = Job(self, row[0], row[1], json.loads(row[2]), json.loads(row[3]))
+        with self._changed:
+            self._running[job.id] = job
+            self._changed.notify_all()
+        return job
+
+    def _work(self):
+        while True:
+            job = self._claim()
+            if job is None:
+                with self._changed:
+                    self._changed.wait(timeout=5)
+                continue
+            state, result, error = 'done', None, None
+            # noinspection PyBroadException
+            try:
+                result = self.handler(job)
+            except JobCancelled:
+                state = 'cancelled'
+            except Exception as e:
+                logging.exception(f'Ingestion job {job.id} failed')
+                state, error = 'failed', f'{e.__class__.__name__}: {e}'
+            if result is not None and 'error' in result:
+                state, error = 'failed', result['error']
+            self._finish(job, state, result, error)
+
+    def _finish(self, job: Job, state: str, result: Optional[Dict[str, Any]], error: Optional[str]):
+        with closing(self._connect()) as db, db:
+            db.execute('UPDATE jobs SET state = ?, progress = ?, result = ?, error = ?, updated_at = ? WHERE id = ?',
+                       (state, json.dumps(job.progress), json.dumps(result), error, time.time(), job.id))
+        shutil.rmtree(job.directory, ignore_errors=True)
+        with self._changed:
+            self._running.pop(job.id, None)
+            self._persisted_at.pop(job.id, None)
+            self._changed.notify_all()
+
+    def update(self, job: Job, persist: bool = False):
+        now = time.time()
+        if persist or now - self._persisted_at.get(job.id, 0) > INGEST_PERSIST_INTERVAL:
+            with closing(self._connect()) as db, db:
+                db.execute('UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ?',
+                           (json.dumps(job.progress), now, job.id))
+            self._persisted_at[job.id] = now
+        with self._changed:
+            self._changed.notify_all()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with closing(self._connect()) as db:
+            row = db.execute('SELECT id, username, state, progress, result, error, created_at FROM jobs WHERE id = ?',
+                             (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(id=row[0], username=row[1], state=row[2], progress=json.loads(row[3]),
+                   result=json.loads(row[4]) if row[4] else None, error=row[5], created_at=row[6])
+        running = self._running.get(job_id)
+        if running is not None:  # more recent than what has been persisted
+            job['progress'] = dict(running.progress)
+        return job
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancels a queued job, or asks a running one to stop after the file it is working on
+        """
+        with self._changed:
+            running = self._running.get(job_id)
+            if running is not None:
+                running.cancelled.set()
+                return True
+        with closing(self._connect()) as db, db:
+            cursor = db.execute("UPDATE jobs SET state = 'cancelled', updated_at = ? WHERE id = ? AND state = 'queued'",
+                                (time.time(), job_id))
+        if cursor.rowcount:
+            shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+            with self._changed:
+                self._changed.notify_all()
+        return bool(cursor.rowcount)
+
+    def events(self, job_id: str, keepalive: float = 15) -> Iterator[Optional[Dict[str, Any]]]:
+        """
+        The job each time it changes, until it is finished. None when nothing changed for keepalive seconds.
+        """
+        last = None
+        while True:
+            job = self.get(job_id)
+            if job is None:
+                return
+            if job != last:
+                yield job
+                last = job
+            if job['state'] in FINISHED:
+                return
+            with self._changed:
+                changed = self._changed.wait(timeout=keepalive)
+            if not changed:
+                yield None
+
+    def stats(self) -> Dict[str, Any]:
+        with closing(self._connect()) as db:
+            counts = dict(db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        return dict(workers=self.workers, running=len(self._running), **counts)
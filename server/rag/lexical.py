@@ -0,0 +1,123 @@
+"""
+Lexical retrieval next to the vector search, for what embeddings miss: identifiers, function names, error messages.
+Chunks are indexed with BM25 (SQLite FTS5, in the chunk store of the collection) when they are saved.
+Identifiers are indexed whole and split into their words, so getUserName is found by "get_user_name" and "user name".
+A hybrid search runs the lexical leg while the query is embedded, and fuses both rankings by reciprocal rank.
+"""
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Sequence, Tuple, Dict, Any, Optional, Callable, TYPE_CHECKING
+
+import numpy as np
+from langchain_core.documents import Document
+
+if TYPE_CHECKING:
+    from rag.store import NativeCollection
+
+HYBRID_SEARCH_ENABLED = os.environ.get('RAG_HYBRID_SEARCH', '1') == '1'
+HYBRID_CANDIDATES = int(os.environ.get('RAG_HYBRID_CANDIDATES', 4))  # each leg fetches k times this many chunks
+HYBRID_WORKERS = 4
+RRF_K = 60  # the usual constant of reciprocal rank fusion, damps the weight of the first ranks
+MAX_QUERY_TERMS = 64
+
+WORD = re.compile(r'\w+')
+WORD_PART = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+')
+
+
+def terms(text: str) -> List[str]:
+    """
+    Lower case words of text, identifiers followed by their parts (snake_case, camelCase)
+    """
+    result = []
+    for word in WORD.findall(text):
+        result.append(word.lower())
+        parts = [part.lower() for piece in word.split('_') for part in WORD_PART.findall(piece)]
+        if len(parts) > 1:
+            result.extend(parts)
+    return result
+
+
+def index_text(text: str) -> str:
+    return ' '.join(terms(text))
+
+
+def match_expression(query: str) -> Optional[str]:
+    """
+    FTS5 query matching chunks with any of the terms of query, BM25 ranks those with more (and rarer) ones first
+    """
+    unique = list(dict.fromkeys(terms(query)))[:MAX_QUERY_TERMS]
+    if not unique:
+        return None
+    return ' OR '.join('"' + term.replace('"', '""') + '"' for term in unique)
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int = RRF_K) -> List[Tuple[int, float]]:
+    """
+    Positions ranked by the sum of 1 / (k + rank) over the rankings they appear in, best first
+    """
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, position in enumerate(ranking):
+            scores[int(position)] = scores.get(int(position), 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: -item[1])
+
+
+class HybridSearch:
+    """
+    Lexical and vector search of a collection, executed concurrently and fused
+    """
+
+    def __init__(self, candidates: int = HYBRID_CANDIDATES, workers: int = HYBRID_WORKERS):
+        self.candidates = max(1, candidates)
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='lexical')
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.lexical_seconds = 0.0
+        self.vector_seconds = 0.0
+        self.total_seconds = 0.0
+        self.lexical_only = 0  # hits found by the lexical leg alone
+
+    def search(self, collection: 'NativeCollection', query: str, k: int,
+               embed: Optional[Callable[[], np.ndarray]] = None) -> List[Document]:
+        """
+        The k best chunks of both searches, embed gives the query vector (e.g. from a cache), called meanwhile
+        """
+        start = time.perf_counter()
+        n_candidates = k * self.candidates
+
+        def lexical():
+            lexical_start = time.perf_counter()
+            ids, _ = collection.lexical_search(query, n_candidates)
+            return ids, time.perf_counter() - lexical_start
+
+        lexical_future = self._executor.submit(lexical)
+        vector_start = time.perf_counter()
+        if embed is None:
+            vector = np.asarray(collection.embeddings.embed_query(query), dtype=np.float32)
+        else:
+            vector = embed()
+        vector_ids, _ = collection.search(vector, n_candidates)
+        vector_seconds = time.perf_counter() - vector_start
+        lexical_ids, lexical_seconds = lexical_future.result()
+
+        fused = [position for position, _ in reciprocal_rank_fusion([vector_ids, lexical_ids])[:k]]
+        lexical_only = len(set(fused) - set(int(i) for i in vector_ids))
+        with self._lock:
+            self.queries += 1
+            self.lexical_seconds += lexical_seconds
+            self.vector_seconds += vector_seconds
+            self.total_seconds += time.perf_counter() - start
+            self.lexical_only += lexical_only
+        return collection.documents(fused)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(enabled=HYBRID_SEARCH_ENABLED, queries=self.queries, lexical_only_hits=self.lexical_only,
+                        lexical_seconds=round(self.lexical_seconds, 3), vector_seconds=round(self.vector_seconds, 3),
+                        total_seconds=round(self.total_seconds, 3))
+
+
+HYBRID_SEARCH = HybridSearch()
@@ -0,0 +1,273 @@
+"""
+PDF to markdown conversion with marker, in long-lived worker processes.
+A worker loads the marker models once and then converts one job (a document or a range of its pages) at a time.
+Jobs and results are exchanged as json lines over the stdin and stdout of the worker.
+This file is also the worker program, it is started as a script so the worker does not import the server.
+"""
+import atexit
+import importlib.metadata
+import json
+import logging
+import os
+import queue
+import select
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+
+PDF_WORKER_MEMORY = 4 * 2**30  # bytes, about what a worker with the marker models loaded takes
+
+
+def default_pdf_workers() -> int:
+    """
+    Workers this machine holds: each one with a few cores (torch runs several threads) and half the memory at most
+    """
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        memory = 0
+    return max(1, min((os.cpu_count() or 1) // 4, memory // 2 // PDF_WORKER_MEMORY, 4))
+
+
+PDF_WORKERS = int(os.environ.get('RAG_PDF_WORKERS', 0)) or default_pdf_workers()  # each holds its own marker models
+PDF_TIMEOUT = float(os.environ.get('RAG_PDF_TIMEOUT', 600))  # seconds per job, the worker is killed beyond
+PDF_MAX_RSS = int(os.environ.get('RAG_PDF_MAX_RSS', 8 * 2**30))  # bytes, a worker above is restarted, 0 = unlimited
+PDF_PAGES_PER_JOB = int(os.environ.get('RAG_PDF_PAGES_PER_JOB', 20))  # split longer documents across workers, 0 = never
+
+
+def marker_version() -> str:
+    try:
+        return importlib.metadata.version('marker-pdf')
+    except importlib.metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def current_rss() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:  # not linux, the peak is the best we have
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # bytes on macOS
+
+
+def page_count(path: str) -> int:
+    """
+    Number of pages of a PDF, 0 if it cannot be read here (marker will tell)
+    """
+    # noinspection PyBroadException
+    try:
+        # noinspection PyPackageRequirements
+        import pypdfium2  # installed with marker
+        document = pypdfium2.PdfDocument(path)
+        try:
+            return len(document)
+        finally:
+            document.close()
+    except Exception:
+        return 0
+
+
+class PdfWorker:
+    """
+    One worker process, used by one thread at a time
+    """
+
+    def __init__(self):
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__)],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def run(self, job: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        self.process.stdin.write(json.dumps(job).encode() + b'\n')
+        self.process.stdin.flush()
+        return json.loads(self._read_line(time.monotonic() + timeout, timeout))
+
+    def _read_line(self, deadline: float, timeout: float) -> bytes:
+        """
+        The next line of the worker, read as it arrives so a worker hanging in the middle of a line is caught too
+        """
+        fd = self.process.stdout.fileno()
+        parts = []
+        while True:
+            remaining = deadline - time.monotonic()
+            ready, _, _ = select.select([fd], [], [], max(remaining, 0))
+            if not ready:
+                raise TimeoutError(f'PDF conversion took more than {timeout}s')
+            data = os.read(fd, 2**20)  # what is there, does not wait for more
+            if not data:
+                raise RuntimeError(f'PDF worker exited with {self.process.wait()}')
+            end = data.find(b'\n')
+            if end >= 0:
+                parts.append(data[:end])  # one job at a time, nothing follows the line of its result
+                return b''.join(parts)
+            parts.append(data)
+
+    def stop(self):
+        try:
+            self.process.stdin.close()  # the worker exits at the end of its input
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+
+
+class PdfWorkerPool:
+    """
+    A fixed number of workers, started on first use and restarted after a timeout, a crash or when they grew beyond
+    max_rss. Documents longer than pages_per_job are split into page ranges converted concurrently.
+    """
+
+    def __init__(self, workers: int = PDF_WORKERS, timeout: float = PDF_TIMEOUT, max_rss: int = PDF_MAX_RSS,
+                 pages_per_job: int = PDF_PAGES_PER_JOB):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.max_rss = max_rss
+        self.pages_per_job = pages_per_job
+        self._idle: 'queue.Queue[Optional[PdfWorker]]' = queue.Queue()
+        for _ in range(self.workers):
+            self._idle.put(None)  # started when needed
+        self._started: List[PdfWorker] = []
+        self._batches = ThreadPoolExecutor(self.workers, thread_name_prefix='pdf')
+        self._lock = threading.Lock()
+        self.conversions = 0
+        self.jobs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.restarts = 0
+        self.convert_seconds = 0.0
+
+    def convert(self, path: str) -> str:
+        """
+        Markdown of a PDF, blocks until it is converted
+        """
+        start = time.perf_counter()
+        path = os.path.abspath(path)
+        n_pages = page_count(path) if self.pages_per_job > 0 and self.workers > 1 else 0
+        if n_pages > self.pages_per_job:
+            page_ranges = [list(range(first, min(first + self.pages_per_job, n_pages)))
+                           for first in range(0, n_pages, self.pages_per_job)]
+            parts = self._batches.map(lambda pages: self._run(dict(path=path, pages=pages)), page_ranges)
+            markdown = '\n\n'.join(parts)
+        else:
+            markdown = self._run(dict(path=path))
+        with self._lock:
+            self.conversions += 1
+            self.convert_seconds += time.perf_counter() - start
+        return markdown
+
+    def _run(self, job: Dict[str, Any]) -> str:
+        worker = self._idle.get()
+        try:
+            if worker is None:
+                worker = self._start_worker()
+            try:
+                reply = worker.run(job, self.timeout)
+            except TimeoutError:
+                self._discard(worker, kill=True)
+                worker = None
+                with self._lock:
+                    self.timeouts += 1
+                raise
+            except (OSError, RuntimeError, ValueError):
+                self._discard(worker, kill=True)
+                worker = None
+                with self._lock:
+                    self.failures += 1
+                raise
+            with self._lock:
+                self.jobs += 1
+            if self.max_rss and reply.get('rss', 0) > self.max_rss:
+                logging.info(f"PDF worker uses {reply['rss'] / 2**30:.1f} GiB, restarting it")
+                self._discard(worker)
+                worker = None
+            if 'error' in reply:
+                with self._lock:
+                    self.failures += 1
+                raise RuntimeError(reply['error'])
+            return reply['markdown']
+        finally:
+            self._idle.put(worker)
+
+    def _start_worker(self) -> PdfWorker:
+        worker = PdfWorker()
+        with self._lock:
+            self._started.append(worker)
+        return worker
+
+    def _discard(self, worker: PdfWorker, kill: bool = False):
+        with self._lock:
+            if worker in self._started:  # not closed meanwhile
+                self._started.remove(worker)
+            self.restarts += 1  # a new worker is started for the next job
+        if kill:
+            worker.kill()
+        else:
+            threading.Thread(target=worker.stop, daemon=True).start()
+
+    def close(self):
+        with self._lock:
+            workers, self._started = self._started, []
+        for worker in workers:
+            worker.stop()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(workers=self.workers, running=len(self._started), conversions=self.conversions, jobs=self.jobs,
+                        failures=self.failures, timeouts=self.timeouts, restarts=self.restarts,
+                        convert_seconds=round(self.convert_seconds, 3))
+
+
+PDF_WORKER_POOL = PdfWorkerPool()
+atexit.register(PDF_WORKER_POOL.close)
+
+
+def load_marker_models() -> Dict[str, Any]:
+    # TODO: This is a workaround, see https://github.com/VikParuchuri/marker/issues/654
+    import transformers
+
+    def new_repr(self):
+        return f"{self.__class__.__name__}"
+    transformers.configuration_utils.PretrainedConfig.__repr__ = new_repr
+    # TODO: End
+
+    os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"  # For some reason, transformers decided to use .isin for a simple op, which is not supported on MPS
+    # noinspection PyPackageRequirements
+    from marker.models import create_model_dict
+    return create_model_dict()
+
+
+def convert_with_marker(models: Dict[str, Any], path: str, pages: Optional[List[int]] = None) -> str:
+    # noinspection PyPackageRequirements
+    from marker.converters.pdf import PdfConverter
+    # noinspection PyPackageRequirements
+    from marker.output import text_from_rendered
+    config = dict(page_range=pages) if pages else None
+    converter = PdfConverter(artifact_dict=models, config=config)  # cheap, the models are shared
+    markdown, _, _images = text_from_rendered(converter(path))
+    return markdown
+
+
+def worker_main():
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())  # whatever marker prints must not end up in the replies
+    models = load_marker_models()
+    for line in sys.stdin.buffer:
+        job = json.loads(line)
+        # noinspection PyBroadException
+        try:
+            reply = dict(markdown=convert_with_marker(models, job['path'], job.get('pages')))
+        except Exception as e:
+            reply = dict(error=f'{e.__class__.__name__}: {e}')
+        reply['rss'] = current_rss()
+        replies.write(json.dumps(reply).encode() + b'\n')
+        replies.flush()
+
+
+if __name__ == '__main__':
+    worker_main()
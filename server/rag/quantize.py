@@ -0,0 +1,171 @@
+"""
+Storage precisions of the vectors of a collection:
+- float32: as embedded, 4 bytes per dimension
+- float16: 2 bytes per dimension, practically lossless for normalized embeddings
+- int8: 1 byte per dimension, scalar quantization between the per dimension minimum and maximum of the collection
+- pq: product quantization, one byte per group of PQ_DIMS_PER_CODE dimensions (64 bytes for bge-m3)
+int8 and pq are trained on the vectors of the collection, once it has enough of them, until then it stays float32.
+A trained codec is kept in a file next to the segments encoded with it.
+Codes are scored against a query without decoding them to float32 first.
+"""
+import os
+from pathlib import Path
+from typing import Union, Optional
+
+import numpy as np
+
+PRECISIONS = ['float32', 'float16', 'int8', 'pq']
+DEFAULT_PRECISION = os.environ.get('RAG_VECTOR_PRECISION', 'float32')
+TRAIN_MIN_VECTORS = dict(int8=1000, pq=10000)  # pq trains 256 centroids per code
+TRAIN_MAX_VECTORS = 2**17
+PQ_DIMS_PER_CODE = 16
+SCORE_BLOCK = 2**15  # rows converted at once, bounds the temporary memory of a search
+
+
+class Codec:
+    precision = 'float32'
+    file: Optional[str] = None  # where a trained codec is stored, None for float32 and float16
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.asarray(vectors, dtype=np.float32)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return np.asarray(codes, dtype=np.float32)
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """
+        Inner products of the encoded vectors with query
+        """
+        return codes @ query
+
+    def save(self, path: Path):
+        pass
+
+
+class Float16Codec(Codec):
+    precision = 'float16'
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.asarray(vectors, dtype=np.float16)
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        return blockwise(codes, lambda block: block.astype(np.float32) @ query)
+
+
+class Int8Codec(Codec):
+    precision = 'int8'
+
+    def __init__(self, low: np.ndarray, scale: np.ndarray):
+        self.low = low.astype(np.float32)
+        self.scale = scale.astype(np.float32)
+
+    @classmethod
+    def train(cls, sample: np.ndarray) -> 'Int8Codec':
+        low, high = sample.min(axis=0), sample.max(axis=0)
+        return cls(low, np.maximum(high - low, 1e-12) / 255)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint((vectors - self.low) / self.scale), 0, 255).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) * self.scale + self.low
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        scaled, shift = query * self.scale, float(query @ self.low)
+        return blockwise(codes, lambda block: block.astype(np.float32) @ scaled + shift)
+
+    def save(self, path: Path):
+        np.savez(path, precision=self.precision, low=self.low, scale=self.scale)
+
+
+class PqCodec(Codec):
+    precision = 'pq'
+
+    def __init__(self, centroids: np.ndarray):
+        self.centroids = centroids.astype(np.float32)  # (codes per vector, 256, dimensions per code)
+
+    @classmethod
+    def train(cls, sample: np.ndarray) -> 'PqCodec':
+        import faiss
+        dim = sample.shape[1]
+        n_codes = max(1, dim // PQ_DIMS_PER_CODE)
+        while dim % n_codes:
+            n_codes -= 1
+        pq = faiss.ProductQuantizer(dim, n_codes, 8)
+        pq.train(np.ascontiguousarray(sample, dtype=np.float32))
+        return cls(faiss.vector_to_array(pq.centroids).reshape(n_codes, pq.ksub, pq.dsub))
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        import faiss
+        n_codes, _, dsub = self.centroids.shape
+        pq = faiss.ProductQuantizer(n_codes * dsub, n_codes, 8)
+        faiss.copy_array_to_vector(self.centroids.ravel(), pq.centroids)
+        return pq.compute_codes(np.ascontiguousarray(vectors, dtype=np.float32))
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        n_codes = self.centroids.shape[0]
+        parts = self.centroids[np.arange(n_codes), np.asarray(codes, dtype=np.int64)]  # (n, codes, dsub)
+        return parts.reshape(len(codes), -1)
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        n_codes = self.centroids.shape[0]
+        table = np.einsum('mkd,md->mk', self.centroids, query.reshape(n_codes, -1))  # query x every centroid
+        return blockwise(codes, lambda block: table[np.arange(n_codes), block].sum(axis=1))
+
+    def save(self, path: Path):
+        np.savez(path, precision=self.precision, centroids=self.centroids)
+
+
+def blockwise(codes: np.ndarray, score) -> np.ndarray:
+    if len(codes) <= SCORE_BLOCK:
+        return score(codes)
+    return np.concatenate([score(codes[first:first + SCORE_BLOCK]) for first in range(0, len(codes), SCORE_BLOCK)])
+
+
+FLOAT32 = Codec()
+FLOAT16 = Float16Codec()
+
+
+def needs_training(precision: str) -> bool:
+    return precision in TRAIN_MIN_VECTORS
+
+
+def train_codec(precision: str, vectors: np.ndarray, seed: int = 0) -> Codec:
+    """
+    Codec of the given precision, trained on (a sample of) vectors
+    """
+    if precision == 'float32':
+        return FLOAT32
+    if precision == 'float16':
+        return FLOAT16
+    if len(vectors) > TRAIN_MAX_VECTORS:
+        sample = vectors[np.sort(np.random.default_rng(seed).choice(len(vectors), TRAIN_MAX_VECTORS, replace=False))]
+    else:
+        sample = vectors[np.arange(len(vectors))]
+    sample = np.asarray(sample, dtype=np.float32)
+    if precision == 'int8':
+        return Int8Codec.train(sample)
+    if precision == 'pq':
+        return PqCodec.train(sample)
+    raise ValueError(f'Unknown precision {precision}, one of {", ".join(PRECISIONS)}')
+
+
+def load_codec(directory: Union[str, Path], precision: str, file: Optional[str] = None) -> Optional[Codec]:
+    """
+    Codec of this precision, read from file in directory when it is trained, None if it has not been trained yet
+    """
+    if precision == 'float32':
+        return FLOAT32
+    if precision == 'float16':
+        return FLOAT16
+    if file is None:
+        return None
+    data = np.load(Path(directory) / file)
+    if precision == 'int8':
+        codec = Int8Codec(data['low'], data['scale'])
+    elif precision == 'pq':
+        codec = PqCodec(data['centroids'])
+    else:
+        raise ValueError(f'Unknown precision {precision}, one of {", ".join(PRECISIONS)}')
+    codec.file = file
+    return codec
@@ -0,0 +1,141 @@
+"""
+Reranking of the retrieved chunks with a cross-encoder (flashrank, onnx on the CPU), when enabled for a collection.
+The collection is searched for k * candidates chunks, the model scores all of them against the query in one batch,
+and the k best are kept. The model is loaded once and shared by all collections.
+A reranking which does not finish within its latency budget is abandoned and the chunks keep their search order.
+It is enabled in the config.json of a collection by "rerank": true or e.g. {"enabled": true, "candidates": 4,
+"budget_ms": 500}, collections without the key follow RAG_RERANK.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Union
+
+from langchain_core.documents import Document
+
+from utils.filesystem import is_importable
+
+RERANK_DEFAULT = os.environ.get('RAG_RERANK', '0') == '1'
+RERANK_MODEL = os.environ.get('RAG_RERANK_MODEL', 'ms-marco-MultiBERT-L-12')
+RERANK_CANDIDATES = int(os.environ.get('RAG_RERANK_CANDIDATES', 4))  # chunks scored per chunk returned
+RERANK_BUDGET_MS = float(os.environ.get('RAG_RERANK_BUDGET_MS', 500))  # 0 = unlimited
+RERANK_MAX_LENGTH = int(os.environ.get('RAG_RERANK_MAX_LENGTH', 512))  # tokens of query and chunk, the rest is cut
+RERANK_CACHE_DIR = os.environ.get('RAG_RERANK_CACHE_DIR', 'cache/rerank')
+
+
+def rerank_config(path: Union[str, Path]) -> Dict[str, Any]:
+    try:
+        with open(Path(path) / 'config.json') as f:
+            config = json.load(f).get('rerank', RERANK_DEFAULT)
+    except (OSError, ValueError):
+        config = RERANK_DEFAULT
+    if not isinstance(config, dict):
+        config = dict(enabled=bool(config))
+    return dict(dict(enabled=True, candidates=RERANK_CANDIDATES, budget_ms=RERANK_BUDGET_MS), **config)
+
+
+class Reranker:
+    """
+    Cross-encoder shared by all collections, scoring one batch of chunks at a time in its own thread
+    """
+
+    def __init__(self, model_name: str = RERANK_MODEL):
+        self.model_name = model_name
+        self._ranker = None
+        self._available: Optional[bool] = None  # flashrank is imported at the first reranking
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='rerank')
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.reranked = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.candidates = 0
+        self.batches = 0  # scored, in time or not
+        self.rerank_seconds = 0.0
+        self.load_seconds = 0.0
+
+    @property
+    def available(self) -> bool:
+        if self._available is None:
+            self._available = is_importable('flashrank')
+            if not self._available:
+                logging.warning('Reranking is enabled but flashrank is not installed, chunks keep their search order')
+        return self._available
+
+    def _model(self):
+        if self._ranker is None:  # only loaded in the rerank thread
+            # noinspection PyPackageRequirements
+            from flashrank import Ranker
+            start = time.perf_counter()
+            self._ranker = Ranker(model_name=self.model_name, cache_dir=RERANK_CACHE_DIR, max_length=RERANK_MAX_LENGTH)
+            self.load_seconds = time.perf_counter() - start
+            logging.info(f'Loaded reranker {self.model_name} in {self.load_seconds:.1f}s')
+        return self._ranker
+
+    def warm_up(self):
+        """
+        Loads the model in the rerank thread, so the first queries do not wait for it beyond their budget
+        """
+        if self.available:
+            self._executor.submit(self._model)
+
+    def _order(self, query: str, docs: List[Document], deadline: Optional[float]) -> Optional[List[int]]:
+        if deadline is not None and time.perf_counter() > deadline:
+            return None  # waited too long behind other queries, the caller has given up already
+        # noinspection PyPackageRequirements
+        from flashrank import RerankRequest
+        ranker = self._model()
+        start = time.perf_counter()
+        results = ranker.rerank(RerankRequest(query=query, passages=[
+            dict(id=i, text=d.page_content) for i, d in enumerate(docs)
+        ]))
+        with self._lock:
+            self.batches += 1
+            self.rerank_seconds += time.perf_counter() - start
+        return [r['id'] for r in results]
+
+    def rerank(self, query: str, docs: List[Document], k: int,
+               budget_ms: float = RERANK_BUDGET_MS) -> Optional[List[Document]]:
+        """
+        The k of docs which are most relevant to query, None if that could not be decided in time
+        """
+        if len(docs) <= 1 or not self.available:
+            return docs[:k]
+        with self._lock:
+            self.queries += 1
+            self.candidates += len(docs)
+        timeout = budget_ms / 1000 if budget_ms else None
+        deadline = time.perf_counter() + timeout if timeout else None
+        future = self._executor.submit(self._order, query, docs, deadline)
+        try:
+            order = future.result(timeout=timeout)
+        except TimeoutError:
+            order = None
+        except Exception as e:
+            logging.warning(f'Reranking failed: {e}')
+            with self._lock:
+                self.failures += 1
+            return None
+        with self._lock:
+            if order is None:
+                self.timeouts += 1
+            else:
+                self.reranked += 1
+        if order is None:
+            return None
+        return [docs[i] for i in order[:k]]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(model=self.model_name, available=self._available, loaded=self._ranker is not None,
+                        queries=self.queries, reranked=self.reranked, timeouts=self.timeouts, failures=self.failures,
+                        candidates=self.candidates, rerank_seconds=round(self.rerank_seconds, 3),
+                        mean_rerank_ms=round(self.rerank_seconds / max(1, self.batches) * 1000, 1),
+                        load_seconds=round(self.load_seconds, 3))
+
+
+RERANKER = Reranker()
@@ -0,0 +1,519 @@
+"""
+Native collection format. A collection directory holds:
+- segments.json: the manifest, the list of vector segments and the number of chunks they hold
+- segments/<n>.npy: vectors of consecutive chunks, memory mapped, so the page cache is shared by all processes.
+  They are stored in the precision of the collection, see rag.quantize, with the quantizer in segments/codec-<n>.npz.
+- chunks.sqlite3: texts and metadata of the chunks by position, only read for the hits of a search,
+  and their BM25 index for lexical search (see rag.lexical)
+New documents are written as a new segment, existing segments are never rewritten except when small ones are merged.
+"""
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import closing, contextmanager
+from pathlib import Path
+from typing import List, Tuple, Optional, Dict, Any, Iterable, Union, Iterator
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from rag.lexical import index_text, match_expression
+from rag.quantize import Codec, DEFAULT_PRECISION, PRECISIONS, FLOAT32, TRAIN_MIN_VECTORS, load_codec, train_codec, \
+    needs_training
+
+COLLECTION_MANIFEST = 'segments.json'
+COLLECTION_CHUNKS = 'chunks.sqlite3'
+COLLECTION_SEGMENTS = 'segments'
+COLLECTION_LOCK = '.lock'
+LEGACY_FILES = ['index.faiss', 'index.pkl']  # langchain FAISS.save_local
+MAX_SEGMENTS = int(os.environ.get('RAG_MAX_SEGMENTS', 16))  # adjacent small segments are merged beyond
+LOAD_ATTEMPTS = 3  # loads without a lock before waiting for the writer
+
+
+def is_legacy_collection(path: Union[str, Path]) -> bool:
+    path = Path(path)
+    return not (path / COLLECTION_MANIFEST).exists() and (path / LEGACY_FILES[0]).exists()
+
+
+class NativeCollection(VectorStore):
+    """
+    Collection in the native format. Vectors are normalized, scores are cosine similarities (higher is better).
+    Added chunks are kept in memory until save_local, which writes them as one new segment.
+    Several processes may read a collection while one of them writes to it.
+    """
+
+    def __init__(self, path: Union[str, Path], embeddings: Embeddings):
+        self.path = Path(path)
+        self._embeddings = embeddings
+        self._lock = threading.Lock()
+        self._manifest: Dict[str, Any] = {}
+        self._vectors: List[Tuple[int, np.ndarray, Codec]] = []  # (position of the first chunk, memory mapped codes, codec)
+        self._ann = None  # (faiss index of the first chunks, its description), see rag.ann
+        self._pending_vectors: List[np.ndarray] = []
+        self._pending_chunks: List[Tuple[str, Dict[str, Any]]] = []
+        self._load()
+
+    @classmethod
+    def create(cls, path: Union[str, Path], embeddings: Embeddings,
+               precision: str = DEFAULT_PRECISION) -> 'NativeCollection':
+        """
+        Opens the collection at path, creates it with vectors stored in precision if it does not exist
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f'Unknown precision {precision}, one of {", ".join(PRECISIONS)}')
+        path = Path(path)
+        os.makedirs(path / COLLECTION_SEGMENTS, exist_ok=True)
+        with collection_lock(path):
+            if not (path / COLLECTION_MANIFEST).exists():
+                init_chunks(path)
+                write_manifest(path, dict(dim=None, dtype=precision, codec=None, total=0, next=1, segments=[],
+                                          lexical=True))
+        return cls(path, embeddings)
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self._embeddings
+
+    def _load(self):
+        """
+        Maps the segments of the current manifest. A writer may replace it and remove the segments it listed
+        while they are being mapped, the manifest is then read again, at last while the writer is kept out.
+        """
+        for _ in range(LOAD_ATTEMPTS - 1):
+            try:
+                return self._read()
+            except FileNotFoundError as e:
+                logging.info(f'Reading {self.path} again, it has been written meanwhile ({e})')
+        with collection_lock(self.path, shared=True):
+            self._read()
+
+    def _read(self):
+        with open(self.path / COLLECTION_MANIFEST) as f:
+            manifest = json.load(f)
+        vectors = segments_of(self.path, manifest)
+        from rag.ann import read_ann_index
+        ann = read_ann_index(self.path)
+        with self._lock:
+            self._manifest, self._vectors, self._ann = manifest, vectors, ann
+
+    def __len__(self) -> int:
+        return self._manifest['total']
+
+    @property
+    def precision(self) -> str:
+        return self._manifest['dtype']
+
+    def memory_bytes(self) -> int:
+        """
+        Bytes of vectors mapped, they are only resident as far as the page cache holds them
+        """
+        return sum(codes.nbytes for _, codes, _ in self._vectors)
+
+    def vectors(self, start: int = 0, end: Optional[int] = None) -> 'SegmentView':
+        return SegmentView(self._vectors, start, len(self) if end is None else end)
+
+    @property
+    def has_lexical_index(self) -> bool:
+        return bool(self._manifest.get('lexical'))
+
+    @property
+    def ann_info(self) -> Optional[Dict[str, Any]]:
+        return self._ann[1] if self._ann is not None else None
+
+    def add_embeddings(self, text_embeddings: Iterable[Tuple[str, List[float]]],
+                       metadatas: Optional[List[Dict[str, Any]]] = None, **kwargs) -> List[str]:
+        pairs = list(text_embeddings)
+        if not pairs:
+            return []
+        texts, vectors = zip(*pairs)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            first = self._manifest['total'] + sum(len(v) for v in self._pending_vectors)
+            self._pending_vectors.append(vectors)
+            self._pending_chunks.extend(zip(texts, metadatas or [{}] * len(texts)))
+        return [str(first + i) for i in range(len(texts))]  # final once saved, unless another process wrote first
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs) -> List[str]:
+        texts = list(texts)
+        return self.add_embeddings(zip(texts, self._embeddings.embed_documents(texts)), metadatas)
+
+    def save_local(self, folder_path: Union[str, Path, None] = None):
+        """
+        Writes the pending chunks as a new segment, then merges segments if there are too many
+        """
+        with self._lock:
+            vectors, self._pending_vectors = self._pending_vectors, []
+            chunks, self._pending_chunks = self._pending_chunks, []
+        if not vectors and len(self._manifest['segments']) <= MAX_SEGMENTS:
+            self._load()  # nothing to write, pick up what others wrote
+            return
+        with collection_lock(self.path):
+            with open(self.path / COLLECTION_MANIFEST) as f:
+                manifest = json.load(f)  # another process may have added segments since we loaded it
+            if vectors:
+                vectors = np.concatenate(vectors)
+                manifest['dim'] = manifest['dim'] or vectors.shape[1]
+                first = manifest['total']
+                codec = codec_for(self.path, manifest, vectors)
+                name = f"{manifest['next']:06d}.npy"
+                write_segment(self.path, name, codec.encode(vectors))
+                insert_chunks(self.path, first, chunks)
+                manifest['segments'].append(dict(name=name, first=first, count=len(vectors), dtype=codec.precision,
+                                                 codec=codec.file))
+                manifest['total'] = first + len(vectors)
+                manifest['next'] += 1
+            merge_segments(self.path, manifest)
+            write_manifest(self.path, manifest)
+            remove_unused_segments(self.path, manifest)
+        self._load()
+
+    def search(self, vector: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Positions and scores of the k chunks closest to vector, best first.
+        With an ANN index, it is searched for the chunks it holds and the chunks added since are searched exhaustively.
+        """
+        query = np.asarray(vector, dtype=np.float32)
+        ids, scores = [], []
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        indexed = 0
+        if self._ann is not None:
+            from rag.ann import ann_search
+            index, info = self._ann
+            indexed = info['total']
+            hits, hit_scores = ann_search(index, self.vectors(), query, k, info.get('refine', 1))
+            ids.append(hits)
+            scores.append(hit_scores)
+        for first, codes, codec in self._vectors:
+            if first + len(codes) <= indexed:
+                continue
+            offset = max(0, indexed - first)
+            segment_scores = codec.scores(codes[offset:], query)
+            if len(segment_scores) > k:
+                best = np.argpartition(-segment_scores, k - 1)[:k]
+            else:
+                best = np.arange(len(segment_scores))
+            ids.append(best + first + offset)
+            scores.append(segment_scores[best])
+        if not ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        ids, scores = np.concatenate(ids), np.concatenate(scores)
+        order = np.argsort(-scores, kind='stable')[:k]
+        return ids[order], scores[order]
+
+    def lexical_search(self, query: str, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Positions and BM25 scores of the k chunks best matching the words of query, best first
+        """
+        expression = match_expression(query)
+        if expression is None or k <= 0 or not self.has_lexical_index:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        with closing(connect_chunks(self.path)) as db:
+            rows = db.execute('SELECT rowid, bm25(chunks_fts) FROM chunks_fts WHERE chunks_fts MATCH ? '
+                              'AND rowid < ? ORDER BY bm25(chunks_fts) LIMIT ?', (expression, len(self), k)).fetchall()
+        return (np.array([row[0] for row in rows], dtype=np.int64),
+                np.array([-row[1] for row in rows], dtype=np.float32))  # bm25() is lower for better matches
+
+    def build_lexical_index(self):
+        """
+        Indexes the chunks of a collection saved before lexical search existed
+        """
+        if self.has_lexical_index:
+            return
+        with collection_lock(self.path):
+            init_chunks(self.path)
+            with closing(connect_chunks(self.path)) as db:
+                last = -1
+                while True:
+                    rows = db.execute('SELECT id, text FROM chunks WHERE id > ? ORDER BY id LIMIT 1000', (last,)).fetchall()
+                    if not rows:
+                        break
+                    with db:
+                        db.execute('DELETE FROM chunks_fts WHERE rowid > ? AND rowid <= ?', (last, rows[-1][0]))
+                        db.executemany('INSERT INTO chunks_fts (rowid, terms) VALUES (?, ?)',
+                                       ((row[0], index_text(row[1])) for row in rows))
+                    last = rows[-1][0]
+            with open(self.path / COLLECTION_MANIFEST) as f:
+                manifest = json.load(f)
+            manifest['lexical'] = True
+            write_manifest(self.path, manifest)
+        self._load()
+
+    def documents(self, ids: Iterable[int]) -> List[Document]:
+        """
+        The chunks at these positions, in the same order
+        """
+        ids = [int(i) for i in ids]
+        if not ids:
+            return []
+        with closing(connect_chunks(self.path)) as db:
+            rows = db.execute(f"SELECT id, text, metadata FROM chunks WHERE id IN ({','.join('?' * len(ids))})",
+                              ids).fetchall()
+        found = {row[0]: Document(page_content=row[1], metadata=json.loads(row[2])) for row in rows}
+        return [found[i] for i in ids if i in found]
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4,
+                                               **kwargs) -> List[Tuple[Document, float]]:
+        ids, scores = self.search(np.asarray(embedding, dtype=np.float32), k)
+        return list(zip(self.documents(ids), scores.tolist()))
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self._embeddings.embed_query(query), k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs) -> List[Document]:
+        return self.similarity_search_by_vector(self._embeddings.embed_query(query), k)
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   path: Union[str, Path, None] = None, **kwargs) -> 'NativeCollection':
+        if path is None:
+            raise ValueError('A native collection needs a path')
+        collection = cls.create(path, embedding)
+        collection.add_texts(texts, metadatas)
+        collection.save_local()
+        return collection
+
+
+def segments_of(path: Path, manifest: Dict[str, Any]) -> List[Tuple[int, np.ndarray, Codec]]:
+    """
+    (position of the first chunk, memory mapped codes, codec) of every segment
+    """
+    segments = []
+    codecs = {}
+    for segment in manifest['segments']:
+        key = (segment.get('dtype', 'float32'), segment.get('codec'))
+        if key not in codecs:
+            codecs[key] = load_codec(path / COLLECTION_SEGMENTS, *key)
+        segments.append((segment['first'], np.load(path / COLLECTION_SEGMENTS / segment['name'], mmap_mode='r'),
+                         codecs[key]))
+    return segments
+
+
+def codec_for(path: Path, manifest: Dict[str, Any], vectors: np.ndarray) -> Codec:
+    """
+    Codec for new vectors. A quantizer is trained once the collection has enough vectors,
+    the segments stored in float32 until then are encoded again.
+    """
+    precision = manifest['dtype']
+    if not needs_training(precision) or manifest.get('codec'):
+        return load_codec(path / COLLECTION_SEGMENTS, precision, manifest.get('codec'))
+    if manifest['total'] + len(vectors) < TRAIN_MIN_VECTORS[precision]:
+        return FLOAT32
+    existing = SegmentView(segments_of(path, manifest), 0, manifest['total'])
+    codec = train_codec(precision, np.concatenate([existing[:], vectors]))
+    encode_segments(path, manifest, codec)
+    return codec
+
+
+class SegmentView:
+    """
+    Vectors of consecutive positions across segments, without copying them. Indexing returns an array.
+    """
+
+    def __init__(self, segments: List[Tuple[int, np.ndarray, Codec]], start: int, end: int):
+        self.segments = [segment for segment in segments if segment[0] < end and segment[0] + len(segment[1]) > start]
+        self.start = start
+        self.end = end
+        self.shape = (end - start, segments[0][2].decode(segments[0][1][:1]).shape[1] if segments else 0)
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def __getitem__(self, key: Union[slice, np.ndarray]) -> np.ndarray:
+        if isinstance(key, slice):
+            first, last, _ = key.indices(len(self))
+            parts = [codec.decode(codes[max(0, self.start + first - offset):max(0, self.start + last - offset)])
+                     for offset, codes, codec in self.segments]
+            return np.concatenate([p for p in parts if len(p)] or [np.empty((0, self.shape[1]), dtype=np.float32)])
+        positions = np.asarray(key, dtype=np.int64) + self.start
+        firsts = np.array([first for first, _, _ in self.segments], dtype=np.int64)
+        segment = np.searchsorted(firsts, positions, side='right') - 1
+        result = np.empty((len(positions), self.shape[1]), dtype=np.float32)
+        for i in np.unique(segment):
+            selected = segment == i
+            first, codes, codec = self.segments[i]
+            result[selected] = codec.decode(codes[positions[selected] - first])
+        return result
+
+
+@contextmanager
+def collection_lock(path: Path, shared: bool = False) -> Iterator[None]:
+    """
+    Serializes writers of a collection, across processes. A shared lock keeps writers out, not other readers.
+    """
+    with open(path / COLLECTION_LOCK, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def connect_chunks(path: Path) -> sqlite3.Connection:
+    return sqlite3.connect(path / COLLECTION_CHUNKS, timeout=30)
+
+
+def init_chunks(path: Path):
+    with closing(connect_chunks(path)) as db, db:
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, text TEXT NOT NULL, metadata TEXT NOT NULL)')
+        # words are split by rag.lexical, FTS5 only has to keep the underscores of identifiers
+        db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(terms, tokenize=\"unicode61 tokenchars '_'\")")
+
+
+def insert_chunks(path: Path, first: int, chunks: List[Tuple[str, Dict[str, Any]]]):
+    """
+    Stores chunks at positions first, first + 1, ... with their lexical index, in one transaction
+    """
+    init_chunks(path)  # the lexical index of collections saved before it existed
+    with closing(connect_chunks(path)) as db, db:
+        db.execute('DELETE FROM chunks WHERE id >= ?', (first,))  # left over by a crash before the manifest
+        db.execute('DELETE FROM chunks_fts WHERE rowid >= ?', (first,))
+        db.executemany('INSERT INTO chunks (id, text, metadata) VALUES (?, ?, ?)',
+                       ((first + i, text, json.dumps(metadata)) for i, (text, metadata) in enumerate(chunks)))
+        db.executemany('INSERT INTO chunks_fts (rowid, terms) VALUES (?, ?)',
+                       ((first + i, index_text(text)) for i, (text, _) in enumerate(chunks)))
+
+
+def write_manifest(path: Path, manifest: Dict[str, Any]):
+    tmp = path / f'{COLLECTION_MANIFEST}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path / COLLECTION_MANIFEST)
+
+
+def write_segment(path: Path, name: str, vectors: np.ndarray):
+    tmp = path / COLLECTION_SEGMENTS / f'{name}.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, vectors)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path / COLLECTION_SEGMENTS / name)
+
+
+def merge_segments(path: Path, manifest: Dict[str, Any], max_segments: int = MAX_SEGMENTS):
+    """
+    Merges the two adjacent segments of the same precision with the fewest chunks until there are at most max_segments
+    """
+    segments = manifest['segments']
+    while len(segments) > max(1, max_segments):
+        candidates = [j for j in range(len(segments) - 1)
+                      if segment_codec(segments[j]) == segment_codec(segments[j + 1])]
+        if not candidates:
+            break
+        i = min(candidates, key=lambda j: segments[j]['count'] + segments[j + 1]['count'])
+        left, right = segments[i], segments[i + 1]
+        vectors = np.concatenate([np.load(path / COLLECTION_SEGMENTS / left['name'], mmap_mode='r'),
+                                  np.load(path / COLLECTION_SEGMENTS / right['name'], mmap_mode='r')])
+        name = f"{manifest['next']:06d}.npy"
+        manifest['next'] += 1
+        write_segment(path, name, vectors)
+        segments[i:i + 2] = [dict(left, name=name, count=left['count'] + right['count'])]
+
+
+def segment_codec(segment: Dict[str, Any]) -> Tuple[str, Optional[str]]:
+    return segment.get('dtype', 'float32'), segment.get('codec')
+
+
+def encode_segments(path: Path, manifest: Dict[str, Any], codec: Codec):
+    """
+    Makes codec the one of the collection and writes every segment encoded otherwise again with it.
+    The previous codecs and segments are removed once the caller has written the manifest.
+    """
+    if needs_training(codec.precision):
+        codec.file = f"codec-{manifest['next']:06d}.npz"
+        manifest['next'] += 1
+        codec.save(path / COLLECTION_SEGMENTS / codec.file)
+    manifest.update(dtype=codec.precision, codec=codec.file)
+    for segment in manifest['segments']:
+        if segment_codec(segment) == (codec.precision, codec.file):
+            continue
+        codes = np.load(path / COLLECTION_SEGMENTS / segment['name'], mmap_mode='r')
+        previous = load_codec(path / COLLECTION_SEGMENTS, *segment_codec(segment))
+        encoded = np.concatenate([codec.encode(previous.decode(codes[first:first + 2**16]))
+                                  for first in range(0, len(codes), 2**16)])
+        name = f"{manifest['next']:06d}.npy"
+        manifest['next'] += 1
+        write_segment(path, name, encoded)
+        segment.update(name=name, dtype=codec.precision, codec=codec.file)
+
+
+def convert_precision(path: Union[str, Path], precision: str, codec: Optional[Codec] = None) -> Dict[str, Any]:
+    """
+    Encodes all the vectors of a collection in precision, with codec if it has been trained already.
+    Returns the bytes of vectors before and after.
+    """
+    path = Path(path)
+    with collection_lock(path):
+        with open(path / COLLECTION_MANIFEST) as f:
+            manifest = json.load(f)
+        segments = segments_of(path, manifest)
+        before = sum(codes.nbytes for _, codes, _ in segments)
+        if codec is None:
+            codec = train_codec(precision, SegmentView(segments, 0, manifest['total']))
+        encode_segments(path, manifest, codec)
+        write_manifest(path, manifest)
+        remove_unused_segments(path, manifest)
+    after = sum(codes.nbytes for _, codes, _ in segments_of(path, manifest))
+    return dict(precision=precision, bytes_before=before, bytes_after=after)
+
+
+def remove_unused_segments(path: Path, manifest: Dict[str, Any]):
+    """
+    Segments merged into others or encoded again, their codecs, or written by a save which crashed before its manifest.
+    Readers which still map them keep their data until they load the new manifest.
+    """
+    used = {segment['name'] for segment in manifest['segments']} | {manifest.get('codec')}
+    for name in os.listdir(path / COLLECTION_SEGMENTS):
+        if name not in used:
+            try:
+                os.remove(path / COLLECTION_SEGMENTS / name)
+            except FileNotFoundError:
+                pass
+
+
+def convert_legacy_collection(path: Union[str, Path], embeddings: Embeddings) -> NativeCollection:
+    """
+    Converts a collection saved by langchain FAISS (index.faiss and a pickled docstore) to the native format
+    """
+    path = Path(path)
+    from langchain_community.vectorstores.faiss import FAISS
+    os.makedirs(path / COLLECTION_SEGMENTS, exist_ok=True)
+    with collection_lock(path):
+        if is_legacy_collection(path):
+            index = FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)  # our own files
+            n_vectors = index.index.ntotal
+            vectors = index.index.reconstruct_n(0, n_vectors) if n_vectors else np.empty((0, 0), dtype=np.float32)
+            # noinspection PyProtectedMember,PyUnresolvedReferences
+            docs = [index.docstore._dict[index.index_to_docstore_id[i]] for i in range(n_vectors)]
+            init_chunks(path)
+            manifest = dict(dim=None, dtype='float32', codec=None, total=0, next=1, segments=[], lexical=True)
+            if n_vectors:
+                write_segment(path, '000001.npy', np.asarray(vectors, dtype=np.float32))
+                insert_chunks(path, 0, [(doc.page_content, doc.metadata) for doc in docs])
+                manifest.update(dim=int(vectors.shape[1]), total=n_vectors, next=2,
+                                segments=[dict(name='000001.npy', first=0, count=n_vectors)])
+            write_manifest(path, manifest)
+            for name in LEGACY_FILES:
+                os.remove(path / name)
+            logging.info(f'Converted collection {path} ({n_vectors} chunks) to the native format')
+    return NativeCollection(path, embeddings)
+
+
+def open_collection(path: Union[str, Path], embeddings: Embeddings) -> NativeCollection:
+    """
+    Opens a collection, converting it first if it is in the langchain FAISS format, or creates it
+    """
+    if is_legacy_collection(path):
+        return convert_legacy_collection(path, embeddings)
+    return NativeCollection.create(path, embeddings)
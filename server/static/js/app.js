@@ -92213,9 +92213,87 @@ ${text2}</tr>
         const fileInput = formElement.querySelector("#file");
         const parentDiv = fileInput.parentElement;
         const help = parentDiv.nextElementSibling;
+        if (uploadButton.dataset.job) {
+          fetch(`/upload/${uploadButton.dataset.job}/cancel`, { method: "post" });
+          return;
+        }
         const formData = new FormData(formElement);
         const chat = document.getElementById("chat");
+        const label = uploadButton.firstChild;
+        const labelText = label.textContent;
         uploadButton.disabled = true;
+        const showError = (message) => {
+          help.dataset.errorMessage = message;
+          help.classList.add("warning");
+        };
+        const uploaded = (jsonData) => {
+          document.location.hash = "";
+          renderMessage(formData.get("file").name, "me", chat, "file-icon", false);
+          if (jsonData["collection-visibility"]) {
+            const menuLink = document.getElementById("menuLink");
+            if (menuLink) {
+              const textNode = menuLink.firstChild;
+              textNode.textContent = jsonData["collection-name"];
+              const collectionType = jsonData["collection-visibility"] === "public" ? "common" : "user";
+              const subMenu = document.getElementById(`menu-collection-${collectionType}`);
+              if (subMenu) {
+                const button = document.createElement("a");
+                button.className = "mode-button";
+                button.href = "#";
+                button.textContent = jsonData["collection-name"];
+                button.id = jsonData["collection-name"];
+                subMenu.appendChild(button);
+                const url = new URL(window.location.href);
+                url.searchParams.set("collection", jsonData["collection-hashed-name"]);
+                history.replaceState({}, "", url);
+              }
+            }
+          }
+        };
+        const finished = () => {
+          delete uploadButton.dataset.job;
+          delete help.dataset.progressMessage;
+          label.textContent = labelText;
+          uploadButton.disabled = false;
+        };
+        const follow = (jobId) => {
+          uploadButton.dataset.job = jobId;
+          label.textContent = "Cancel ";
+          uploadButton.disabled = false;
+          const events = new EventSource(`/upload/${jobId}/events`);
+          events.onmessage = (event) => {
+            const job = JSON.parse(event.data);
+            const progress = job.progress;
+            if (job.state === "queued") {
+              help.dataset.progressMessage = "Waiting for other uploads";
+            } else if (job.state === "running" && progress.files_total !== void 0) {
+              let message = `${progress.files_done}/${progress.files_total} files`;
+              if (progress.chunks_embedded) {
+                message += `, ${progress.chunks_embedded} chunks`;
+              }
+              if (progress.eta !== void 0) {
+                message += `, about ${Math.ceil(progress.eta)}s left`;
+              }
+              help.dataset.progressMessage = message;
+            } else if (job.state === "done") {
+              uploaded(job.result);
+            } else if (job.state === "failed") {
+              showError(job.error);
+            } else if (job.state === "cancelled") {
+              showError("Upload cancelled");
+            }
+            if (["done", "failed", "cancelled"].indexOf(job.state) >= 0) {
+              events.close();
+              finished();
+            }
+          };
+          events.onerror = () => {
+            if (events.readyState === EventSource.CLOSED) {
+              help.classList.add("warning", "warning-file-upload-failed");
+              finished();
+            }
+          };
+        };
         fetch(
           "/upload",
           {
@@ -92231,45 +92309,25 @@ ${text2}</tr>
           console.log(jsonData);
           help.classList.remove("warning");
           if (jsonData.error) {
-            help.dataset.errorMessage = jsonData["error"];
-            help.classList.add("warning");
+            showError(jsonData["error"]);
+            finished();
           } else {
-            document.location.hash = "";
-            renderMessage(formData.get("file").name, "me", chat, "file-icon", false);
-            if (jsonData["collection-visibility"]) {
-              const menuLink = document.getElementById("menuLink");
-              if (menuLink) {
-                const textNode = menuLink.firstChild;
-                textNode.textContent = jsonData["collection-name"];
-                const collectionType = jsonData["collection-visibility"] === "public" ? "common" : "user";
-                const subMenu = document.getElementById(`menu-collection-${collectionType}`);
-                if (subMenu) {
-                  const button = document.createElement("a");
-                  button.className = "mode-button";
-                  button.href = "#";
-                  button.textContent = jsonData["collection-name"];
-                  button.id = jsonData["collection-name"];
-                  subMenu.appendChild(button);
-                  const url = new URL(window.location.href);
-                  url.searchParams.set("collection", jsonData["collection-hashed-name"]);
-                  history.replaceState({}, "", url);
-                }
-              }
-            }
+            follow(jsonData["job"]);
           }
         }).catch((_error) => {
           help.classList.add("warning", "warning-file-upload-failed");
-        }).finally(() => {
-          uploadButton.disabled = false;
+          finished();
         });
       });
     }
     const collectionSelector = document.getElementById("collection-selector");
     const collectionName = document.getElementById("collection-name");
     const collectionVisibility = document.getElementById("collection-visibility");
+    const collectionPrecision = document.getElementById("collection-precision");
     if (collectionSelector && collectionName && collectionVisibility) {
       const outerName = collectionName.closest(".block");
       const outerVisibility = collectionVisibility.closest(".block");
+      const outerPrecision = collectionPrecision?.closest(".block");
       const eventHandler = (event) => {
         if (event) {
           event.preventDefault();
@@ -92279,9 +92337,16 @@ ${text2}</tr>
           outerVisibility.className = "d-block";
           collectionName.value = "";
           collectionVisibility.checked = false;
+          if (outerPrecision && collectionPrecision) {
+            outerPrecision.className = "d-block";
+            collectionPrecision.value = "";
+          }
         } else {
           outerName.className = "d-none";
           outerVisibility.className = "d-none";
+          if (outerPrecision) {
+            outerPrecision.className = "d-none";
+          }
         }
       };
       collectionSelector.addEventListener("change", eventHandler);
@@ -92309,6 +92374,8 @@ ${text2}</tr>
     });
     view.dispatch(transaction);
   };
+  var historyItems = /* @__PURE__ */ new Map();
+  var historySince = null;
   var loadHistory = () => {
     const historyDiv = document.getElementById("history");
     historyDiv.innerHTML = "";
@@ -92392,10 +92459,24 @@ ${text2}</tr>
     };
     const index = document.location.pathname.indexOf("/c/");
     let url = "/history";
-    if (index >= 0) {
+    if (historySince !== null) {
+      url += `?since=${historySince}`;
+    } else if (index >= 0) {
       url += "/" + document.location.pathname.slice(index + 3);
     }
-    fetch(url).then((r) => r.json()).then(setHistory);
+    fetch(url).then((r) => {
+      historySince = r.headers.get("X-History-Since");
+      return r.json();
+    }).then((changes) => {
+      changes.forEach((item) => {
+        if (item.deleted) {
+          historyItems.delete(item.url);
+        } else {
+          historyItems.set(item.url, item);
+        }
+      });
+      setHistory(Array.from(historyItems.values()).sort((a, b) => b.updated_at - a.updated_at));
+    });
   };
   var findLastCodeCanvasBlock = (text2) => {
     let stack = [];
@@ -92454,18 +92535,21 @@ ${text2}</tr>
   }
   var getAllChunks = (input) => {
     let allResponses = [];
-    let buffer;
-    let candidate = "";
-    for (let i = 0; i < input.length; i++) {
-      candidate += input[i];
-      try {
-        const parsed = JSON.parse(candidate);
-        allResponses.push(parsed);
-        candidate = "";
-      } catch (e) {
+    let start = 0;
+    let end = input.indexOf("\n\n");
+    while (end >= 0) {
+      const frame = input.substring(start, end);
+      if (frame.startsWith("data: ")) {
+        try {
+          allResponses.push(JSON.parse(frame.substring(6)));
+        } catch (e) {
+          console.log("Could not parse frame: " + frame);
+        }
       }
+      start = end + 2;
+      end = input.indexOf("\n\n", start);
     }
-    buffer = candidate;
+    const buffer = input.substring(start);
     return { allResponses, buffer };
   };
   function getInputHandler(inputElement) {
@@ -92497,6 +92581,11 @@ ${text2}</tr>
         if (stopButton) {
           stopButton.addEventListener("click", (e2) => {
             e2.preventDefault();
+            const index = document.location.pathname.indexOf("/c/");
+            if (index >= 0) {
+              fetch(`/cancel/${document.location.pathname.slice(index + 3)}`, { method: "POST" }).catch(() => {
+              });
+            }
             xhr.abort();
             stopButton.disabled = true;
             inputElement.contentEditable = "true";
@@ -92681,7 +92770,6 @@ ${text2}</tr>
           flushList.forEach((item) => flushQueue.push(item));
           scheduleFlush();
         };
-        let ccindex = 0;
         let lastIndex = 0;
         let chunkBuffer = "";
         xhr.onprogress = function() {
@@ -92689,10 +92777,6 @@ ${text2}</tr>
           lastIndex = xhr.responseText.length;
           chunkBuffer += newData;
           const { allResponses, buffer } = getAllChunks(chunkBuffer);
-          if (allResponses.length > 0) {
-            let s = JSON.stringify(allResponses);
-            ccindex += s.length;
-          }
           for (let i = 0; i < allResponses.length; i++) {
             const chunk = allResponses[i];
             if (!chunk || !chunk.choices) {
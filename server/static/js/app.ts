@@ -385,10 +385,96 @@ const setupUploadButton = () => {
             const parentDiv = fileInput.parentElement!;
             const help = parentDiv.nextElementSibling! as HTMLElement;
 
+            if (uploadButton.dataset.job) {  // a job is running, the button cancels it
+                fetch(`/upload/${uploadButton.dataset.job}/cancel`, {method: "post"})
+                return;
+            }
+
             // Create a new FormData object
             const formData = new FormData(formElement);
             const chat = document.getElementById('chat')!;
+            const label = uploadButton.firstChild!;
+            const labelText = label.textContent;
             uploadButton.disabled = true;
+
+            const showError = (message: string) => {
+                help.dataset.errorMessage = message
+                help.classList.add('warning')
+            }
+            const uploaded = (jsonData: any) => {
+                document.location.hash = ''
+                renderMessage((formData.get('file') as any).name, "me", chat, 'file-icon', false);
+
+                if (jsonData['collection-visibility']) {
+                    const menuLink = document.getElementById('menuLink');
+                    if (menuLink) {
+                        const textNode = menuLink.firstChild! as HTMLElement;
+                        textNode.textContent = jsonData['collection-name'];
+                        const collectionType = jsonData['collection-visibility'] === 'public' ? 'common' : 'user'
+                        const subMenu = document.getElementById(`menu-collection-${collectionType}`)
+                        if (subMenu) {
+                            const button = document.createElement('a')
+                            button.className = 'mode-button'
+                            button.href = '#';
+                            button.textContent = jsonData['collection-name'];
+                            button.id = jsonData['collection-name'];
+                            subMenu.appendChild(button);
+                            // Get the current URL
+                            const url = new URL(window.location.href);
+                            // Update the search parameter
+                            url.searchParams.set('collection', jsonData['collection-hashed-name']);
+                            // Change the location object without reloading the page
+                            history.replaceState({}, '', url);
+                        }
+                    }
+                }
+            }
+            const finished = () => {
+                delete uploadButton.dataset.job;
+                delete help.dataset.progressMessage;
+                label.textContent = labelText;
+                uploadButton.disabled = false;
+            }
+            // the upload is ingested in the background, follow its progress until it is finished
+            const follow = (jobId: string) => {
+                uploadButton.dataset.job = jobId;
+                label.textContent = 'Cancel ';
+                uploadButton.disabled = false;
+                const events = new EventSource(`/upload/${jobId}/events`);
+                events.onmessage = (event) => {
+                    const job = JSON.parse(event.data);
+                    const progress = job.progress;
+                    if (job.state === 'queued') {
+                        help.dataset.progressMessage = 'Waiting for other uploads';
+                    } else if (job.state === 'running' && progress.files_total !== undefined) {
+                        let message = `${progress.files_done}/${progress.files_total} files`;
+                        if (progress.chunks_embedded) {
+                            message += `, ${progress.chunks_embedded} chunks`;
+                        }
+                        if (progress.eta !== undefined) {
+                            message += `, about ${Math.ceil(progress.eta)}s left`;
+                        }
+                        help.dataset.progressMessage = message;
+                    } else if (job.state === 'done') {
+                        uploaded(job.result);
+                    } else if (job.state === 'failed') {
+                        showError(job.error);
+                    } else if (job.state === 'cancelled') {
+                        showError('Upload cancelled');
+                    }
+                    if (['done', 'failed', 'cancelled'].indexOf(job.state) >= 0) {
+                        events.close();
+                        finished();
+                    }
+                };
+                events.onerror = () => {
+                    if (events.readyState === EventSource.CLOSED) {
+                        help.classList.add('warning', 'warning-file-upload-failed')
+                        finished();
+                    }
+                };
+            }
+
             fetch("/upload",
                 {
                     body: formData,
@@ -403,44 +489,16 @@ const setupUploadButton = () => {
                 console.log(jsonData);
                 help.classList.remove('warning')
                 if (jsonData.error) {
-                    help.dataset.errorMessage = jsonData['error']
-                    help.classList.add('warning')
-                } else { // all set
-                    document.location.hash = ''
-                    renderMessage((formData.get('file') as any).name, "me", chat, 'file-icon', false);
-
-                    if (jsonData['collection-visibility']) {
-                        const menuLink = document.getElementById('menuLink');
-                        if (menuLink) {
-                            const textNode = menuLink.firstChild! as HTMLElement;
-                            textNode.textContent = jsonData['collection-name'];
-                            const collectionType = jsonData['collection-visibility'] === 'public' ? 'common' : 'user'
-                            const subMenu = document.getElementById(`menu-collection-${collectionType}`)
-                            if (subMenu) {
-                                const button = document.createElement('a')
-                                button.className = 'mode-button'
-                                button.href = '#';
-                                button.textContent = jsonData['collection-name'];
-                                button.id = jsonData['collection-name'];
-                                subMenu.appendChild(button);
-                                // Get the current URL
-                                const url = new URL(window.location.href);
-                                // Update the search parameter
-                                url.searchParams.set('collection', jsonData['collection-hashed-name']);
-                                // Change the location object without reloading the page
-                                history.replaceState({}, '', url);
-                            }
-                        }
-                    }
-
+                    showError(jsonData['error'])
+                    finished();
+                } else {
+                    follow(jsonData['job']);
                 }
             })
                 .catch((_error) => {
                     // Handle errors or display a message to the user
                     help.classList.add('warning', 'warning-file-upload-failed')
-                })
-                .finally(() => {
-                    uploadButton.disabled = false;
+                    finished();
                 });
         })
     }
@@ -448,10 +506,12 @@ const setupUploadButton = () => {
     const collectionSelector = document.getElementById('collection-selector') as HTMLSelectElement;
     const collectionName = document.getElementById('collection-name') as HTMLInputElement;
     const collectionVisibility = document.getElementById('collection-visibility') as HTMLInputElement;
+    const collectionPrecision = document.getElementById('collection-precision') as HTMLSelectElement | null;
 
     if (collectionSelector && collectionName && collectionVisibility) {
         const outerName = collectionName.closest('.block')!;
         const outerVisibility = collectionVisibility.closest('.block')!;
+        const outerPrecision = collectionPrecision?.closest('.block');
         const eventHandler = (event?: Event) => {
             if (event) {
                 event.preventDefault();
@@ -461,9 +521,16 @@ const setupUploadButton = () => {
                 outerVisibility.className = 'd-block';
                 collectionName.value = "";
                 collectionVisibility.checked = false;
+                if (outerPrecision && collectionPrecision) {
+                    outerPrecision.className = 'd-block';
+                    collectionPrecision.value = "";
+                }
             } else {
                 outerName.className = 'd-none'
                 outerVisibility.className = 'd-none'
+                if (outerPrecision) {
+                    outerPrecision.className = 'd-none';
+                }
             }
         }
         collectionSelector.addEventListener('change', eventHandler)
@@ -501,27 +568,34 @@ const replaceLine = (view: EditorView, lineNumber: number, newText: string) => {
     view.dispatch(transaction);
 };
 
+type Metadata = {
+    file: string
+}
+type Message = {
+    collection: string;
+    metadata: Array<Metadata>;
+    role: string;
+    content: string;
+}
+
+type HistoryItem = {
+    url: string;
+    title: string;
+    items: Array<Message>;
+    assistant: string;
+    user: string;
+    age: string;
+    updated_at: number;
+    deleted?: boolean
+};
+type HistoryItems = HistoryItem[];
+
+// conversations shown in the sidebar, after the first load only the changes are fetched
+const historyItems = new Map<string, HistoryItem>();
+let historySince: string | null = null;
+
 // load history and render it in the sidebar
 const loadHistory = () => {
-    type Metadata = {
-        file: string
-    }
-    type Message = {
-        collection: string;
-        metadata: Array<Metadata>;
-        role: string;
-        content: string;
-    }
-
-    type HistoryItem = {
-        url: string;
-        title: string;
-        items: Array<Message>;
-        assistant: string;
-        user: string;
-        age: string
-    };
-    type HistoryItems = HistoryItem[];
     const historyDiv = document.getElementById('history') as HTMLUListElement;
     historyDiv.innerHTML = "";
     const setHistory = (items: HistoryItems) => {
@@ -623,10 +697,24 @@ const loadHistory = () => {
     }
     const index = document.location.pathname.indexOf('/c/')
     let url = '/history'
-    if (index >= 0) {
+    if (historySince !== null) {
+        url += `?since=${historySince}`
+    } else if (index >= 0) {
         url += '/' + document.location.pathname.slice(index + 3)  // 3 is length of '/c/'
     }
-    fetch(url).then((r) => r.json()).then(setHistory)
+    fetch(url).then((r) => {
+        historySince = r.headers.get('X-History-Since');
+        return r.json()
+    }).then((changes: HistoryItems) => {
+        changes.forEach(item => {
+            if (item.deleted) {
+                historyItems.delete(item.url);
+            } else {
+                historyItems.set(item.url, item);
+            }
+        })
+        setHistory(Array.from(historyItems.values()).sort((a, b) => b.updated_at - a.updated_at))
+    })
 };
 
 // this finds the last codecanvas block and renders it in the editor
@@ -713,30 +801,27 @@ const KNOWN_MARKERS = ["<codecanvas>", "</codecanvas>", "<think>", "</think>"];
 function isPotentialMarker(bufferStr: Array<string>) {
     return KNOWN_MARKERS.some(marker => marker.startsWith(bufferStr.join("")));
 }
-// get all valid chunks from partial xhr responses
+// get all complete frames ("data: {...}\n\n") from partial xhr responses, each frame is parsed exactly once
 const getAllChunks = (input: string) => {
     let allResponses = [];
-    let buffer: string;
-    let candidate = "";
-
-    for (let i = 0; i < input.length; i++) {
-        candidate += input[i];
-        try {
-            const parsed = JSON.parse(candidate);
-
-            // If we parsed successfully, store it
-            allResponses.push(parsed);
-
-            // Reset candidate
-            candidate = "";
-        } catch (e) {
-            // If parsing fails, keep accumulating
-            // do nothing, just continue
+    let start = 0;
+    let end = input.indexOf('\n\n');
+
+    while (end >= 0) {
+        const frame = input.substring(start, end);
+        if (frame.startsWith('data: ')) {
+            try {
+                allResponses.push(JSON.parse(frame.substring(6)));
+            } catch (e) {
+                console.log('Could not parse frame: ' + frame);
+            }
         }
+        start = end + 2;
+        end = input.indexOf('\n\n', start);
     }
 
-    // Whatever remains in candidate is incomplete JSON
-    buffer = candidate;
+    // Whatever follows the last delimiter is an incomplete frame
+    const buffer = input.substring(start);
     return {allResponses, buffer};
 };
 
@@ -777,6 +862,11 @@ function getInputHandler(inputElement: HTMLElement) {
             if (stopButton) {
                 stopButton.addEventListener('click', (e) => {
                     e.preventDefault();
+                    // ask the server to stop generating, this frees the llama-server slot right away
+                    const index = document.location.pathname.indexOf('/c/')
+                    if (index >= 0) {
+                        fetch(`/cancel/${document.location.pathname.slice(index + 3)}`, {method: 'POST'}).catch(() => {})
+                    }
                     xhr.abort();
                     stopButton.disabled = true;
                     inputElement.contentEditable = "true";
@@ -1069,11 +1159,9 @@ function getInputHandler(inputElement: HTMLElement) {
                 scheduleFlush();
             };
 
-            let ccindex = 0
-
             // A variable to store how many characters we've processed from the raw response
             let lastIndex = 0;
-            // A buffer string for partial JSON data that hasn't yet formed a valid chunk
+            // A buffer string for a partial frame that hasn't been terminated yet
             let chunkBuffer = "";
 
             // The rest of your XHR logic:
@@ -1085,14 +1173,9 @@ function getInputHandler(inputElement: HTMLElement) {
                 // 2) Accumulate into our buffer
                 chunkBuffer += newData;
 
-                // 3) Try to parse out as many JSON objects as we can
+                // 3) Parse all complete frames
                 const {allResponses, buffer} = getAllChunks(chunkBuffer);// console.log(allChunks)
 
-                if (allResponses.length > 0) {
-                    let s = JSON.stringify(allResponses);
-                    ccindex += s.length // enclosing
-                }
-
                 // for (let i = 0; i < allResponses.length; i++) {
                 //     const chunk = allResponses[i];
                 //     if (!chunk || !chunk.choices) {
@@ -1140,7 +1223,7 @@ function getInputHandler(inputElement: HTMLElement) {
                         }
                     }
 
-                    // 5) Keep any leftover partial JSON in chunkBuffer
+                    // 5) Keep any leftover partial frame in chunkBuffer
                     //    (which is the ‘buffer’ value returned by getAllChunks)
                     chunkBuffer = buffer;
                     updateScrollButton();
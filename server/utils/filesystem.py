@@ -4,10 +4,22 @@ import logging
 import os
 import tarfile
 from pathlib import Path
-from typing import List, Union
+from typing import List, Union, NamedTuple, Tuple
 import magic
 import zipfile
 
+FILE_HEADER_BYTES = 64 * 1024  # what libmagic gets to see of a file, enough for every type handled below
+ARCHIVE_MIME_TYPES = ['application/x-tar', 'application/gzip', 'application/zip']
+ARCHIVE_EXTENSIONS = ['.tar', '.tar.gz', '.tar.bz', '.zip']
+
+MAGIC = magic.Magic(mime=True, mime_encoding=True)  # thread safe, python-magic serializes the calls
+
+
+class FileType(NamedTuple):
+    kind: str  # pdf, archive, source, json, text, sqlite or unknown
+    mime: str
+    encoding: str  # as reported by libmagic, e.g. utf-8, us-ascii, binary
+
 
 def find_files(directory: str, extension: str) -> List[str]:
     result = []
@@ -26,10 +38,48 @@ def list_directories(directory: Union[str, Path]) -> List[str]:
     return result
 
 
-def get_mime_type(filename: str) -> str:
+def read_header(filename: str) -> bytes:
     with open(filename, 'rb') as f:
-        mime = magic.from_buffer(f.read(), mime=True)
-        return mime
+        return f.read(FILE_HEADER_BYTES)
+
+
+def sniff(filename: str) -> Tuple[str, str]:
+    """
+    (mime type, encoding) of a file, from its first FILE_HEADER_BYTES
+    """
+    mime, _, encoding = MAGIC.from_buffer(read_header(filename)).partition('; charset=')
+    return mime, encoding
+
+
+def classify_file(filename: str) -> FileType:
+    """
+    Type of an uploaded file, reads the header of the file once.
+    The kinds are checked in the order the upload handles them, e.g. a .json file is a source file.
+    """
+    try:
+        mime, encoding = sniff(filename)
+    except OSError as e:
+        logging.error(f"Error occurred while checking file type: {e}")
+        return FileType('unknown', '', '')
+    if "application/pdf" in mime:
+        kind = 'pdf'
+    elif mime in ARCHIVE_MIME_TYPES or os.path.splitext(filename)[1] in ARCHIVE_EXTENSIONS:
+        kind = 'archive'
+    elif is_source_code_file(filename):
+        kind = 'source'
+    elif 'application/json' in mime or 'application/javascript' in mime:
+        kind = 'json'
+    elif mime.startswith("text/"):
+        kind = 'text'
+    elif 'application/vnd.sqlite3' in mime or 'application/x-sqlite3' in mime:
+        kind = 'sqlite'
+    else:
+        kind = 'unknown'
+    return FileType(kind, mime, encoding)
+
+
+def get_mime_type(filename: str) -> str:
+    return sniff(filename)[0]
 
 
 def is_source_code_file(filename: str) -> bool:
@@ -50,8 +100,7 @@ def is_source_code_file(filename: str) -> bool:
 
 def is_json(filename: str) -> bool:
     try:
-        with open(filename, 'rb') as f:
-            mime = magic.from_buffer(f.read(), mime=True)
+        mime = get_mime_type(filename)
         return 'application/json' in mime or 'application/javascript' in mime
     except Exception as e:
         logging.error(f"Error occurred while checking file type: {e}")
@@ -60,8 +109,7 @@ def is_json(filename: str) -> bool:
 
 def is_sqlite(filename: str) -> bool:
     try:
-        with open(filename, 'rb') as f:
-            mime = magic.from_buffer(f.read(), mime=True)
+        mime = get_mime_type(filename)
         return 'application/vnd.sqlite3' in mime or 'application/x-sqlite3' in mime
     except Exception as e:
         logging.error(f"Error occurred while checking file type: {e}")
@@ -70,8 +118,7 @@ def is_sqlite(filename: str) -> bool:
 
 def is_text_file(filename: str) -> bool:
     try:
-        with open(filename, 'rb') as f:
-            mime = magic.from_buffer(f.read(), mime=True)
+        mime = get_mime_type(filename)
         return mime.startswith("text/")
     except Exception as e:
         logging.error(f"Error occurred while checking file type: {e}")
@@ -80,8 +127,7 @@ def is_text_file(filename: str) -> bool:
 
 def is_pdf(filename: str) -> bool:
     try:
-        with open(filename, 'rb') as f:
-            mime = magic.from_buffer(f.read(), mime=True)
+        mime = get_mime_type(filename)
         return "application/pdf" in mime
     except Exception as e:
         logging.error(f"Error occurred while checking file type: {e}")
@@ -92,20 +138,7 @@ def is_archive(filename: str) -> bool:
     # Check if the file exists
     if not os.path.isfile(filename):
         return False
-
-    # Create a Magic object
-    mime = magic.Magic(mime=True)
-
-    # Get the MIME type of the file
-    mime_type = mime.from_file(filename)
-
-    if mime_type in ['application/x-tar', 'application/gzip', 'application/zip']:
-        return True
-
-    if os.path.splitext(filename)[1] in ['.tar', '.tar.gz', '.tar.bz', '.zip']:
-        return True
-
-    return False
+    return classify_file(filename).kind == 'archive'
 
 
 def extract_archive(filename: str, destination: str) -> bool:
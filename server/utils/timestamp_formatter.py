@@ -1,4 +1,13 @@
 import datetime
+from typing import Tuple, Optional
+
+AGE_DAYS = {
+    "Today": (0, 0),
+    "Yesterday": (1, 1),
+    "Last week": (2, 7),
+    "Last month": (8, 30),
+    "Older": (31, None),
+}
 
 
 def categorize_timestamp(timestamp: float):
@@ -17,3 +26,14 @@ def categorize_timestamp(timestamp: float):
         return "Last month"
     else:
         return "Older"
+
+
+def timestamp_range(age: str) -> Tuple[Optional[float], Optional[float]]:
+    """
+    (after, until) of the timestamps which categorize_timestamp puts into age
+    """
+    first_day, last_day = AGE_DAYS[age]
+    now = datetime.datetime.now().timestamp()
+    after = now - (last_day + 1) * 86400 if last_day is not None else None
+    until = now - first_day * 86400
+    return after, until
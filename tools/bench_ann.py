@@ -0,0 +1,76 @@
+"""
+Recall against latency of the ANN index types, on a collection or on synthetic clustered vectors.
+For every configuration the index is built, then its search parameter is swept on queries sampled from the
+collection, the exact search being the reference. Quantized indexes are measured with the exact rescoring of
+their hits, as collections search them. The row marked * is what the builder would choose.
+
+    PYTHONPATH=server python3 tools/bench_ann.py [collection directory | number of vectors] [index type ...]
+
+index types as in config.json, e.g. flat hnsw ivf hnsw:sq8 ivf:sq8 ivf:pq (default all of them)
+"""
+import sys
+import time
+
+import faiss
+import numpy as np
+
+from rag.ann import choose_factory, sample_queries, exact_neighbours, tune, add_in_blocks, refine_factor, ANN_EVAL_K, \
+    ANN_TARGET_RECALL, ANN_TRAIN_POINTS_PER_LIST
+
+DEFAULT_TYPES = ['flat', 'hnsw', 'hnsw:sq8', 'ivf', 'ivf:sq8', 'ivf:pq']
+
+
+def synthetic_vectors(n: int, dim: int = 1024, clusters: int = 1000, seed: int = 0) -> np.ndarray:
+    """
+    Normalized vectors around random centers, closer to real embeddings than uniform noise
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(clusters, size=n)] + rng.standard_normal((n, dim)).astype(np.float32) * 1.5
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def load_vectors(argument: str):
+    if argument.isdigit():
+        return synthetic_vectors(int(argument))
+    from rag.store import NativeCollection
+    collection = NativeCollection(argument, None)
+    return collection.vectors()
+
+
+def main():
+    vectors = load_vectors(sys.argv[1] if len(sys.argv) > 1 else '100000')
+    types = sys.argv[2:] or DEFAULT_TYPES
+    n, dim = vectors.shape
+    queries = sample_queries(vectors)
+    start = time.perf_counter()
+    truth = exact_neighbours(vectors, queries, ANN_EVAL_K)
+    exact_ms = (time.perf_counter() - start) / len(queries) * 1000
+    print(f'{n} vectors of {dim} dimensions, {len(queries)} queries, recall@{ANN_EVAL_K}, '
+          f'target {ANN_TARGET_RECALL}, exact search {exact_ms:.2f} ms/query')
+    print(f'{"index":<16} {"build":>8} {"bytes/vec":>9} {"param":>10} {"recall":>7} {"ms/query":>9}')
+    for index_type in types:
+        kind, _, quantizer = index_type.partition(':')
+        factory = choose_factory(dict(type=kind, quantizer=quantizer or 'none'), n, dim) or 'Flat'
+        start = time.perf_counter()
+        index = faiss.index_factory(dim, factory, faiss.METRIC_INNER_PRODUCT)
+        if not index.is_trained:
+            ivf = faiss.try_extract_index_ivf(index)
+            n_train = min(n, max(ANN_TRAIN_POINTS_PER_LIST * (ivf.nlist if ivf is not None else 256), 2**16))
+            index.train(np.asarray(vectors[np.sort(np.random.default_rng(0).choice(n, n_train, replace=False))],
+                                   dtype=np.float32))
+        add_in_blocks(index, vectors, 0)
+        build_seconds = time.perf_counter() - start
+        size = len(faiss.serialize_index(index)) / n
+        result = tune(index, vectors, queries, truth, refine_factor(factory), target_recall=2.0)  # sweeps all the values
+        measurements = result['measurements']
+        chosen = next((m for m in measurements if m['recall'] >= ANN_TARGET_RECALL),
+                      max(measurements, key=lambda m: m['recall']))
+        for m in measurements:
+            mark = '*' if m is chosen else ' '
+            print(f'{factory:<16} {build_seconds:7.1f}s {size:9.0f} {result["parameter"] or "-":>7}={m["value"] or "":<3}'
+                  f'{m["recall"]:7.3f} {m["latency_ms"]:8.3f}{mark}')
+
+
+if __name__ == '__main__':
+    main()
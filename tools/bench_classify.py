@@ -0,0 +1,101 @@
+"""
+Time to classify uploads of mixed types and sizes, the previous checks against classify_file.
+The previous checks handed the whole file to libmagic, once per check.
+
+    PYTHONPATH=server python3 tools/bench_classify.py [size in MB]
+"""
+import io
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import zipfile
+from typing import Callable, Dict, List
+
+import magic
+
+from utils.filesystem import classify_file, is_source_code_file
+
+REPEAT = 3
+
+
+def make_corpus(directory: str, size: int) -> List[str]:
+    line = b'The quick brown fox jumps over the lazy dog, again and again and again.\n'
+    paths = {
+        'notes.txt': line * (size // len(line)),
+        'data.json': json.dumps([dict(id=i, text='lorem ipsum dolor sit amet') for i in range(size // 40)]).encode(),
+        'module.py': b'def f(x):\n    return x * 2\n\n' * (size // 30),
+        'paper.pdf': b'%PDF-1.7\n' + b'0' * size,
+        'blob.bin': os.urandom(size),
+    }
+    result = []
+    for name, data in paths.items():
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        result.append(path)
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_STORED) as z:
+        z.writestr('notes.txt', paths['notes.txt'])
+    path = os.path.join(directory, 'upload.zip')
+    with open(path, 'wb') as f:
+        f.write(archive.getvalue())
+    result.append(path)
+    path = os.path.join(directory, 'app.sqlite')
+    with sqlite3.connect(path) as db:
+        db.execute('CREATE TABLE t (x TEXT)')
+        db.executemany('INSERT INTO t VALUES (?)', [('x' * 1000,)] * (size // 1000))
+    result.append(path)
+    return result
+
+
+def previous_checks(filename: str) -> str:
+    # What the upload did before: is_archive, then is_pdf, is_source_code_file, is_json, is_text_file, is_sqlite
+    def mime_of_whole_file() -> str:
+        with open(filename, 'rb') as f:
+            return magic.from_buffer(f.read(), mime=True)
+    if magic.Magic(mime=True).from_file(filename) in ['application/x-tar', 'application/gzip', 'application/zip']:
+        return 'archive'
+    if 'application/pdf' in mime_of_whole_file():
+        return 'pdf'
+    if is_source_code_file(filename):
+        return 'source'
+    mime = mime_of_whole_file()
+    if 'application/json' in mime or 'application/javascript' in mime:
+        return 'json'
+    if mime_of_whole_file().startswith('text/'):
+        return 'text'
+    mime = mime_of_whole_file()
+    if 'application/vnd.sqlite3' in mime or 'application/x-sqlite3' in mime:
+        return 'sqlite'
+    mime_of_whole_file()  # get_mime_type for the error message
+    return 'unknown'
+
+
+def measure(classify: Callable[[str], str], paths: List[str]) -> Dict[str, float]:
+    timings = {}
+    for path in paths:
+        start = time.perf_counter()
+        for _ in range(REPEAT):
+            classify(path)
+        timings[path] = (time.perf_counter() - start) / REPEAT
+    return timings
+
+
+def main():
+    size = int(float(sys.argv[1]) * 2 ** 20) if len(sys.argv) > 1 else 50 * 2 ** 20
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_corpus(directory, size)
+        previous = measure(previous_checks, paths)
+        current = measure(lambda p: classify_file(p).kind, paths)
+        print(f'{"file":<12} {"size":>8} {"kind":<8} {"previous":>10} {"classify":>10}')
+        for path in paths:
+            print(f'{os.path.basename(path):<12} {os.path.getsize(path) / 2 ** 20:6.1f}MB {classify_file(path).kind:<8} '
+                  f'{previous[path] * 1000:8.1f}ms {current[path] * 1000:8.2f}ms')
+        print(f'{"total":<30} {sum(previous.values()) * 1000:8.1f}ms {sum(current.values()) * 1000:8.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Per token overhead of relaying the llama-server event stream, for growing outputs.
+The relay should cost the same per token for the first and the last thousand tokens.
+
+    PYTHONPATH=server python3 tools/bench_relay.py
+"""
+import json
+import time
+from typing import List
+
+from llama_cpp.stream import StreamRelay
+
+WINDOW = 1000
+
+
+def make_lines(n_tokens: int, n_tool_tokens: int) -> List[bytes]:
+    lines = [b'data: ' + json.dumps(dict(choices=[dict(index=0, delta=dict(role='assistant'))])).encode()]
+    for i in range(n_tokens):
+        chunk = dict(choices=[dict(index=0, finish_reason=None, delta=dict(content=f' word{i}'))],
+                     created=1751355925, id='chatcmpl-bench', model='bench', object='chat.completion.chunk')
+        lines.append(b'data: ' + json.dumps(chunk).encode())
+    arguments = json.dumps(dict(location='x' * n_tool_tokens))
+    for i, part in enumerate(arguments):  # tool call arguments streamed one character per chunk
+        function = dict(name='get_current_weather', arguments=part) if i == 0 else dict(arguments=part)
+        chunk = dict(choices=[dict(index=0, finish_reason=None, delta=dict(tool_calls=[dict(index=0, function=function)]))],
+                     object='chat.completion.chunk')
+        lines.append(b'data: ' + json.dumps(chunk).encode())
+    lines.append(b'data: [DONE]')
+    return lines
+
+
+def previous_relay(lines: List[bytes], timings: List[float]):
+    # What generate() did before: every chunk kept, membership test against all tool call chunks
+    responses = []
+    tool_calls = []
+    for line in lines:
+        start = time.perf_counter()
+        response = line.decode('utf-8')[6:]
+        if response != '[DONE]':
+            parsed_response = json.loads(response)
+            if 'tool_calls' in parsed_response['choices'][0]['delta']:
+                tool_calls.append(parsed_response)
+            if parsed_response not in tool_calls:
+                responses.append(parsed_response)
+        timings.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    "".join([a['choices'][0]['delta'].get('content', '') or "" for a in responses if 'embedding' not in a]).strip()
+    timings[-1] += time.perf_counter() - start
+
+
+def stream_relay(lines: List[bytes], timings: List[float]):
+    relay = StreamRelay()
+    for line in lines:
+        start = time.perf_counter()
+        relay.feed(line)
+        timings.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    relay.output()
+    relay.tool_call()
+    timings[-1] += time.perf_counter() - start
+
+
+def report(name: str, timings: List[float]):
+    windows = [timings[i:i + WINDOW] for i in range(0, len(timings) - WINDOW + 1, WINDOW)]
+    per_token = [1e6 * sum(w) / len(w) for w in windows]
+    print(f'  {name:<10} first {per_token[0]:6.2f} us/token, last {per_token[-1]:6.2f} us/token, '
+          f'max {max(per_token):6.2f} us/token, total {sum(timings) * 1000:8.1f} ms')
+
+
+def main():
+    for n_tokens in [10000, 20000, 40000]:
+        lines = make_lines(n_tokens, n_tool_tokens=n_tokens // 4)
+        print(f'{n_tokens} content tokens + {n_tokens // 4} tool call tokens ({len(lines)} chunks)')
+        for name, relay in [('previous', previous_relay), ('relay', stream_relay)]:
+            timings = []
+            relay(lines, timings)
+            report(name, timings)
+
+
+if __name__ == '__main__':
+    main()
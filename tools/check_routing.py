@@ -0,0 +1,104 @@
+"""
+Checks the llama-server routing against mock servers: free slots, sticky chats, failover and the release of the slot
+of a completion cancelled before llama-server answered.
+
+    PYTHONPATH=server python3 tools/check_routing.py
+"""
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Tuple
+
+from llama_cpp.aio import AsyncBackendClients
+from llama_cpp.backends import BackendPool
+
+
+def start_mock(slots: int, delay: float = 0.02) -> Tuple[str, subprocess.Popen]:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    script = os.path.join(os.path.dirname(__file__), 'mock_llama_server.py')
+    process = subprocess.Popen([sys.executable, script, '--port', str(port), '--slots', str(slots), '--delay', str(delay)],
+                               stdout=subprocess.DEVNULL)
+    for _ in range(100):  # wait until it listens
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    return f'http://127.0.0.1:{port}', process
+
+
+def complete(pool: BackendPool, token: str, text: str):
+    response, lease = pool.post_completion(token, dict(messages=[dict(role='user', content=text)]), stream=True)
+    try:
+        for _ in response.iter_lines():
+            pass
+    finally:
+        response.close()
+        lease.release()
+    return lease.backend.base_url, lease.id_slot
+
+
+async def cancel_while_sending(clients: AsyncBackendClients):
+    async def chat():
+        async with clients.stream_completion('cancelled', dict(messages=[dict(role='user', content='stop')])):
+            pass
+
+    task = asyncio.create_task(chat())
+    await asyncio.sleep(0.3)  # the mock is still processing the prompt
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    await clients.aclose()
+
+
+def main():
+    mocks = dict([start_mock(slots=2), start_mock(slots=2)])
+    pool = BackendPool(list(mocks.keys()))
+    pool.poll()
+
+    # Four concurrent chats fill all four slots
+    leases = [pool.acquire(f'chat{i}') for i in range(4)]
+    placements = {(lease.backend.base_url, lease.id_slot) for lease in leases}
+    assert len(placements) == 4, placements
+    for lease in leases:
+        lease.release()
+    print('free slots: OK, 4 chats on 4 different slots')
+
+    # A chat keeps its backend and slot across turns
+    placement = complete(pool, 'sticky', 'hello')
+    pool.poll()
+    for turn in range(3):
+        assert complete(pool, 'sticky', f'turn {turn}') == placement
+    print(f'sticky: OK, all turns on {placement}')
+
+    # The backend of a chat goes down, it fails over to the other one
+    mocks[placement[0]].kill()
+    mocks[placement[0]].wait()
+    new_placement = complete(pool, 'sticky', 'after failover')
+    assert new_placement[0] != placement[0], new_placement
+    assert complete(pool, 'sticky', 'next turn') == new_placement
+    print(f'failover: OK, moved to {new_placement}, {pool.failovers} failover(s)')
+
+    for process in mocks.values():
+        process.kill()
+
+    # A completion cancelled before the headers arrived (stop clicked during the prompt) gives its slot back
+    url, process = start_mock(slots=1, delay=2)
+    pool = BackendPool([url])
+    pool.poll()
+    asyncio.run(cancel_while_sending(AsyncBackendClients(pool)))
+    backend = pool.backends[0]
+    assert not backend.reserved and backend.in_flight == 0, (backend.reserved, backend.in_flight)
+    print('cancel: OK, the slot was released')
+    process.kill()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Converts the vectors of a collection to another precision (float32, float16, int8 or pq) and reports the memory
+saved against the recall lost. The reference is an exact search on the vectors as they are stored now.
+Queries are read from a file (one per line, embedded with the model of the collection), else chunks of the
+collection, slightly perturbed, stand in for them.
+
+    PYTHONPATH=server python3 tools/convert_collection.py data/user/<name>/<collection> int8 [--queries file] [--dry-run]
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+from rag.ann import sample_queries, exact_neighbours
+from rag.quantize import PRECISIONS, train_codec
+from rag.store import NativeCollection, convert_precision
+
+
+def read_queries(path: Path, queries_file: str) -> np.ndarray:
+    from rag import get_embeddings
+    with open(path / 'config.json') as f:
+        model = json.load(f).get('model')
+    with open(queries_file) as f:
+        texts = [line.strip() for line in f if line.strip()]
+    return np.asarray(get_embeddings(model).embed_documents(texts), dtype=np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('collection')
+    parser.add_argument('precision', choices=PRECISIONS)
+    parser.add_argument('--queries', help='file with one query per line')
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--dry-run', action='store_true', help='only report, do not convert')
+    args = parser.parse_args()
+
+    path = Path(args.collection)
+    collection = NativeCollection(path, None)
+    vectors = collection.vectors()
+    queries = read_queries(path, args.queries) if args.queries else sample_queries(vectors)
+    truth = exact_neighbours(vectors, queries, args.k)
+
+    start = time.perf_counter()
+    codec = train_codec(args.precision, vectors)
+    codes = np.concatenate([codec.encode(vectors[first:first + 2**16]) for first in range(0, len(vectors), 2**16)])
+    train_seconds = time.perf_counter() - start
+    found = 0
+    start = time.perf_counter()
+    for query, expected in zip(queries, truth):
+        scores = codec.scores(codes, query)
+        found += len(np.intersect1d(np.argsort(-scores)[:args.k], expected))
+    search_ms = (time.perf_counter() - start) / len(queries) * 1000
+
+    before, after = collection.memory_bytes(), codes.nbytes
+    print(f'{len(vectors)} vectors, {collection.precision} -> {args.precision} '
+          f'(trained and encoded in {train_seconds:.1f}s)')
+    print(f'memory: {before / 2**20:.1f} MiB -> {after / 2**20:.1f} MiB, {(1 - after / max(1, before)) * 100:.0f}% saved')
+    print(f'recall@{args.k} on {len(queries)} {"queries" if args.queries else "sampled queries"}: '
+          f'{found / truth.size:.3f}, exhaustive search {search_ms:.2f} ms/query')
+    if args.dry_run:
+        return
+
+    convert_precision(path, args.precision, codec)
+    with open(path / 'config.json') as f:
+        config = json.load(f)
+    config['precision'] = args.precision
+    with open(path / 'config.json', 'w') as f:
+        json.dump(config, f)
+    print(f'converted {path}')
+
+
+if __name__ == '__main__':
+    main()
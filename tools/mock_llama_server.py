@@ -0,0 +1,116 @@
+"""
+Minimal stand-in for llama-server: /props, /slots, /tokenize and streamed /v1/chat/completions.
+Good enough to test routing and streaming without a model.
+
+    python3 tools/mock_llama_server.py --port 8081 --slots 2
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class MockLlamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int = 8081, slots: int = 2, n_ctx: int = 8192, tokens: int = 20, delay: float = 0.01):
+        super().__init__(('127.0.0.1', port), MockLlamaHandler)
+        self.n_slots = slots
+        self.n_ctx = n_ctx
+        self.tokens = tokens
+        self.delay = delay
+        self.processing = set()
+        self.completions = []  # (id_slot, first user message) of every completion, for checks
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+class MockLlamaHandler(BaseHTTPRequestHandler):
+    server: MockLlamaServer
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        if self.path == '/props':
+            self.send_json(dict(default_generation_settings=dict(n_ctx=self.server.n_ctx),
+                                total_slots=self.server.n_slots,
+                                build_info='mock',
+                                model_path='mock.gguf'))
+        elif self.path == '/slots':
+            with self.server.lock:
+                self.send_json([dict(id=i, is_processing=i in self.server.processing) for i in range(self.server.n_slots)])
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        data = self.read_json()
+        if self.path == '/tokenize':
+            self.send_json(dict(tokens=list(range(len(data.get('content', '').split())))))
+        elif self.path == '/v1/chat/completions':
+            self.stream_completion(data)
+        else:
+            self.send_error(404)
+
+    def stream_completion(self, data):
+        with self.server.lock:
+            id_slot = data.get('id_slot', -1)
+            if id_slot < 0:
+                free = [i for i in range(self.server.n_slots) if i not in self.server.processing]
+                id_slot = free[0] if free else 0
+            self.server.processing.add(id_slot)
+            user_messages = [m['content'] for m in data.get('messages', []) if m.get('role') == 'user']
+            self.server.completions.append((id_slot, user_messages[0] if user_messages else None))
+        time.sleep(self.server.delay)  # processing the prompt, the headers come after
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for i in range(self.server.tokens):
+                chunk = dict(choices=[dict(index=0, finish_reason=None, delta=dict(content=f'token{i} '))],
+                             object='chat.completion.chunk')
+                self.write_chunk(f'data: {json.dumps(chunk)}\n\n')
+                time.sleep(self.server.delay)
+            self.write_chunk('data: [DONE]\n\n')
+            self.write_chunk('')
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client went away, stop generating like llama-server does
+        finally:
+            with self.server.lock:
+                self.server.processing.discard(id_slot)
+
+    def write_chunk(self, text: str):
+        body = text.encode()
+        self.wfile.write(f'{len(body):x}\r\n'.encode() + body + b'\r\n')
+        self.wfile.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--slots', type=int, default=2)
+    parser.add_argument('--n-ctx', type=int, default=8192)
+    parser.add_argument('--tokens', type=int, default=20)
+    parser.add_argument('--delay', type=float, default=0.01)
+    args = parser.parse_args()
+    server = MockLlamaServer(args.port, args.slots, args.n_ctx, args.tokens, args.delay)
+    print(f'Mock llama-server on {server.base_url} with {args.slots} slots')
+    server.serve_forever()